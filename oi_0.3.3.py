@@ -12,19 +12,50 @@ import humanfriendly
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import random
 import uuid
 import csv
 import olca_ipc as ipc
 import olca_schema as olca
 from typing import Callable
+try:
+    import scipy.sparse as sparse
+    import scipy.sparse.linalg as sparse_linalg
+except ImportError:
+    sparse = None  # scipy is only needed for the local matrix engine
+try:
+    from scipy.stats import qmc
+except ImportError:
+    qmc = None  # scipy is only needed for sobol sampling
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None  # pyarrow is only needed for parquet or arrow results output
 import subprocess
 import time
-
-
-plt.style.use('ggplot')
-plt.ion()
+import multiprocessing
+import threading
+import atexit
+import json
+import warnings
+from statistics import NormalDist
+from collections import OrderedDict
+import concurrent.futures
+import queue
+import traceback
+import glob
+import hashlib
+import ast
+import operator
+from oi_tools.replay import RecordingClient, ReplayClient, parse_latency, serve_recording
+from oi_tools.trace import tracer, TracedClient
+from oi_tools.bench import benchmark_pipeline, write_benchmark
+
+
+plt.style.use('ggplot')  # also the style of the standalone figures of the live histogram and tornado plot
 
 timer_start = timeit.default_timer()
 
@@ -36,8 +67,35 @@ script as well as launch OLCA IPC server by running "run_oi.py" from terminal.
 """
 client = ipc.Client(8080)
 
+# Settings of the MODIFY AS NEEDED block of main, the only names main accepts as overrides.
+main_settings = (
+    'sub_names', 'calc_using_ps', 'update_ps_in_place', 'trace_output', 'base_analysis', 'range_analysis',
+    'subgroup_mca', 'probability_analysis', 'loop_runs', 'param_runs', 'minimize_rewiring', 'local_engine',
+    'local_validation_runs', 'ipc_ports', 'prefetch_workers', 'process_cache_size', 'sampling_strategy',
+    'convergence_target', 'adaptive_stopping', 'convergence_tolerance', 'min_loop_runs', 'sobol_analysis',
+    'sobol_base_runs', 'sobol_factors_by', 'pipeline_depth', 'olca_simulator', 'max_value', 'live_histogram',
+    'histogram_interval', 'flush_rows', 'flush_interval', 'columnar_output', 'group_stats_output', 'resume', 'seed',
+    'lcia_methods',
+)
+# Settings that only change how a run is carried out or shown, not its results. A checkpoint journal is continued when
+# only these differ from the run that wrote it; all other settings are part of its signature, see input_signature.
+run_settings = ('sub_names', 'trace_output', 'ipc_ports', 'prefetch_workers', 'process_cache_size', 'max_value',
+                'live_histogram', 'histogram_interval', 'flush_rows', 'flush_interval', 'resume')
+
+
+def main(**overrides):
+    """
+    Runs the simulations of the substitution sheets. The settings are in the MODIFY AS NEEDED block below.
+
+    :param overrides: settings that replace the ones in the MODIFY AS NEEDED block, e.g. main(loop_runs=10), see
+        main_settings
+    """
+    global active_checkpoint, client
+    unknown = set(overrides) - set(main_settings)
+    if unknown:
+        raise TypeError(f'Unknown settings for main: {", ".join(sorted(unknown))}')
+    setting = overrides.get
 
-def main():
     # # Set up logging
     # log_path = os.path.join("logs", f"logfile_{datetime.today().strftime('%y%m%d-%H%M')}.txt")
     # logging.basicConfig(level=logging.DEBUG, filename=log_path, format="")
@@ -77,13 +135,13 @@ def main():
     standard values defined on OLCA, Monte Carlo uses OLCA-defined uncertainty values.
     MODIFY AS NEEDED: ==========================================================================================
     """
-    sub_names = [
+    sub_names = setting('sub_names', [
         'steel_heavysection_v3',
         'steel_hss_v3',
         'steel_plate_v3',
         'steel_rebar_v3',
         'steel_sheet_galv_v3.2'
-    ]
+    ])
 
     # 'steel_heavysection_a1a2a3_v2',
     # 'steel_hss_a1a2a3_v2',
@@ -94,17 +152,82 @@ def main():
 
     # Build a product system for use in the calculation? If False, then the main process is used directly
     # without first building a product system. Note that this only works if all default providers are already set.
-    calc_using_ps = True
+    calc_using_ps = setting('calc_using_ps', True)
+    # Keep one product system per substitution sheet and only rewrite the process links of changed providers? If False,
+    # a new product system is created for every provider combination and deleted after its calculations.
+    update_ps_in_place = setting('update_ps_in_place', True)
+    # Write a trace of the pipeline stages and openLCA requests? None, or a path ending in '.json' for a Chrome trace
+    # (open it in Perfetto or chrome://tracing) or any other path, e.g. ending in '.txt', for OpenMetrics text.
+    trace_output = setting('trace_output', None)
+
+    if trace_output is not None:
+        tracer.enable()
+        client = TracedClient(client)  # times the openLCA requests, unwrapped again at the end of the run
+        atexit.register(tracer.write, trace_output)  # the trace is still written if the run stops early
 
     for sub_name in sub_names:
+        tracer.label = sub_name
         # sub_name = 'steel_heavysection_a1a2a3_v2'  # the filename of the substitution sheet
-        base_analysis = True  # Do you want to run base case simulation?
-        range_analysis = True  # Do you want to run range simulation?
-        subgroup_mca = True  # grouped monte carlo simulation aimed at getting uncertainty group variations
-        probability_analysis = True  # Do you want to run probabilistic simulation?
-        loop_runs = 50
-        param_runs = 5
-        max_value = 5.0  # kgCO2e/unit, expected highest value for setting plot axis max
+        base_analysis = setting('base_analysis', True)  # Do you want to run base case simulation?
+        range_analysis = setting('range_analysis', True)  # Do you want to run range simulation?
+        # grouped monte carlo simulation aimed at getting uncertainty group variations
+        subgroup_mca = setting('subgroup_mca', True)
+        probability_analysis = setting('probability_analysis', True)  # Do you want to run probabilistic simulation?
+        loop_runs = setting('loop_runs', 50)
+        param_runs = setting('param_runs', 5)
+        # order MCA provider draws by similarity and only rewire changed substitutions
+        minimize_rewiring = setting('minimize_rewiring', True)
+        # solve MCA runs with a local matrix engine instead of openLCA calculations (needs scipy)
+        local_engine = setting('local_engine', False)
+        # number of randomly sampled MCA runs to check against openLCA with local_engine
+        local_validation_runs = setting('local_validation_runs', 5)
+        # list more ports to run the MCA in parallel, one openLCA server per database copy
+        ipc_ports = setting('ipc_ports', [8080])
+        # parallel requests used to index the provider reference flows at startup
+        prefetch_workers = setting('prefetch_workers', 8)
+        # max. number of processes kept in memory, least recently used ones are dropped
+        process_cache_size = setting('process_cache_size', 2000)
+        # 'random', 'lhs' (latin hypercube), 'sobol' (scrambled, needs scipy) or 'stratified' (providers drawn in
+        # proportion to their market shares, random parameters) for the MCA draws
+        sampling_strategy = setting('sampling_strategy', 'random')
+        # report after how many MCA runs the gwp percentiles stay within this relative error
+        convergence_target = setting('convergence_target', 0.01)
+        # stop the MCA and sub-group loops once the gwp estimates are within the tolerance; loop_runs is then the
+        # maximum number of loop runs. The MCA checks for convergence after every min_loop_runs loop runs and only
+        # groups repeated provider combinations within these batches, so it rewires more often than without stopping.
+        adaptive_stopping = setting('adaptive_stopping', False)
+        # relative half width of the 95% confidence intervals of mean, p5, p50 and p95 gwp
+        convergence_tolerance = setting('convergence_tolerance', 0.02)
+        # loop runs before adaptive stopping is considered, also the MCA batch size between convergence checks
+        min_loop_runs = setting('min_loop_runs', 10)
+        # first-order and total Sobol indices of gwp from one shared Saltelli design; can replace the sub-group MCA,
+        # which needs a full MCA per uf_group and does not capture interactions
+        sobol_analysis = setting('sobol_analysis', False)
+        # rows of the A and B matrices, a power of 2; runs = sobol_base_runs * (factors + 2)
+        sobol_base_runs = setting('sobol_base_runs', 64)
+        # 'uf_group' (one factor per uncertainty group) or 'variable' (one factor per provider sheet and parameter)
+        sobol_factors_by = setting('sobol_factors_by', 'uf_group')
+        # openLCA calculations kept running while the next parameters are picked and results are written; 1 waits for
+        # every calculation before the next one is started
+        pipeline_depth = setting('pipeline_depth', 2)
+        # sample parameters in an openLCA simulator session per product system (faster, but sampled parameter values are
+        # not recorded in the results csv)
+        olca_simulator = setting('olca_simulator', False)
+        max_value = setting('max_value', 5.0)  # kgCO2e/unit, expected highest value for setting plot axis max
+        # save a live gwp histogram next to the results csv; set False for headless batch runs
+        live_histogram = setting('live_histogram', True)
+        histogram_interval = setting('histogram_interval', 5.0)  # seconds between live histogram updates
+        flush_rows = setting('flush_rows', 50)  # results are written to disk in batches of this many rows...
+        flush_interval = setting('flush_interval', 30.0)  # ...or after this many seconds, whichever comes first
+        # 'parquet' or 'arrow' to also write a typed results file next to the csv (needs pyarrow)
+        columnar_output = setting('columnar_output', None)
+        # write group stats and boxplot data per sim_type next to the raw results folder
+        group_stats_output = setting('group_stats_output', True)
+        # continue interrupted work from the checkpoint journal and skip finished substitution sheets; the journal is
+        # only used if the sheets, the openLCA server and all settings that change the results are the same
+        resume = setting('resume', True)
+        # seed of the random draws, so a run can be repeated; None draws new values every run
+        seed = setting('seed', None)
 
         """
         Value suggestions:
@@ -114,17 +237,55 @@ def main():
         max_value = 2.0  # electricity, per kWh
         """
 
-        lcia_methods = [
+        lcia_methods = setting('lcia_methods', [
             'TRACI 2.1 (openIMPACT)'
             # 'IPCC 2013 GWP 100a',
             # 'EF Method (adapted)',
             # 'CML-IA baseline'
-        ]
+        ])
 
         """
         END OF MANUAL MODIFICATIONS ====================================================================================
         """
 
+        if len(ipc_ports) > 1:
+            if probability_analysis and local_engine:
+                raise ValueError(f'local_engine is not supported by the parallel MCA. Use a single ipc port for it, or '
+                                 f'set local_engine = False.')
+            print(f'Only the MCA runs in parallel on ports {ipc_ports}. The base, range, sub-group and Sobol phases run '
+                  f'on the openLCA server of the main client.')
+
+        """
+        Checkpoint journal. Finished phases and iterations, the results csv offset and the random number generator
+        state are recorded as the simulation goes, so an interrupted run continues where it stopped. Delete the journal
+        or set resume = False to start a substitution sheet over. The journal is also started over when the
+        substitution sheet, one of its provider sheets, the openLCA server or a setting that changes the results (all
+        but run_settings, e.g. the phases that are run or the seed) differs from the run that wrote it.
+        """
+        current = locals()
+        signature = input_signature(os.path.join("substitutions", f"{sub_name}.xlsx"), {
+            **{name: current[name] for name in main_settings if name not in run_settings},
+            'parallel': len(ipc_ports) > 1, 'database': client.url,
+        })
+        checkpoint = Checkpoint(os.path.join("results files", "checkpoints", f"{sub_name}.json"), resume=resume,
+                                signature=signature)
+        if seed is not None and not checkpoint.resumed:
+            np.random.seed(seed)
+            random.seed(seed)
+        if checkpoint.finished:
+            print(f'"{sub_name}" is already finished according to {checkpoint.path}, skipping it.')
+            continue
+        if checkpoint.orphans():
+            print(f'Cleaning up product systems left behind by an interrupted run.')
+            checkpoint.clean_up()
+        active_checkpoint = checkpoint
+
+        # Processes cached for a previous substitution sheet are checked against the database before they are reused.
+        cache_process.resize(process_cache_size)
+        if len(cache_process) > 0:
+            invalidated = cache_process.revalidate(lambda olca_uuid: client.get(olca.Process, olca_uuid))
+            print(f'Revalidated {len(cache_process)} cached processes, {invalidated} changed in the database.')
+
         print(f'Loading "{sub_name}" substitution sheet.')
 
         """ LOAD SUBSTITUTION DATA """
@@ -144,6 +305,11 @@ def main():
         for i in provider_sheets:
             print(f'\t{i}')
 
+        # Reference flows of all providers are fetched once, so rewiring never fetches a full provider process.
+        print(f'\nIndexing provider reference flows.')
+        with tracer.span('provider index'):
+            provider_index = preload_ref_flows(provider_sheets, workers=prefetch_workers)
+
         # List all parameters used in this simulation
         print(f'\nIdentifying parameters and their context.')
         param_sheet = sub_sheet[sub_sheet['parameter'].notna()].reset_index()
@@ -219,11 +385,14 @@ def main():
         # List all base, low, and high parameters for each provider sheet
         print(f'\nIdentifying base model parameters.')
 
+        # The sample strings are compiled once per substitution sheet; all phases read and draw from this table.
+        param_table = compile_parameters(param_sheet)
+
         param_lists = []  # placeholder list for param tables
-        for index, row in param_sheet.iterrows():
-            q_base = pick_value(row['sample'], "base")
-            q_low = pick_value(row['sample'], "low")
-            q_high = pick_value(row['sample'], "high")
+        for position, (index, row) in enumerate(param_sheet.iterrows()):
+            q_base = param_table['base'][position].item()
+            q_low = param_table['low'][position].item()
+            q_high = param_table['high'][position].item()
             param_lists.append([row['uuid'], row['name'], row['parameter'], "base", q_base])
             param_lists.append([row['uuid'], row['name'], row['parameter'], "low", q_low])
             param_lists.append([row['uuid'], row['name'], row['parameter'], "high", q_high])
@@ -267,6 +436,8 @@ def main():
         # Get the reference amount and unit of the main process (from which a Product System is later created).
         main_process_uuid = sub_sheet['uuid'].iloc[0]  # Get main process uuid
         main_process_json = fetch_process_json(main_process_uuid)  # Fetch main process JSON
+        ps_manager = ProductSystemManager(main_process_json, prov_sheet, in_place=update_ps_in_place)
+        pipeline = CalculationPipeline(lcia_methods, pipeline_depth)
         ref_amount, ref_unit = find_ref_flow(main_process_json)  # Get main process reference flow info
         print(f'\nGetting product system reference info.\n'
               f'\tMain process:\t {main_process_json.name}\n'
@@ -282,18 +453,41 @@ def main():
         """ SETUP OF RESULTS FILES """
 
         """ for MCA """
-        print(f'\nSetting up a csv results file for Probabilistic Analysis.')
-        datetime_stamp = datetime.today().strftime('%y%m%d-%H%M')
-        results_name = f'{main_process_json.name} {datetime_stamp}'
-        res_path = os.path.join("results files", f"{main_process_json.name}", "raw", f"{results_name}.csv")
+        if checkpoint.resumed:
+            res_path = checkpoint.state['res_path']
+            results_name = os.path.splitext(os.path.basename(res_path))[0]
+            print(f'\nResuming the csv results file {res_path}.')
+        else:
+            print(f'\nSetting up a csv results file for Probabilistic Analysis.')
+            datetime_stamp = datetime.today().strftime('%y%m%d-%H%M')
+            results_name = f'{main_process_json.name} {datetime_stamp}'
+            res_path = os.path.join("results files", f"{main_process_json.name}", "raw", f"{results_name}.csv")
         header = (provider_sheets + param_list +
                   ['gwp', 'gwp_be', 'gep_bu', 'ap', 'ep', 'odp', 'pocp', 'gwp_AR5', 'gwp_EF2', 'gwp_CML'] +
                   ["sim_type"])
 
-        f = open(res_path, "w", newline='')
-        writer = csv.DictWriter(f, fieldnames=header)
-        writer.writeheader()
-        f.close()
+        # Results are buffered and written in batches; the writer stays open for the whole run. Group stats are
+        # collected from the written rows; a resumed run streams them from the csv at the end instead.
+        group_stats = GroupStats() if group_stats_output and not checkpoint.resumed else None
+        results = ResultsWriter(res_path, header,
+                                text_columns=provider_sheets + ["sim_type"],
+                                batch_size=flush_rows,
+                                interval=flush_interval,
+                                columnar=columnar_output,
+                                offset=checkpoint.state['csv_offset'],
+                                stats=group_stats)
+        checkpoint.start(res_path)
+
+        # Live histogram of MCA results, fed with new rows only and rendered in the background.
+        histogram = LiveHistogram(main_process_json.name,
+                                  declared_unit=ref_unit,
+                                  results_path=res_path,
+                                  max_value=max_value,
+                                  interval=histogram_interval,
+                                  enabled=live_histogram)
+        gwp_column = header.index('gwp')
+        if checkpoint.resumed:
+            histogram.add(pd.read_csv(res_path, dtype=str).values.tolist(), gwp_column)
 
         # Create a directory with substitution and provider files for debugging
         debug_dir = os.path.join("results files", f"{main_process_json.name}", "raw", f"{results_name} input debug")
@@ -316,243 +510,214 @@ def main():
             Set all providers to base providers
             Set all parameters to base parameters
             Run simulation
-    
-        2. For each row in range_p_df (range provider table)
-            Set all providers to base providers
-            Sub range provider
-            Set all parameters to base parameters
-            Run simulation
-    
-        3. For each row in range_q_df (range parameter table)
-            Set all providers to base providers
-            Set all parameters to base parameters
-            Sub range parameter
-            Run simulation
+
+        2. For each provider swap of the sensitivity plan (range_p_df, range provider table)
+            Sub range provider, as a diff from the base providers
+            Run simulation with base parameters
+            Revert the range provider to the base provider
+
+        3. For each parameter swap of the sensitivity plan (range_q_df, range parameter table)
+            Sub range parameter in the base parameter redefinitions
+            Run simulation on the base product system
+
+        The one-at-a-time design is planned up front (plan_sensitivity). Only parameter redefinitions change between the
+        base run and the parameter range runs, so they share a single base product system (base_ps), which is released
+        once the parameter range runs are finished. Swaps that equal the base case reuse the base results. Tornado data
+        of all swaps is written at the end (write_tornado).
         """
+        base_ps = None
+        provider_dict = None  # providers the processes are currently modified for
+
+        print(f'\nGetting base provider data')
+        base_provider_dict = identify_providers(base_p_df)
+
+        print(f'\nGetting base parameter data')
+        base_picked = []
+        base_redefs = []
+        for index, row in base_q_df.iterrows():
+            # Append picked value to list of redefinitions for results sheet
+            base_picked.append(row['value'])
+            # Redefine parameters in OLCA model
+            redef = olca.ParameterRedef(
+                context=fetch_descriptor(olca.Process, row['uuid']),
+                name=row['parameter'],
+                value=row['value']
+            )
+            base_redefs.append(redef)
+            print(f"\t{index}) {row['parameter']} :: {row['value']}")
 
-        if base_analysis:
-            print(f'\nStarting base simulation.\n=============================================================')
-            base_start = timeit.default_timer()
+        base_providers_picked = [base_provider_dict[sheet].name for sheet in provider_sheets]
+        base_impacts = None  # results of the base run, reused by swaps that equal the base case
 
-            counter = 0
+        base_start = timeit.default_timer()
+        counter = 0
+        if base_analysis and not checkpoint.done('base'):
+            print(f'\nStarting base simulation.\n=============================================================')
 
             """ 1. Run base simulation """
 
             """SETUP: PROVIDERS OF FLOWS"""
-            print(f'\nGetting base provider data')
-            provider_dict = identify_providers(base_p_df)
-
             print(f'\nModifying all relevant processes.')
-            modify_processes(prov_sheet, provider_dict)
+            with tracer.span('rewire'):
+                modify_processes(prov_sheet, base_provider_dict, preloaded_provider_dict=provider_index)
+            provider_dict = base_provider_dict
 
             if calc_using_ps:
                 """SETUP: PRODUCT SYSTEM"""
-                print(f'\nCreating a product system.')
-                model_ref = create_ps(main_process_json)
-
-            """SETUP: PARAMETER REDEFINITION"""
-            print(f'\nGetting base parameter data')
-            param_picked = []
-            parameter_redefs = []
-            for index, row in base_q_df.iterrows():
-                # Append picked value to list of redefinitions for results sheet
-                param_picked.append(row['value'])
-                # Redefine parameters in OLCA model
-                redef = olca.ParameterRedef(
-                    context=client.get_descriptor(olca.Process, row['uuid']),
-                    name=row['parameter'],
-                    value=row['value']
-                )
-                parameter_redefs.append(redef)
-                # print(f"\t{index}) {row['parameter']}: {row['value']}")
-                # print(f"\t{q_index}) {q_row['parameter']}: {value} || {redef}")
+                with tracer.span('product system'):
+                    model_ref = ps_manager.acquire(provider_key(base_provider_dict))
+                base_ps = model_ref
 
             """EXECUTE: CALCULATION"""
             counter += 1
-            impact_results = []
-            impact_results = get_results(model_ref, lcia_methods, counter, parameter_redefs)
+            with tracer.span('calculate'):
+                impact_results = get_results(model_ref, lcia_methods, counter, base_redefs)
+            base_impacts = impact_results
 
             """
-            Save results to csv. A new csv file is created on every first simulation and any additional runs in 
-            that simulation are appended to that csv. This ensures that results are saved even if the full 
-            simulation doesn't finish.
+            Save results to csv. Rows are buffered by the results writer and appended to the csv in batches, and any
+            buffered rows are written on exit. This ensures that results are saved even if the full simulation doesn't
+            finish.
             """
-            # provider_keys_list = list(provider_dict)
-            providers_picked = []
-            for sheet in provider_sheets:
-                providers_picked.append(provider_dict[sheet].name)
+            fields = base_providers_picked + base_picked + impact_results + ["base"]
 
-            fields = providers_picked + param_picked + impact_results + ["base"]
+            with tracer.span('write'):
+                results.writerow(fields)
 
-            # Append results to an existing csv file
-            with open(res_path, 'a', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow(fields)
-            # counter += 1
-            # print(f'\nResult saved to csv. | Run {counter} gwp: {gwp:.2f} {gwp_unit} ({lcia_methods[0]})')
+            if calc_using_ps and not range_analysis:
+                ps_manager.release_all()  # the base product system is only reused by the parameter range runs
+                base_ps = None
 
-            if calc_using_ps:
-                client.delete(model_ref)  # delete product system
+            checkpoint.save('base', results, done=True)
 
             print('\nElapsed time: {}'.format(humanfriendly.format_timespan(timeit.default_timer() - timer_start)))
 
-            """ 2. For each row in range_p_df (range provider table) """
-
-        if range_analysis:
-            print(f'\n\nStarting provider range simulations...')
-            # for all providers run through swaps between base and range providers
-            for range_index, range_row in range_p_df.iterrows():
+            """ 2. For each provider swap (range provider table) """
 
-                print(f'\nResetting all providers to base selection')
-                # identifying all base providers (base_p)
-                provider_dict = identify_providers(base_p_df)
+        if range_analysis and not checkpoint.done('parameter_range'):
+            print(f'\nPlanning the one-at-a-time sensitivity runs.')
+            provider_swaps, parameter_swaps = plan_sensitivity(base_provider_dict, range_p_df, base_q_df, range_q_df)
 
-                print(f"\nSetting {range_row['provider_sheet']} to {range_row['mark']}")
-                # If UUID is provided, get REF by UUID, else get REF by Name.
-                if isinstance(range_row['process_uuid'], str):
-                    provider_ref = client.get_descriptor(olca.Process, range_row['process_uuid'])
+            print(f'\n\nStarting provider range simulations...')
+            # run through the provider swaps, skipping finished ones
+            for range_index in range(checkpoint.progress('provider_range'), len(provider_swaps)):
+                swap = provider_swaps[range_index]
+                print(f"\nSetting {swap['factor']} to {swap['mark']} :: {swap['label']}")
+
+                if swap['same_as_base'] and base_impacts is not None:
+                    print(f'Same provider as the base case, reusing the base results.')
+                    impact_results = base_impacts
                 else:
-                    provider_ref = client.find(olca.Process, range_row['name'])
-
-                # save the range provider selection to provider_dict for this iteration
-                provider_dict[range_row['provider_sheet']] = provider_ref
+                    print(f'\nModifying the swapped substitutions.')
+                    # processes are at the base providers (or unknown after a resume), so only the swap is rewired
+                    with tracer.span('rewire'):
+                        modify_processes(prov_sheet, swap['provider_dict'], previous_dict=provider_dict,
+                                         preloaded_provider_dict=provider_index)
+                    provider_dict = swap['provider_dict']
 
-                print(f'\nModifying all relevant processes.')
-                # modify all processes using either the selected base or range provider listed in provider_dict
-                modify_processes(prov_sheet, provider_dict)
+                    if calc_using_ps:
+                        with tracer.span('product system'):
+                            model_ref = ps_manager.acquire()
 
-                if calc_using_ps:
-                    print(f'Creating a product system.')
-                    model_ref = create_ps(main_process_json)
-
-                print(f'\nGetting base parameter data')
-                # set_params(base_q_df)
-
-                parameter_dict = {}
-                param_picked = []
-                parameter_redefs = []
-
-                # set all parameters to base (base_q)
-                for index, row in base_q_df.iterrows():
-                    # Append picked value to list of redefinitions for results sheet
-                    param_picked.append(row['value'])
-                    # Redefine parameters in OLCA model
-                    redef = olca.ParameterRedef(
-                        context=client.get_descriptor(olca.Process, row['uuid']),
-                        name=row['parameter'],
-                        value=row['value']
-                    )
-                    parameter_redefs.append(redef)
-                    print(f"\t{index}) {row['parameter']} :: {row['value']}")
-                    # print(f"\t{q_index}) {q_row['parameter']}: {value} || {redef}")
+                    """EXECUTE: CALCULATION"""
+                    counter += 1
+                    with tracer.span('calculate'):
+                        impact_results = get_results(model_ref, lcia_methods, counter, base_redefs)
 
-                """EXECUTE: CALCULATION"""
+                    if calc_using_ps:
+                        ps_manager.release(model_ref)
 
-                counter += 1
-                impact_results = []
-                impact_results = get_results(model_ref, lcia_methods, counter, parameter_redefs)
+                    print(f"\nReverting {swap['factor']} to the base provider.")
+                    with tracer.span('rewire'):
+                        modify_processes(prov_sheet, base_provider_dict, previous_dict=provider_dict,
+                                         preloaded_provider_dict=provider_index)
+                    provider_dict = base_provider_dict
 
                 """
-                Save results to csv. A new csv file is created on every first simulation and any additional runs in 
-                that simulation are appended to that csv. This ensures that results are saved even if the full 
-                simulation doesn't finish.
+                Save results to csv. Rows are buffered by the results writer and appended to the csv in batches, and any
+                buffered rows are written on exit. This ensures that results are saved even if the full simulation doesn't
+                finish.
                 """
-                # provider_keys_list = list(provider_dict)
-                providers_picked = []
-                for sheet in provider_sheets:
-                    providers_picked.append(provider_dict[sheet].name)
+                providers_picked = [swap['provider_dict'][sheet].name for sheet in provider_sheets]
 
-                fields = providers_picked + param_picked + impact_results + ["range"]
+                fields = providers_picked + base_picked + impact_results + ["range"]
 
-                with open(res_path, 'a', newline='') as f:  # 'a' appends to an existing file
-                    writer = csv.writer(f)
-                    writer.writerow(fields)
-                # counter += 1
-                # print(f'\nResult saved to csv. | Run {counter} gwp: {gwp:.2f} {gwp_unit} ({lcia_methods[0]})')
-
-                if calc_using_ps:
-                    client.delete(model_ref)  # delete product system
+                with tracer.span('write'):
+                    results.writerow(fields)
 
+                checkpoint.save('provider_range', results, progress=range_index + 1)
                 print('\nElapsed time: {}'.format(humanfriendly.format_timespan(timeit.default_timer() - timer_start)))
 
-            """ 3. For each row in range_q_df (range parameter table) """
+            checkpoint.save('provider_range', results, done=True)
 
-            print(f'\n\nStarting parameter range simulations...')
-            # for all parameters run through swaps between base and range parameters
-            for range_index, range_row in range_q_df.iterrows():
+            """ 3. For each parameter swap (range parameter table) """
 
-                print(f'\nResetting all providers to base selection')
-                provider_dict = identify_providers(base_p_df)
+            print(f'\n\nStarting parameter range simulations...')
 
-                print(f'\nModifying all relevant processes.')
-                modify_processes(prov_sheet, provider_dict)
+            """
+            Only the parameter redefinitions change between parameter range runs. Processes are reset to the base
+            providers if needed, and all runs use the base product system (or a single new one if the base simulation
+            was not run).
+            """
+            parameter_progress = checkpoint.progress('parameter_range')
+            if any(not swap['same_as_base'] or base_impacts is None for swap in parameter_swaps[parameter_progress:]):
+                if provider_dict is None or provider_key(provider_dict) != provider_key(base_provider_dict):
+                    print(f'\nResetting all providers to base selection')
+                    with tracer.span('rewire'):
+                        modify_processes(prov_sheet, base_provider_dict, previous_dict=provider_dict,
+                                         preloaded_provider_dict=provider_index)
+                    provider_dict = base_provider_dict
 
                 if calc_using_ps:
-                    print(f'Creating a product system.')
-                    model_ref = create_ps(main_process_json)
-
-                print(f'\nGetting base parameter data')
-
-                param_picked = []
-                parameter_redefs = []
-
-                for base_index, base_row in base_q_df.iterrows():
-                    if base_row['name'] == range_row['name'] and base_row['parameter'] == range_row['parameter']:
-                        # Append picked value to list of redefinitions for results sheet
-                        param_picked.append(range_row['value'])
-                        # Redefine parameters in OLCA model
-                        redef = olca.ParameterRedef(
-                            context=client.get_descriptor(olca.Process, range_row['uuid']),
-                            name=range_row['parameter'],
-                            value=range_row['value']
-                        )
-                        parameter_redefs.append(redef)
-                        print(f"\t{range_index}) {range_row['mark']} value of {range_row['value']} "
-                              f"set for {range_row['name']}.{range_row['parameter']}")
-                        # print(f"\t{q_index}) {q_row['parameter']}: {value} || {redef}")
-
-                    else:
-                        # Append picked value to list of redefinitions for results sheet
-                        param_picked.append(base_row['value'])
-                        # Redefine parameters in OLCA model
-                        redef = olca.ParameterRedef(
-                            context=client.get_descriptor(olca.Process, base_row['uuid']),
-                            name=base_row['parameter'],
-                            value=base_row['value']
-                        )
-                        parameter_redefs.append(redef)
-                        print(f"\t{base_index}) {base_row['mark']} value of {base_row['value']} "
-                              f"set for {base_row['name']}.{base_row['parameter']}")
-                        # print(f"\t{q_index}) {q_row['parameter']}: {value} || {redef}")
-
-                """EXECUTE: CALCULATION"""
+                    # the base product system, relinked to the base providers if it is updated in place
+                    with tracer.span('product system'):
+                        base_ps = ps_manager.acquire(provider_key(base_provider_dict))
+                    model_ref = base_ps
+
+            # run through the parameter swaps, skipping finished ones
+            for range_index in range(parameter_progress, len(parameter_swaps)):
+                swap = parameter_swaps[range_index]
+                print(f"\n{swap['mark']} value of {swap['label']} set for {swap['factor']}")
+
+                param_picked = list(base_picked)
+                parameter_redefs = list(base_redefs)
+                for position in swap['positions']:
+                    param_picked[position] = swap['value']
+                    parameter_redefs[position] = olca.ParameterRedef(
+                        context=base_redefs[position].context,
+                        name=base_redefs[position].name,
+                        value=swap['value']
+                    )
 
-                counter += 1
-                impact_results = []
-                impact_results = get_results(model_ref, lcia_methods, counter, parameter_redefs)
+                if swap['same_as_base'] and base_impacts is not None:
+                    print(f'Same value as the base case, reusing the base results.')
+                    impact_results = base_impacts
+                else:
+                    """EXECUTE: CALCULATION"""
+                    counter += 1
+                    with tracer.span('calculate'):
+                        impact_results = get_results(model_ref, lcia_methods, counter, parameter_redefs)
 
                 """
-                Save results to csv. A new csv file is created on every first simulation and any additional runs in 
-                that simulation are appended to that csv. This ensures that results are saved even if the full 
-                simulation doesn't finish.
+                Save results to csv. Rows are buffered by the results writer and appended to the csv in batches, and any
+                buffered rows are written on exit. This ensures that results are saved even if the full simulation doesn't
+                finish.
                 """
-                # provider_keys_list = list(provider_dict)
-                providers_picked = []
-                for sheet in provider_sheets:
-                    providers_picked.append(provider_dict[sheet].name)
+                fields = base_providers_picked + param_picked + impact_results + ["range"]
 
-                fields = providers_picked + param_picked + impact_results + ["range"]
+                with tracer.span('write'):
+                    results.writerow(fields)
 
-                with open(res_path, 'a', newline='') as f:  # 'a' appends to an existing file
-                    writer = csv.writer(f)
-                    writer.writerow(fields)
-                # counter += 1
-                # print(f'\nResult saved to csv. | Run {counter} gwp: {gwp:.2f} {gwp_unit} ({lcia_methods[0]})')
+                checkpoint.save('parameter_range', results, progress=range_index + 1)
+                print('\nElapsed time: {}'.format(humanfriendly.format_timespan(timeit.default_timer() - timer_start)))
 
-                if calc_using_ps:
-                    client.delete(model_ref)  # delete product system
+            if calc_using_ps and base_ps is not None:
+                ps_manager.release_all()  # delete the shared base product system
+                base_ps = None
 
-                print('\nElapsed time: {}'.format(humanfriendly.format_timespan(timeit.default_timer() - timer_start)))
+            checkpoint.save('parameter_range', results, done=True)
+            results.flush()  # write_tornado reads the range rows from the csv
+            write_tornado(res_path, provider_swaps + parameter_swaps, ref_unit)
 
             """ End of base simulation """
             # Show execution time for base simulation.
@@ -573,7 +738,97 @@ def main():
                 - it is more complicated and takes longer to swap providers
         """
 
-        if probability_analysis:
+        if probability_analysis and checkpoint.done('mca'):
+            print(f'\nProbability simulation already finished, skipping it.')
+
+        elif probability_analysis and len(ipc_ports) > 1:
+            print(f'\nStarting parallel probability simulation on {len(ipc_ports)} openLCA IPC servers.\n'
+                  f'=============================================================')
+            mca_start = timeit.default_timer()
+
+            """
+            Whole MCA iterations (provider pick, process modification, product system, parameter loops) are handed to
+            whichever server is free. Every server needs its own copy of the database, because each worker modifies
+            processes and creates product systems independently. Rows are merged into the same results csv.
+            """
+            mca_context = {
+                'prov_sheet': prov_sheet,
+                'provider_sheets': provider_sheets,
+                'param_sheet': param_sheet,
+                'param_table': param_table,
+                'main_process_json': main_process_json,
+                'lcia_methods': lcia_methods,
+                'param_runs': param_runs,
+                'calc_using_ps': calc_using_ps,
+                'update_ps_in_place': update_ps_in_place,
+                'minimize_rewiring': minimize_rewiring,
+                'olca_simulator': olca_simulator,
+                'pipeline_depth': pipeline_depth,
+                'provider_index': provider_index,
+                'replay': getattr(client, 'replay_args', None),  # workers replay the same recording, see ReplayClient
+                'trace': tracer.label if tracer.enabled else None,  # workers trace under the same sub_name
+                'journal': checkpoint.path,  # workers journal their product systems next to it
+            }
+            if isinstance(getattr(client, 'client', client), RecordingClient):
+                print(f'!! Requests of the parallel MCA workers are not recorded. Use a single ipc port to record them.')
+            if olca_simulator:
+                record_simulated(res_path, 'mca', simulator_parameters(param_sheet), param_list)  # as in the workers
+
+            # Iterations are independent, so an interrupted MCA only runs the iterations that did not finish. They
+            # finish out of order, so the journal keeps the numbers of the finished iterations. The sampling design
+            # covers all loop runs and every iteration seeds its own random stream from its number, so an iteration
+            # draws the same values whichever worker runs it; both seeds are journaled.
+            mca_phase = checkpoint.phase('mca')
+            provider_design, param_design = mca_designs(sampling_strategy, mca_phase, loop_runs, param_runs,
+                                                        provider_sheets, param_sheet)
+            if 'run_seed' not in mca_phase:
+                mca_phase['run_seed'] = int(np.random.randint(0, 2**31))
+            checkpoint.write()
+
+            finished_runs = set(mca_phase.get('finished_runs', range(mca_phase['progress'])))
+            runs_done = len(finished_runs)
+            runs_resumed = runs_done
+            monitor = ConvergenceMonitor(convergence_tolerance, min_runs=min_loop_runs)
+            if runs_done > 0:
+                print(f'\nResuming the MCA after {runs_done} finished iterations.')
+                checkpoint.restore_rng()
+                results.flush()
+                monitor.add_csv(res_path, 'mca', 'gwp', param_runs)
+            mca_context['provider_design'] = provider_design
+            mca_context['param_design'] = param_design
+            mca_context['run_seed'] = mca_phase['run_seed']
+
+            # With adaptive stopping, no new iterations are handed out once converged; running ones still finish.
+            stop = monitor.converged if adaptive_stopping else None
+            missing_runs = [run for run in range(loop_runs) if run not in finished_runs]
+            for run, rows in run_parallel_mca(ipc_ports, missing_runs, mca_context, stop=stop):
+                with tracer.span('write'):
+                    results.writerows(rows)
+
+                histogram.add(rows, gwp_column)
+                monitor.add(rows, gwp_column)
+                monitor.end_run()
+
+                finished_runs.add(run)
+                runs_done = len(finished_runs)
+                checkpoint.save('mca', results, progress=runs_done, finished_runs=sorted(finished_runs))
+                print(f'\n{monitor.summary()}')
+                time_left = ((timeit.default_timer() - mca_start) / (runs_done - runs_resumed) *
+                             (loop_runs - runs_done))
+                print(f'\nFinished iteration {runs_done} / {loop_runs}')
+                print('Elapsed time: {}'.format(humanfriendly.format_timespan(timeit.default_timer() - timer_start)))
+                print('Time remaining: {}'.format(humanfriendly.format_timespan(time_left)))
+
+            checkpoint.save('mca', results, done=True)
+            if adaptive_stopping and runs_done < loop_runs:
+                print(f'\nMCA converged after {runs_done} / {loop_runs} iterations.')
+            results.flush()
+            report_convergence(res_path, sampling_strategy, convergence_target)
+
+            # Show execution time for probability simulation.
+            print(f'\nTotal MCA run time: {humanfriendly.format_timespan(timeit.default_timer() - mca_start)}')
+
+        elif probability_analysis:
             print(f'\nStarting probability simulation.\n=============================================================')
             mca_start = timeit.default_timer()
 
@@ -583,9 +838,116 @@ def main():
             OLCA simulations consist of OLCA sampling from the basic and DQI uncertainty definitions associated with
             processes, exchanges, and/or parameters.
             """
-            counter = 0
+            """
+            When resuming, the random number generators are reset to their state at the start of the MCA, so the same
+            provider combinations are drawn again. Finished iterations are then skipped and the random number generators
+            continue from the state of the last finished iteration.
+            """
+            mca_phase = checkpoint.phase('mca')
+
+            """
+            With a sampling_strategy other than 'random', providers and parameters are drawn from a stratified or
+            quasi-random design over all loop runs, so percentiles settle with fewer runs. The design seed is drawn
+            before the start state is recorded, so a resumed MCA gets the same design.
+            """
+            provider_design, param_design = mca_designs(sampling_strategy, mca_phase, loop_runs, param_runs,
+                                                        provider_sheets, param_sheet)
+
+            if 'start_rng' in mca_phase:
+                set_rng_state(mca_phase['start_rng'])
+            else:
+                mca_phase['start_rng'] = get_rng_state()
+                checkpoint.write()
+            runs_done = mca_phase['progress']
+            counter = runs_done * param_runs
+
+            """
+            Draw the provider combinations for all loop runs up front. Repeated combinations are grouped together so
+            that processes are only rewired and a product system is only created once per distinct combination.
+            Repeats of a combination only run their parameter redefinition loops against the stored product system.
+            """
+            print(f'\nPicking providers for {loop_runs} iterations ({sampling_strategy} sampling)')
+            with tracer.span('provider pick'):
+                if provider_design is None:
+                    provider_draws = [pick_providers(provider_sheets) for run in range(loop_runs)]
+                else:
+                    provider_draws = [pick_providers(provider_sheets, uniforms=provider_design[run])
+                                      for run in range(loop_runs)]
+            reorder = order_provider_draws if minimize_rewiring else group_provider_draws
+            if adaptive_stopping:
+                # The MCA only stops after whole batches of min_loop_runs iterations, so the draws are reordered within
+                # each batch. A stop then never leaves out the draws that the reordering moved to the end.
+                stop_batch = max(1, min_loop_runs)
+                provider_draws = [provider_dict for start in range(0, loop_runs, stop_batch)
+                                  for provider_dict in reorder(provider_draws[start:start + stop_batch])]
+            else:
+                provider_draws = reorder(provider_draws)
+            print(f'\t{len(set(provider_key(d) for d in provider_draws))} distinct provider combinations '
+                  f'in {loop_runs} iterations.')
+
+            """
+            With olca_simulator, parameters are sampled by openLCA in one simulator session per product system instead
+            of a new calculation for every parameter draw. Falls back to pick_parameters if a sample has no openLCA
+            distribution.
+            """
+            simulation_setup = simulator_parameters(param_sheet) if olca_simulator else None
+            record_simulated(res_path, 'mca', simulation_setup, param_list)
+            wired_dict = None  # provider combination the processes are currently modified for
+
+            """
+            Local matrix engine. The matrices of the base product system and of all candidate providers are exported
+            from openLCA once. Runs the engine supports are then solved locally, without modifying processes, creating
+            product systems or calculating in openLCA. A random sample of runs is checked against openLCA at the end.
+            """
+            engine = None
+            validation_runs = set()
+            validation_samples = []
+            if local_engine:
+                if sparse is None:
+                    print(f'!! The local engine needs scipy. Using openLCA calculations instead.')
+                else:
+                    print(f'\nBuilding local matrix engine.')
+                    wired_dict = identify_providers(base_p_df)
+                    with tracer.span('rewire'):
+                        modify_processes(prov_sheet, wired_dict, preloaded_provider_dict=provider_index)
+                    with tracer.span('product system'):
+                        engine_ps = ps_manager.acquire()
+
+                    engine_redefs = []
+                    for index, row in base_q_df.iterrows():
+                        engine_redefs.append(olca.ParameterRedef(
+                            context=fetch_descriptor(olca.Process, row['uuid']),
+                            name=row['parameter'],
+                            value=row['value']
+                        ))
+
+                    engine = LocalEngine(prov_sheet, lcia_methods)
+                    try:
+                        with tracer.span('local engine build'):
+                            engine.build(engine_ps, engine_redefs, list_sheet_providers(provider_sheets), param_sheet)
+                    finally:
+                        ps_manager.release(engine_ps)
 
-            for run in range(loop_runs):
+                    total_runs = loop_runs * param_runs
+                    validation_runs = set(random.sample(range(1, total_runs + 1),
+                                                        min(local_validation_runs, total_runs)))
+
+            """
+            Convergence monitor on the streaming gwp results. With adaptive_stopping, the MCA stops once the confidence
+            intervals of the mean and percentiles are within convergence_tolerance, or after loop_runs iterations.
+            """
+            monitor = ConvergenceMonitor(convergence_tolerance, min_runs=min_loop_runs)
+
+            if runs_done > 0:
+                print(f'\nResuming the MCA after {runs_done} finished iterations.')
+                checkpoint.restore_rng()
+                results.flush()
+                monitor.add_csv(res_path, 'mca', 'gwp', param_runs)
+
+            for run in range(runs_done, loop_runs):
+                if adaptive_stopping and run % stop_batch == 0 and monitor.converged():
+                    break
+                runs_done = run + 1
                 loop_timer_start = timeit.default_timer()
                 print(f"\n\nStarting iteration {run+1} / {loop_runs} =======================================================")
                 """
@@ -594,29 +956,11 @@ def main():
                 type of provider substitution, e.g. that all substitutions of electricity flows across all processes source
                 PJM Interconnection grid electricity, and not multiple varying electricity providers.
                 """
-                print(f'\nPicking providers')
-                provider_dict = {}
+                provider_dict = provider_draws[run]
+                run_key = provider_key(provider_dict)
                 for sheet_name in provider_sheets:
-                    try:
-                        """
-                        Get the full path to the current provider sheet and run the pick provider function.
-                        If needed, provide a list of regions in the sample_provider function call to filter specific regions.
-                        """
-                        sheet_path = f'./providers/{sheet_name}.xlsx'
-                        provider_uuid, provider_name, provider_location = sample_provider(sheet_path)
-
-                        # If UUID is provided, get REF by UUID, else get REF by Name.
-                        if isinstance(provider_uuid, str):
-                            provider_ref = client.get_descriptor(olca.Process, provider_uuid)
-                        else:
-                            provider_ref = client.find(olca.Process, provider_name)
-
-                        provider_dict[sheet_name] = provider_ref  # Save to provider_dict
-                        print(f'\tFrom "{sheet_name}" picked "{provider_ref.name}" and loaded json.')
-                    except FileNotFoundError:
-                        print(f'\t!! No such file or directory: {sheet_path} !! MCA will terminate !!')
-                    except KeyError:
-                        print(f'!! Check errors in provider sheet {sheet_path} !! MCA will terminate !!')
+                    print(f'\t"{sheet_name}" :: "{provider_dict[sheet_name].name}"')
+                use_engine = engine is not None and engine.supports(provider_dict)
 
                 """Displaying provider dict for QA purposes. Not critical."""
                 # print(f'\nprovider_dict')
@@ -626,100 +970,146 @@ def main():
                 #           f'\tvalue.name:\t {provider_dict[key].name}')
 
                 """
-                Modify all target processes with the new providers.
+                Modify all target processes with the new providers. Skipped if the processes are already modified for
+                this provider combination, i.e. for a repeat of the previous iteration's combination. With
+                minimize_rewiring, only the substitutions whose provider changed since the last iteration are modified.
                 """
-
-                print(f'\nModifying all relevant processes.')
-                modify_processes(prov_sheet, provider_dict)
+                if use_engine:
+                    print(f'\nSolving with the local matrix engine.')
+                elif wired_dict is None or run_key != provider_key(wired_dict):
+                    print(f'\nModifying all relevant processes.')
+                    with tracer.span('rewire'):
+                        modify_processes(prov_sheet, provider_dict,
+                                         previous_dict=wired_dict if minimize_rewiring else None,
+                                         preloaded_provider_dict=provider_index)
+                    wired_dict = provider_dict
+                else:
+                    print(f'\nProcesses already modified for this provider combination.')
 
                 """
-                Create new temporary product system for the main process. This step takes into account all provider 
-                substitutions made in previous steps. A new product system has to be created anytime there is a change
-                to any Process because the OLCA Update function does not work for this. The product system is deleted
-                at the end of each loop so it does not clutter the database.
+                Product system for the main process. This step takes into account all provider substitutions made in
+                previous steps. The OLCA Update function does not pick up process modifications, so the product system
+                manager either rewrites the process links of the changed substitutions in its product system
+                (update_ps_in_place), or creates a new product system that is kept for the rest of the MCA, so that
+                repeated provider combinations can reuse it.
                 """
-                if calc_using_ps:
-                    print(f'Creating a product system.')
-                    model_ref = create_ps(main_process_json)
+                if calc_using_ps and not use_engine:
+                    with tracer.span('product system'):
+                        model_ref = ps_manager.acquire(run_key)
 
                 """
                 Product system parameter definitions setup.
                 Redefining the product system parameters, and then setting up the product system for this calculation.
                 """
-                for param_loop in range(param_runs):
-                    print(f"\nPicking parameters. Parameter redefinition loop {param_loop+1} / {param_runs} ----\n")
-
-                    param_picked = []
-                    parameter_redefs = []
-
-                    for q_index, q_row in param_sheet.iterrows():
-                        context_name = q_row['name']
-                        param_name = q_row['parameter']
-
-                        param_string = q_row['sample']  # Take the sample from substitution sheet
-                        value = pick_value(param_string, "sample")  # Pick parameter value based on sample information
-                        # Append picked value to list of redefinitions for results sheet
-                        param_picked.append(value)
-                        # Redefine parameters in OLCA model
-                        redef = olca.ParameterRedef(
-                            context=client.get_descriptor(olca.Process, q_row['uuid']),
-                            name=q_row['parameter'],
-                            value=value
-                        )
+                session = None
+                if simulation_setup is not None and not use_engine:
+                    param_picked, parameter_redefs = simulation_setup
+                    session = SimulatorSession(model_ref, lcia_methods, parameter_redefs)
+                elif param_design is None:
+                    # Draw the parameter values of all parameter loops in one block
+                    with tracer.span('parameter draw'):
+                        param_block = draw_parameters(param_table, param_runs)
+                else:
+                    with tracer.span('parameter draw'):
+                        param_block = quantile_parameters(param_table,
+                                                          param_design[run * param_runs:(run + 1) * param_runs])
 
-                        # print(f'{context_name} {param_name}\n'
-                        #       f'\t{param_string}\n'
-                        #       f'\tPicked value: {value}\n')
+                # provider_keys_list = list(provider_dict)
+                providers_picked = []
+                for sheet in provider_sheets:
+                    providers_picked.append(provider_dict[sheet].name)
 
-                        parameter_redefs.append(redef)
-                        print(f"\t{q_index}) {q_row['parameter']} :: {value}")
-                        # print(f"\t{q_index}) {q_row['parameter']}: {value} || {redef}")
+                for param_loop in range(param_runs):
+                    if session is None:
+                        print(f"\nPicking parameters. Parameter redefinition loop {param_loop+1} / {param_runs} ----\n")
+                        with tracer.span('parameter pick'):
+                            param_picked, parameter_redefs = pick_parameters(param_sheet, param_block[param_loop])
 
-                    """ RUN SIMULATION"""
+                    """
+                    RUN SIMULATION. openLCA calculations go through the calculation pipeline, which returns the rows of
+                    the calculations that finished meanwhile, while the newer ones keep running on the server. All are
+                    collected after the last parameter loop, before the processes are modified for the next iteration.
+                    """
 
                     counter += 1
                     impact_results = []
-                    impact_results = get_results(model_ref, lcia_methods, counter, parameter_redefs)
+                    if use_engine:
+                        with tracer.span('calculate'):
+                            impact_results = engine.get_results(provider_dict, parameter_redefs, counter)
+                    if use_engine and impact_results is None:
+                        """
+                        The local engine cannot evaluate a formula with these parameter values, e.g. a division by a
+                        drawn value of zero, so this and the remaining parameter loops of the run are calculated in
+                        openLCA.
+                        """
+                        print(f'\nLocal engine cannot evaluate this parameter set. Calculating the run in openLCA.')
+                        use_engine = False
+                        if wired_dict is None or run_key != provider_key(wired_dict):
+                            with tracer.span('rewire'):
+                                modify_processes(prov_sheet, provider_dict,
+                                                 previous_dict=wired_dict if minimize_rewiring else None,
+                                                 preloaded_provider_dict=provider_index)
+                            wired_dict = provider_dict
+                        if calc_using_ps:
+                            with tracer.span('product system'):
+                                model_ref = ps_manager.acquire(run_key)
+                    if use_engine:
+                        if counter in validation_runs:
+                            validation_samples.append((provider_dict, parameter_redefs, impact_results))
+                        finished = [providers_picked + param_picked + impact_results + ["mca"]]
+                    elif session is not None:
+                        with tracer.span('calculate'):
+                            impact_results = session.get_results(counter)
+                        finished = [providers_picked + param_picked + impact_results + ["mca"]]
+                    else:
+                        finished = pipeline.submit(model_ref, parameter_redefs, counter,
+                                                   providers_picked + param_picked, "mca")
+                    if param_loop == param_runs - 1:
+                        finished += pipeline.drain()
 
                     """
-                    Save results to csv. A new csv file is created on every first simulation and any additional runs in 
-                    that simulation are appended to that csv. This ensures that results are saved even if the full 
-                    simulation doesn't finish.
+                    Save results to csv. Rows are buffered by the results writer and appended to the csv in batches, and any
+                    buffered rows are written on exit. This ensures that results are saved even if the full simulation doesn't
+                    finish.
                     """
-                    # provider_keys_list = list(provider_dict)
-                    providers_picked = []
-                    for sheet in provider_sheets:
-                        providers_picked.append(provider_dict[sheet].name)
+                    for fields in finished:
+                        with tracer.span('write'):
+                            results.writerow(fields)
+                        # counter += 1
+                        # print(f'\nResult saved to csv. | Run {counter} gwp: {gwp:.2f} {gwp_unit} ({lcia_methods[0]})')
 
-                    fields = providers_picked + param_picked + impact_results + ["mca"]
-
-                    with open(res_path, 'a', newline='') as f:  # 'a' appends to an existing file
-                        writer = csv.writer(f)
-                        writer.writerow(fields)
-                    # counter += 1
-                    # print(f'\nResult saved to csv. | Run {counter} gwp: {gwp:.2f} {gwp_unit} ({lcia_methods[0]})')
-
-                    """
-                    Plot latest histogram. If you do not wish to view live histogram updates, then comment this out.
-                    """
-                    display_result(main_process_json.name,
-                                   declared_unit=ref_unit,
-                                   results_path=res_path,
-                                   max_value=max_value)
+                        """
+                        Add result to the live histogram. Set live_histogram = False to switch off plotting.
+                        """
+                        histogram.add([fields], gwp_column)
+                        monitor.add([fields], gwp_column)
 
-                """
-                Delete product system so that we can create a new one in the next loop without cluttering the database.
-                This is currently needed because the product system update functionality in openLCA does not work,
-                which means that even after modifying upstream processes running the simulation using the same
-                product system would have yielded identical results as before process modifications.
-                """
-                if calc_using_ps:
-                    client.delete(model_ref)  # Delete product system
+                if session is not None:
+                    session.dispose()
 
+                monitor.end_run()
+                checkpoint.save('mca', results, progress=run + 1)
+                print(f'\n{monitor.summary()}')
                 time_left = (timeit.default_timer() - loop_timer_start)*(loop_runs - run)
                 print('\nElapsed time: {}'.format(humanfriendly.format_timespan(timeit.default_timer() - timer_start)))
                 print('Time remaining: {}'.format(humanfriendly.format_timespan(time_left)))
 
+            """
+            Delete the product systems kept for provider combinations so they do not clutter the database. A created
+            product system is only valid for the provider combination it was created with, because the product system
+            update functionality in openLCA does not pick up process modifications.
+            """
+            ps_manager.release_all()
+
+            if len(validation_samples) > 0:
+                validate_local_engine(validation_samples, prov_sheet, main_process_json, lcia_methods, wired_dict)
+
+            checkpoint.save('mca', results, done=True)
+            if adaptive_stopping and runs_done < loop_runs:
+                print(f'\nMCA converged after {runs_done} / {loop_runs} iterations.')
+            results.flush()
+            report_convergence(res_path, sampling_strategy, convergence_target)
+
             # Show execution time for probability simulation.
             print(f'\nTotal MCA run time: {humanfriendly.format_timespan(timeit.default_timer() - mca_start)}')
 
@@ -733,6 +1123,10 @@ def main():
             print(uf_groups)
 
             for ufg in uf_groups:
+                group_phase = f'subgroup {ufg}'
+                if checkpoint.done(group_phase):
+                    print(f'\nMCA for "{ufg}" variation already finished, skipping it.')
+                    continue
                 print(f'\nRunning MCA for "{ufg}" variation')
 
                 # set all to base providers
@@ -742,23 +1136,47 @@ def main():
                 # list provider sheets and parameters in this group
                 group_p_df = prov_sheet[prov_sheet['uf_group'] == ufg]  # group provider dataframe
                 group_q_df = param_sheet[param_sheet['uf_group'] == ufg]  # group parameter dataframe
+                group_simulation = simulator_parameters(param_sheet, ufg) if olca_simulator else None
+                record_simulated(res_path, ufg, group_simulation, param_list)
 
-                for run in range(loop_runs):
+                """
+                Every group continues the random stream of the last save, also when an interrupted run resumes before
+                the first iteration of the group finished. The design seed is drawn once and saved with the stream.
+                """
+                checkpoint.restore_rng()
+                group_sheets = group_p_df['provider_sheet'].tolist()
+                provider_design, param_design = mca_designs(sampling_strategy, checkpoint.phase(group_phase),
+                                                            loop_runs, param_runs, group_sheets, param_sheet)
+                checkpoint.save(group_phase, results)
+
+                runs_done = checkpoint.progress(group_phase)
+                monitor = ConvergenceMonitor(convergence_tolerance, min_runs=min_loop_runs)
+                if runs_done > 0:
+                    print(f'\nResuming after {runs_done} finished iterations.')
+                    results.flush()
+                    monitor.add_csv(res_path, ufg, 'gwp', param_runs)
+
+                for run in range(runs_done, loop_runs):
+                    if adaptive_stopping and monitor.converged():
+                        print(f'\nMCA for "{ufg}" variation converged after {run} / {loop_runs} iterations.')
+                        break
                     loop_timer_start = timeit.default_timer()
                     print(f"\n\nStarting iteration {run + 1} / {loop_runs} ==============================================")
 
                     print(f'\nPicking providers')
-                    for index, row in group_p_df.iterrows():
+                    for position, (index, row) in enumerate(group_p_df.iterrows()):
                         try:
                             sheet_name = row['provider_sheet']
                             sheet_path = f'./providers/{sheet_name}.xlsx'
-                            provider_uuid, provider_name, provider_location = sample_provider(sheet_path)
+                            uniforms = None if provider_design is None else provider_design[run, position]
+                            provider_uuid, provider_name, provider_location = sample_provider(sheet_path,
+                                                                                              uniforms=uniforms)
 
                             # If UUID is provided, get REF by UUID, else get REF by Name.
                             if isinstance(provider_uuid, str):
-                                provider_ref = client.get_descriptor(olca.Process, provider_uuid)
+                                provider_ref = fetch_descriptor(olca.Process, provider_uuid)
                             else:
-                                provider_ref = client.find(olca.Process, provider_name)
+                                provider_ref = find_ref(olca.Process, provider_name, provider_location)
 
                             provider_dict[sheet_name] = provider_ref  # Save to provider_dict
                             print(f'\t"{sheet_name}" :: "{provider_ref.name}"')
@@ -768,71 +1186,222 @@ def main():
                             print(f'!! Check errors in provider sheet {sheet_path} !! MCA will terminate !!')
 
                     print(f'\nModifying all relevant processes.')
-                    modify_processes(prov_sheet, provider_dict)
+                    with tracer.span('rewire'):
+                        modify_processes(prov_sheet, provider_dict, preloaded_provider_dict=provider_index)
 
                     if calc_using_ps:
-                        print(f'Creating a product system.')
-                        model_ref = create_ps(main_process_json)
+                        with tracer.span('product system'):
+                            model_ref = ps_manager.acquire()
+
+                    # With olca_simulator, the group parameters are sampled by openLCA in one simulator session.
+                    session = None
+                    if group_simulation is not None:
+                        param_picked, parameter_redefs = group_simulation
+                        session = SimulatorSession(model_ref, lcia_methods, parameter_redefs)
+                    elif param_design is None:
+                        with tracer.span('parameter draw'):
+                            param_block = draw_parameters(param_table, param_runs)
+                    else:
+                        with tracer.span('parameter draw'):
+                            param_block = quantile_parameters(param_table,
+                                                              param_design[run * param_runs:(run + 1) * param_runs])
 
                     # redefine all parameters as necessary
                     for param_loop in range(param_runs):
-                        print(f"\nPicking parameters. Parameter redefinition loop {param_loop+1} / {param_runs} ----\n")
-
-                        print(f'\nSetting base parameter data')
-                        param_picked = []
-                        parameter_redefs = []
-
-                        # if in ufg group then sample randomly, else assign base parameter
-                        for q_index, q_row in param_sheet.iterrows():
-                            if q_row['uf_group'] == ufg:
-                                # Pick parameter value based on sample information
-                                q_value = pick_value(q_row['sample'], "sample")
-                                print(f"\t\t{q_index}) "
-                                      f"{q_row['name']}.{q_row['parameter']} :: {q_value} :: random :: {ufg}")
-                            else:
-                                # Pick base value
-                                q_value = pick_value(q_row['sample'], "base")
-                                print(f"\t\t{q_index}) "
-                                      f"{q_row['name']}.{q_row['parameter']} :: {q_value} :: base")
-
-                            # Append picked value to list of redefinitions for results sheet
-                            param_picked.append(q_value)
-
-                            # Redefine parameters in OLCA model
-                            redef = olca.ParameterRedef(
-                                context=client.get_descriptor(olca.Process, q_row['uuid']),
-                                name=q_row['parameter'],
-                                value=q_value
-                            )
-                            parameter_redefs.append(redef)
+                        if session is None:
+                            print(f"\nPicking parameters. "
+                                  f"Parameter redefinition loop {param_loop+1} / {param_runs} ----\n")
+
+                            print(f'\nSetting base parameter data')
+                            param_picked = []
+                            parameter_redefs = []
+
+                            # if in ufg group then sample randomly, else assign base parameter
+                            for position, (q_index, q_row) in enumerate(param_sheet.iterrows()):
+                                if q_row['uf_group'] == ufg:
+                                    # Take parameter value from the drawn block
+                                    q_value = float(param_block[param_loop, position])
+                                    print(f"\t\t{q_index}) "
+                                          f"{q_row['name']}.{q_row['parameter']} :: {q_value} :: random :: {ufg}")
+                                else:
+                                    # Pick base value
+                                    q_value = param_table['base'][position].item()
+                                    print(f"\t\t{q_index}) "
+                                          f"{q_row['name']}.{q_row['parameter']} :: {q_value} :: base")
+
+                                # Append picked value to list of redefinitions for results sheet
+                                param_picked.append(q_value)
+
+                                # Redefine parameters in OLCA model
+                                redef = olca.ParameterRedef(
+                                    context=fetch_descriptor(olca.Process, q_row['uuid']),
+                                    name=q_row['parameter'],
+                                    value=q_value
+                                )
+                                parameter_redefs.append(redef)
 
                         counter += 1
                         impact_results = []
-                        impact_results = get_results(model_ref, lcia_methods, counter, parameter_redefs)
 
                         # provider_keys_list = list(provider_dict)
                         providers_picked = []
                         for sheet in provider_sheets:
                             providers_picked.append(provider_dict[sheet].name)
 
-                        fields = providers_picked + param_picked + impact_results + [ufg]
+                        if session is not None:
+                            with tracer.span('calculate'):
+                                impact_results = session.get_results(counter)
+                            finished = [providers_picked + param_picked + impact_results + [ufg]]
+                        else:
+                            finished = pipeline.submit(model_ref, parameter_redefs, counter,
+                                                       providers_picked + param_picked, ufg)
+                        if param_loop == param_runs - 1:
+                            finished += pipeline.drain()  # before the next iteration modifies the processes
+
+                        for fields in finished:
+                            with tracer.span('write'):
+                                results.writerow(fields)
 
-                        # appends results to an existing csv file
-                        with open(res_path, 'a', newline='') as f:
-                            writer = csv.writer(f)
-                            writer.writerow(fields)
+                            histogram.add([fields], gwp_column)
+                            monitor.add([fields], gwp_column)
 
-                        display_result(main_process_json.name,
-                                       declared_unit=ref_unit,
-                                       results_path=res_path,
-                                       max_value=max_value)
+                    if session is not None:
+                        session.dispose()
 
                     if calc_using_ps:
-                        client.delete(model_ref)  # Delete product system
+                        ps_manager.release(model_ref)
+
+                    monitor.end_run()
+                    checkpoint.save(group_phase, results, progress=run + 1)
+                    print(f'\n{monitor.summary()}')
+
+                checkpoint.save(group_phase, results, done=True)
+
+        if sobol_analysis and checkpoint.done('sobol'):
+            print(f'\nSobol analysis already finished, skipping it.')
+        elif sobol_analysis:
+            print(f'\nStarting Sobol sensitivity analysis.\n=============================================================')
+            sobol_start = timeit.default_timer()
+
+            """
+            Variance-based sensitivity with one shared Saltelli design over the provider sheets and parameters, instead
+            of a separate MCA per uf_group. The design seed is kept in the checkpoint, so a resumed analysis runs the
+            same design. Runs are evaluated in batches of one provider combination, ordered so that consecutive batches
+            differ in as few provider sheets as possible; the product system is linked once per batch.
+            """
+            sobol_phase = checkpoint.phase('sobol')
+            if 'design_seed' not in sobol_phase:
+                sobol_phase['design_seed'] = int(np.random.randint(0, 2**31))
+                checkpoint.write()
+            design_seed, bootstrap_seed = np.random.SeedSequence(sobol_phase['design_seed']).spawn(2)
+
+            factors, factor_columns, factor_variables = sobol_factors(prov_sheet, provider_sheets, param_sheet,
+                                                                      sobol_factors_by)
+            design = saltelli_design(sobol_base_runs, len(provider_sheets) + len(param_sheet), factor_columns,
+                                     design_seed)
+            print(f'\t{len(factors)} factors: {factors}\n\t{len(design)} runs ({sobol_base_runs} base runs)')
+
+            with tracer.span('provider pick'):
+                provider_draws = [pick_providers(provider_sheets, uniforms=row[:len(provider_sheets)])
+                                  for row in design]
+            with tracer.span('parameter draw'):
+                param_block = quantile_parameters(param_table, design[:, len(provider_sheets):])
+            draw_positions = {id(provider_dict): position for position, provider_dict in enumerate(provider_draws)}
+            run_order = [draw_positions[id(provider_dict)] for provider_dict in order_provider_draws(provider_draws)]
+
+            batches = []  # lists of design rows that share a provider combination, in evaluation order
+            for position in run_order:
+                if batches and provider_key(provider_draws[position]) == provider_key(provider_draws[batches[-1][0]]):
+                    batches[-1].append(position)
+                else:
+                    batches.append([position])
+            print(f'\t{len(batches)} distinct provider combinations.')
+
+            runs_done = sobol_phase['progress']
+            if runs_done > 0:
+                print(f'\nResuming the Sobol analysis after {runs_done} / {len(design)} finished runs.')
+
+            wired_dict = None
+            evaluated = 0
+            for batch in batches:
+                evaluated += len(batch)
+                if evaluated <= runs_done:
+                    continue
+                provider_dict = provider_draws[batch[0]]
+                print(f'\n\nSobol runs {evaluated - len(batch) + 1}-{evaluated} / {len(design)} =====================')
+                for sheet_name in provider_sheets:
+                    print(f'\t"{sheet_name}" :: "{provider_dict[sheet_name].name}"')
+
+                print(f'\nModifying all relevant processes.')
+                with tracer.span('rewire'):
+                    modify_processes(prov_sheet, provider_dict,
+                                     previous_dict=wired_dict if minimize_rewiring else None,
+                                     preloaded_provider_dict=provider_index)
+                wired_dict = provider_dict
+
+                if calc_using_ps:
+                    with tracer.span('product system'):
+                        model_ref = ps_manager.acquire()
+
+                providers_picked = [provider_dict[sheet].name for sheet in provider_sheets]
+                for position in batch:
+                    print(f'\nPicking parameters for design row {position + 1}.\n')
+                    with tracer.span('parameter pick'):
+                        param_picked, parameter_redefs = pick_parameters(param_sheet, param_block[position])
+
+                    counter += 1
+                    finished = pipeline.submit(model_ref, parameter_redefs, counter, providers_picked + param_picked,
+                                               'sobol')
+                    if position == batch[-1]:
+                        finished += pipeline.drain()  # before the next batch modifies the processes
+
+                    for fields in finished:
+                        with tracer.span('write'):
+                            results.writerow(fields)
+                        histogram.add([fields], gwp_column)
+
+                if calc_using_ps:
+                    ps_manager.release(model_ref)
+
+                checkpoint.save('sobol', results, progress=evaluated)
+
+            checkpoint.save('sobol', results, done=True)
+
+            # The sobol rows of the csv are in evaluation order; put them back in design order.
+            results.flush()  # the last Sobol rows may still be buffered
+            res_df = pd.read_csv(res_path, usecols=['gwp', 'sim_type'])
+            sobol_gwp = res_df.loc[res_df['sim_type'] == 'sobol', 'gwp'].to_numpy()
+            if len(sobol_gwp) == len(design):
+                f = np.empty(len(design))
+                f[run_order] = sobol_gwp
+                indices = sobol_indices(f, sobol_base_runs, factors, factor_variables, seed=bootstrap_seed)
+                write_sobol_indices(indices, res_path)
+            else:
+                print(f'\n!! Expected {len(design)} Sobol runs in {res_path} but found {len(sobol_gwp)}. '
+                      f'No Sobol indices written.')
+
+            print(f'\nTotal Sobol run time: {humanfriendly.format_timespan(timeit.default_timer() - sobol_start)}')
+
+        results.close()  # write any buffered rows
+        histogram.close()  # save the final histogram
+        if group_stats_output:
+            write_group_stats(group_stats if group_stats is not None else stream_group_stats(res_path), res_path)
+        ps_manager.close()  # delete the product systems of this substitution sheet
+        checkpoint.finish()
+        active_checkpoint = None
+
+        print_cache_stats()
 
         # Show elapsed execution time.
         print('\nTotal run time: {}'.format(humanfriendly.format_timespan(timeit.default_timer() - timer_start)))
 
+    if trace_output is not None:
+        atexit.unregister(tracer.write)
+        tracer.write(trace_output)
+        print(f'\n{tracer.summary()}')
+        tracer.disable()
+        client = client.client
+
 
 """END OF MAIN"""
 
@@ -850,9 +1419,9 @@ def identify_providers(provider_df):
 
         # If UUID is provided, get REF by UUID, else get REF by Name.
         if isinstance(provider_uuid, str):
-            provider_ref = client.get_descriptor(olca.Process, provider_uuid)  # Get JSON for the selected provider
+            provider_ref = fetch_descriptor(olca.Process, provider_uuid)  # Get JSON for the selected provider
         else:
-            provider_ref = client.find(olca.Process, provider_name)  # Get REF of selected provider
+            provider_ref = find_ref(olca.Process, provider_name, provider_location)  # Get REF of selected provider
 
         provider_dict[sheet_name] = provider_ref  # Save to provider_dict
 
@@ -861,12 +1430,133 @@ def identify_providers(provider_df):
     return provider_dict
 
 
-def modify_processes(prov_sheet, provider_dict):
+def pick_providers(provider_sheets, regions=None, uniforms=None):
+    """
+    Randomly picks one provider from each provider sheet by market share.
+
+    :param provider_sheets: list of provider sheet names from the providers folder
+    :param regions: optional list of regions passed on to sample_provider
+    :param uniforms: optional row of a sampling design, one value in [0, 1) per provider sheet, see sample_design
+    :return: dictionary of provider sheet name -> OLCA reference of the picked provider
+    """
+    provider_dict = {}
+    for position, sheet_name in enumerate(provider_sheets):
+        sheet_path = f'./providers/{sheet_name}.xlsx'
+        try:
+            provider_uuid, provider_name, provider_location = sample_provider(
+                sheet_path, regions, uniforms=None if uniforms is None else uniforms[position])
+
+            # If UUID is provided, get REF by UUID, else get REF by Name.
+            if isinstance(provider_uuid, str):
+                provider_ref = fetch_descriptor(olca.Process, provider_uuid)
+            else:
+                provider_ref = find_ref(olca.Process, provider_name, provider_location)
+
+            provider_dict[sheet_name] = provider_ref  # Save to provider_dict
+        except FileNotFoundError:
+            print(f'\t!! No such file or directory: {sheet_path} !! MCA will terminate !!')
+        except KeyError:
+            print(f'!! Check errors in provider sheet {sheet_path} !! MCA will terminate !!')
+
+    return provider_dict
+
+
+def list_sheet_providers(provider_sheets):
+    """
+    Lists every provider that can be picked from each provider sheet, i.e. all rows with an amount that are not
+    marked as skip.
+
+    :param provider_sheets: list of provider sheet names from the providers folder
+    :return: dictionary of provider sheet name -> list of OLCA references
+    """
+    sheet_providers = {}
+    for sheet_name in provider_sheets:
+        sheet_path = f'./providers/{sheet_name}.xlsx'
+        prod_stats = fetch_provider_sheet(sheet_path)['table']
+
+        sheet_providers[sheet_name] = []
+        for index, row in prod_stats.drop_duplicates(subset=['process_uuid', 'name']).iterrows():
+            # If UUID is provided, get REF by UUID, else get REF by Name.
+            if isinstance(row['process_uuid'], str):
+                provider_ref = fetch_descriptor(olca.Process, row['process_uuid'])
+            else:
+                provider_ref = find_ref(olca.Process, row['name'], row['location'])
+            sheet_providers[sheet_name].append(provider_ref)
+
+    return sheet_providers
+
+
+def provider_key(provider_dict):
+    """
+    Creates a hashable key for a provider combination, i.e. the provider uuid picked for each provider sheet.
+
+    :param provider_dict: dictionary of provider sheet name -> OLCA reference
+    :return: tuple of (provider sheet, provider uuid) pairs sorted by provider sheet
+    """
+    return tuple((sheet_name, provider_dict[sheet_name].id) for sheet_name in sorted(provider_dict))
+
+
+def group_provider_draws(provider_draws):
+    """
+    Reorders provider draws so that repeated provider combinations follow each other. Combinations keep the order in
+    which they were first drawn.
+
+    :param provider_draws: list of provider dictionaries, one per MCA iteration
+    :return: reordered list of provider dictionaries
+    """
+    groups = {}
+    for provider_dict in provider_draws:
+        groups.setdefault(provider_key(provider_dict), []).append(provider_dict)
+
+    return [provider_dict for group in groups.values() for provider_dict in group]
+
+
+def order_provider_draws(provider_draws):
+    """
+    Reorders provider draws so that consecutive MCA iterations differ in as few provider sheets as possible. Repeated
+    combinations are kept together and the distinct combinations are chained greedily, each time continuing with the
+    remaining combination that differs from the current one in the fewest provider sheets.
+
+    :param provider_draws: list of provider dictionaries, one per MCA iteration
+    :return: reordered list of provider dictionaries
+    """
+    groups = {}
+    for provider_dict in provider_draws:
+        groups.setdefault(provider_key(provider_dict), []).append(provider_dict)
+
+    remaining = list(groups)
+    ordered = [remaining.pop(0)] if remaining else []
+    while remaining:
+        current = dict(ordered[-1])
+        changes = [sum(current.get(sheet_name) != uuid for sheet_name, uuid in key) for key in remaining]
+        ordered.append(remaining.pop(int(np.argmin(changes))))
+
+    return [provider_dict for key in ordered for provider_dict in groups[key]]
+
+
+def modify_processes(prov_sheet, provider_dict, previous_dict=None, preloaded_provider_dict=None):
+    """
+    Modifies all processes listed in the substitution sheet to use the providers in provider_dict.
+
+    :param prov_sheet: substitution sheet rows that list a provider sheet
+    :param provider_dict: dictionary of provider sheet name -> OLCA reference of the provider to link
+    :param previous_dict: optional provider dictionary the processes are currently modified for. Rows whose provider
+        is the same in both dictionaries are skipped, so only the changed substitutions are sent to OLCA.
+    :param preloaded_provider_dict: optional provider reference flow index from preload_ref_flows
+    :return: None. The processes are simply updated in OLCA.
+    """
     modify_start = timeit.default_timer()
 
     prov_sheet_rows = prov_sheet.shape[0]  # Total number of provider sheets to run through
+    skipped = 0
 
     for index, row in prov_sheet.iterrows():
+        if previous_dict is not None and row['provider_sheet'] in previous_dict \
+                and row['provider_sheet'] in provider_dict \
+                and previous_dict[row['provider_sheet']].id == provider_dict[row['provider_sheet']].id:
+            skipped += 1
+            continue
+
         print(f'\n{index + 1} / {prov_sheet_rows}')
         try:
             process_json = fetch_process_json(row['uuid'])
@@ -890,17 +1580,50 @@ def modify_processes(prov_sheet, provider_dict):
             modify_exchanges(
                 process=process_json,
                 find_flow=find_flows,
-                new_provider=provider_ref
+                new_provider=provider_ref,
+                preloaded_provider_dict=preloaded_provider_dict
             )
 
     modify_time = humanfriendly.format_timespan(timeit.default_timer() - modify_start)
+    if skipped > 0:
+        print(f'\n\t{skipped} / {prov_sheet_rows} substitutions skipped because their provider did not change.')
     print(f'\n\nModifications finished in {modify_time}.')
 
 
+def pick_parameters(param_sheet, values=None):
+    """
+    Picks a sample value for every parameter in the substitution sheet and creates the OLCA parameter redefinitions.
+
+    :param param_sheet: substitution sheet rows that list a parameter
+    :param values: optional row of values drawn with draw_parameters; if not given, one row is drawn here
+    :return: list of picked values for the results sheet, list of OLCA parameter redefinitions
+    """
+    if values is None:
+        values = draw_parameters(compile_parameters(param_sheet), 1)[0]
+
+    param_picked = []
+    parameter_redefs = []
+
+    for position, (q_index, q_row) in enumerate(param_sheet.iterrows()):
+        value = float(values[position])
+        # Append picked value to list of redefinitions for results sheet
+        param_picked.append(value)
+        # Redefine parameters in OLCA model
+        redef = olca.ParameterRedef(
+            context=fetch_descriptor(olca.Process, q_row['uuid']),
+            name=q_row['parameter'],
+            value=value
+        )
+        parameter_redefs.append(redef)
+        print(f"\t{q_index}) {q_row['parameter']} :: {value}")
+
+    return param_picked, parameter_redefs
+
+
 def pick_value(param_string, mark="base"):
     """
     Picks a sample value based on the specified distribution and parameters from a substitution sheet.
-    E.g., "triangular; min=0.01; mode=0.0771; max=0.08".
+    E.g., "triangular; min=0.01; mode=0.0771; max=0.08". The string is only parsed once, see compile_sample.
 
     :param param_string: string from substitution sheet column "sample"
     :param mark: value type from options of: "sample", "base", "high", "low"
@@ -910,115 +1633,464 @@ def pick_value(param_string, mark="base"):
         low: value that is at the lower end of impact
     :return: selected value
     """
-
-    pars = param_string.split(';')
-    # print(f'{pars}')
-
-    if pars[0] == "list":
-        pars_list = pars[1].split(",")
-
-        sample = float(np.random.choice(pars_list))
-        base = float(pars[2].split("=", 1)[1])
-        high = max(pars_list)
-        low = min(pars_list)
-
-    else:
-        for i in range(1, len(pars)):
-            try:
-                pars[i] = float(pars[i].split("=", 1)[1])
-            except AttributeError:
-                pass
-
-        if pars[0] == "uniform":
-            sample = np.random.uniform(pars[1], pars[2])  # min, max, size
-            base = pars[3]
-            high = pars[1]
-            low = pars[2]
-        if pars[0] == "triangular":
-            sample = np.random.triangular(pars[1], pars[2], pars[3])  # left, mode, right
-            base = pars[4]
-            high = pars[3]
-            low = pars[1]
-        if pars[0] == "normal":
-            sample = np.random.normal(pars[1], pars[2])  # mean, stdv, size
-            base = pars[3]
-            high = pars[1] + pars[2]
-            low = pars[1] - pars[2]
-        if pars[0] == "lognormal":
-            print(f"Warning! Lognormal sampling is not configured yet!")
-            sample = np.random.lognormal(pars[1], pars[2])  # mean, sigma, size
-            base = pars[3]
-            high = pars[1] + pars[2]
-            low = pars[1] - pars[2]
-
-    # print(pars)
+    sample = fetch_sample(param_string)
 
     if mark == "sample":
-        value = sample
-    elif mark == "base":
-        value = base
-    elif mark == "high":
-        value = high
-    elif mark == "low":
-        value = low
+        value = float(draw_sample(sample, 1)[0])
+    elif mark in ["base", "high", "low"]:
+        value = sample[mark]
     else:
         print("Invalid sample. Check substitution sheet column: sample.")
+        value = None
 
     return value
 
 
-def sample_provider(path, regions=None):
+def compile_sample(param_string):
     """
-    Loads market share spreadsheet, calculates probability from total amount produced by each provider,
-    and randomly selects a single provider using the underlying probability.
+    Parses a sample string from a substitution sheet into a typed distribution. Supported strings:
+        "uniform; min=..; max=..; base=.."
+        "triangular; min=..; mode=..; max=..; base=.."
+        "normal; mean=..; sd=..; base=.."
+        "lognormal; mu=..; sigma=..; base=.." (mean and sd of the underlying normal distribution, like
+            np.random.lognormal) or "lognormal; gmean=..; gsd=..; base=.." (geometric mean and sd, like openLCA)
+        "list; a, b, c; base=.."
+    Values can also be given by position without names. Without a base, the mode, median or midpoint is used.
 
-    :param path: Excel sheet path
-    :param regions: which countries to include?
-    :return: single provider based on probability
+    :param param_string: string from substitution sheet column "sample"
+    :return: dictionary with the distribution name, its parameters a, b, c, the list values, and base, low and high
     """
+    pars = [par.strip() for par in param_string.split(';')]
+    # spellings found in older substitution sheets
+    distribution = {'traingular': 'triangular', 'norm': 'normal'}.get(pars[0], pars[0])
+    named = {}
+    positional = []
+    values = None
+    try:
+        for par in pars[1:]:
+            if par == '':
+                continue
+            if '=' in par:
+                name, value = par.split('=', 1)
+                named[name.strip().lower()] = float(value)
+            elif distribution == 'list' and values is None:
+                values = np.array([float(v) for v in par.split(',')])
+            else:
+                positional.append(float(par))
+    except ValueError:
+        raise ValueError(f'Invalid sample "{param_string}". Check substitution sheet column: sample.')
+
+    def value_of(*names, position):
+        for name in names:
+            if name in named:
+                return named[name]
+        if position < len(positional):
+            return positional[position]
+        raise ValueError(f'Invalid sample "{param_string}": missing "{names[0]}". Check substitution sheet column: '
+                         f'sample.')
+
+    sample = {'distribution': distribution, 'a': np.nan, 'b': np.nan, 'c': np.nan, 'values': values}
+    if distribution == 'uniform':
+        sample['a'], sample['b'] = value_of('min', position=0), value_of('max', position=1)
+        base = (sample['a'] + sample['b']) / 2
+        high, low = sample['a'], sample['b']  # as before: high is the min and low the max of a uniform sample
+    elif distribution == 'triangular':
+        sample['a'] = value_of('min', position=0)
+        sample['b'] = value_of('mode', position=1)
+        sample['c'] = value_of('max', position=2)
+        base, high, low = sample['b'], sample['c'], sample['a']
+    elif distribution == 'normal':
+        sample['a'], sample['b'] = value_of('mean', position=0), value_of('sd', 'stdv', 'sigma', position=1)
+        base, high, low = sample['a'], sample['a'] + sample['b'], sample['a'] - sample['b']
+    elif distribution == 'lognormal':
+        if 'gmean' in named:
+            sample['a'], sample['b'] = np.log(named['gmean']), np.log(value_of('gsd', position=1))
+        else:
+            sample['a'], sample['b'] = value_of('mu', 'mean', position=0), value_of('sigma', 'sd', 'stdv', position=1)
+        # median and the one (geometric) standard deviation band
+        base, high, low = np.exp(sample['a']), np.exp(sample['a'] + sample['b']), np.exp(sample['a'] - sample['b'])
+    elif distribution == 'list':
+        base, high, low = float(np.median(values)), float(values.max()), float(values.min())
+    else:
+        raise ValueError(f'Unknown sample distribution "{pars[0]}". Check substitution sheet column: sample.')
 
-    """Load provider sheet and remove unnecessary rows."""
-    prod_stats = pd.read_excel(path).dropna(subset=["amount"])
-    prod_stats = prod_stats.replace(r'^\s+$', np.nan, regex=True)  # Replace empties and spaces with "nan"
-    prod_stats = prod_stats[~prod_stats['skip'].isin(['Yes'])]  # Skip any marked rows
-    prod_stats = prod_stats.reset_index()  # Reindex the dataframe for consistency in calling by index
+    sample['base'] = named.get('base', float(base))
+    sample['high'] = float(high)
+    sample['low'] = float(low)
 
-    """If specific regions are listed, filter out just those regions, else include everything."""
-    if regions is not None:
-        prod_stats = prod_stats[prod_stats['region'].isin(regions)]  # Select subset of regions
-        print(f'\t\t\tSelecting only from the following regions: {regions}')
+    return sample
 
-    """Recalculate probability based on the amount column for the remaining subset of data."""
-    total_prod = prod_stats['amount'].sum()
-    prod_stats["share"] = prod_stats["amount"] / total_prod
 
-    """Check that the recalculated sum equals 100% or notify the user of a possible error."""
-    if 0.96 < prod_stats['share'].sum() < 1.04:
-        pass
-    else:
-        print(f"\t\t,- Market share sum check failed. Please check market share data and code.\n"
-              f"\t\t|- sum({prod_stats['share'].tolist()}) = {prod_stats['share'].sum()}")
+def draw_sample(sample, size):
+    """
+    :param sample: compiled sample from compile_sample
+    :param size: number of values to draw
+    :return: array of drawn values
+    """
+    table = compile_samples([sample])
+    return draw_parameters(table, size)[:, 0]
 
-    """Prep data and make a random choice selection."""
-    names = prod_stats.index.values.tolist()
-    shares = prod_stats['share'].tolist()
-    selection = np.random.choice(names, p=shares)
 
-    """Save info for the randomly selected process."""
-    process_uuid = prod_stats['process_uuid'].iloc[selection]
-    process_name = prod_stats['name'].iloc[selection]
-    process_location = prod_stats['location'].iloc[selection]
+def compile_samples(samples):
+    """
+    Combines compiled samples into a distribution table: parameter arrays of all samples, and the columns of each
+    distribution type, so that draw_parameters can sample each distribution type in one call.
 
-    # print(f'{selection}')
-    # print(f"\t\t\t{process_uuid} | {process_name} - {process_location}")
+    :param samples: list of compiled samples from compile_sample
+    :return: dictionary of distribution table arrays
+    """
+    table = {key: np.array([sample[key] for sample in samples], dtype=float)
+             for key in ['a', 'b', 'c', 'base', 'high', 'low']}
+    table['values'] = [sample['values'] for sample in samples]
+    table['columns'] = {}
+    for column, sample in enumerate(samples):
+        table['columns'].setdefault(sample['distribution'], []).append(column)
+    table['columns'] = {distribution: np.array(columns) for distribution, columns in table['columns'].items()}
+    table['size'] = len(samples)
 
-    return process_uuid, process_name, process_location
+    return table
 
 
-def modify_exchanges_1(process, find_flow, sub_flow, sub_provider):
+def compile_parameters(param_sheet):
     """
-    Finds specific exchanges in a process and modifies their flow and default provider.
-    :param process: Process whose exchanges will be modified.
+    Compiles the sample column of a substitution sheet into a distribution table. Tables are cached per sheet content.
+
+    :param param_sheet: substitution sheet rows that list a parameter
+    :return: dictionary of distribution table arrays, see compile_samples
+    """
+    key = tuple(param_sheet['sample'])
+    if key not in cache_parameters:
+        cache_parameters[key] = compile_samples([fetch_sample(param_string) for param_string in key])
+
+    return cache_parameters[key]
+
+
+def draw_parameters(table, size):
+    """
+    Draws a block of parameter values with one vectorized call per distribution type.
+
+    :param table: distribution table from compile_parameters
+    :param size: number of rows (e.g. param_runs) to draw
+    :return: array of shape (size, number of parameters)
+    """
+    block = np.empty((size, table['size']))
+    for distribution, columns in table['columns'].items():
+        a, b, c = table['a'][columns], table['b'][columns], table['c'][columns]
+        shape = (size, len(columns))
+        if distribution == 'uniform':
+            block[:, columns] = np.random.uniform(a, b, shape)
+        elif distribution == 'triangular':
+            spread = a < c  # np.random.triangular does not accept min == max
+            block[:, columns] = a
+            if spread.any():
+                block[:, columns[spread]] = np.random.triangular(a[spread], b[spread], c[spread],
+                                                                 (size, spread.sum()))
+        elif distribution == 'normal':
+            block[:, columns] = np.random.normal(a, b, shape)
+        elif distribution == 'lognormal':
+            block[:, columns] = np.random.lognormal(a, b, shape)
+        elif distribution == 'list':
+            for column in columns:
+                block[:, column] = np.random.choice(table['values'][column], size)
+
+    return block
+
+
+def quantile_parameters(table, uniforms):
+    """
+    Transforms a block of values in [0, 1) into parameter values with the inverse cumulative distribution of each
+    parameter. Used instead of draw_parameters for stratified and quasi-random sampling designs.
+
+    :param table: distribution table from compile_parameters
+    :param uniforms: array of shape (rows, number of parameters), e.g. from sample_design
+    :return: array of parameter values with the same shape
+    """
+    uniforms = np.clip(uniforms, 1e-12, 1 - 1e-12)  # keep normal and lognormal quantiles finite
+    block = np.empty(uniforms.shape)
+    for distribution, columns in table['columns'].items():
+        a, b, c = table['a'][columns], table['b'][columns], table['c'][columns]
+        u = uniforms[:, columns]
+        if distribution == 'uniform':
+            block[:, columns] = a + u * (b - a)
+        elif distribution == 'triangular':
+            width = np.where(c > a, c - a, 1.0)  # min == max gives min
+            left = a + np.sqrt(u * width * (b - a))
+            right = c - np.sqrt((1 - u) * width * (c - b))
+            block[:, columns] = np.where(u < (b - a) / width, left, right)
+        elif distribution in ['normal', 'lognormal']:
+            z = np.vectorize(NormalDist().inv_cdf)(u)
+            block[:, columns] = a + b * z if distribution == 'normal' else np.exp(a + b * z)
+        elif distribution == 'list':
+            for position, column in enumerate(columns):
+                values = table['values'][column]
+                block[:, column] = values[(u[:, position] * len(values)).astype(int)]
+
+    return block
+
+
+def sample_design(strategy, size, dimensions, seed=None):
+    """
+    Creates a sampling design of values in [0, 1), one column per sampled variable.
+        random: independent pseudo-random values
+        lhs: latin hypercube, every column has exactly one value in each of the size strata, in random order
+        sobol: scrambled Sobol sequence (needs scipy, otherwise lhs is used)
+
+    :param strategy: 'random', 'lhs' or 'sobol'
+    :param size: number of rows
+    :param dimensions: number of columns
+    :param seed: seed of the design
+    :return: array of shape (size, dimensions)
+    """
+    rng = np.random.default_rng(seed)
+    if dimensions == 0:
+        return np.empty((size, 0))
+    if strategy == 'sobol' and qmc is None:
+        print(f'!! Sobol sampling needs scipy. Using latin hypercube sampling instead.')
+        strategy = 'lhs'
+
+    if strategy == 'sobol':
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # balance warning for sizes that are not a power of 2
+            return qmc.Sobol(dimensions, scramble=True, seed=int(rng.integers(2**31))).random(size)
+    if strategy == 'lhs':
+        strata = np.argsort(rng.random((size, dimensions)), axis=0)  # random permutation of the strata per column
+        return (strata + rng.random((size, dimensions))) / size
+    return rng.random((size, dimensions))
+
+
+def mca_designs(strategy, phase, loop_runs, param_runs, provider_sheets, param_sheet):
+    """
+    Creates the provider and parameter sampling designs of an MCA. The design seed is kept in the checkpoint phase, so
+    a resumed MCA gets the same designs.
+
+    :param strategy: sampling_strategy setting, 'random', 'lhs', 'sobol' or 'stratified'
+    :param phase: checkpoint phase state of the MCA
+    :param loop_runs: number of provider loop runs
+    :param param_runs: number of parameter loops per loop run
+    :param provider_sheets: list of provider sheets that are sampled
+    :param param_sheet: substitution sheet rows that list a parameter
+    :return: provider design (loop_runs rows) and parameter design (loop_runs * param_runs rows), None for random draws
+    """
+    if strategy == 'random':
+        return None, None
+    if strategy not in ['lhs', 'sobol', 'stratified']:
+        raise ValueError(f'Unknown sampling strategy "{strategy}".')
+
+    if 'design_seed' not in phase:
+        phase['design_seed'] = int(np.random.randint(0, 2**31))
+    seed = phase['design_seed']
+    provider_seed, param_seed = np.random.SeedSequence(seed).spawn(2)
+    # Stratifying the provider draws means each provider is picked in proportion to its market share.
+    provider_design = sample_design('lhs' if strategy == 'stratified' else strategy, loop_runs,
+                                    len(provider_sheets), provider_seed)
+    if strategy == 'stratified':
+        return provider_design, None
+    param_design = sample_design(strategy, loop_runs * param_runs, len(param_sheet), param_seed)
+
+    return provider_design, param_design
+
+
+def percentile_convergence(values, percentiles=(5, 50, 95), target=0.01):
+    """
+    Finds the number of runs after which the running percentiles stay within a relative error of the percentiles
+    of all runs.
+
+    :param values: results in run order
+    :param percentiles: percentiles to check
+    :param target: relative error
+    :return: number of runs
+    """
+    values = np.asarray(values, dtype=float)
+    final = np.percentile(values, percentiles)
+    converged = len(values)
+    for runs in range(len(values) - 1, 0, -1):
+        error = np.abs(np.percentile(values[:runs], percentiles) - final) / np.abs(final)
+        if np.any(error > target):
+            break
+        converged = runs
+
+    return converged
+
+
+def report_convergence(res_path, strategy, target):
+    """
+    Prints after how many MCA runs the gwp percentiles settled, to compare sampling strategies.
+
+    :param res_path: results csv
+    :param strategy: sampling strategy of the MCA
+    :param target: relative percentile error
+    """
+    res_df = pd.read_csv(res_path)
+    gwp = res_df.loc[res_df['sim_type'] == 'mca', 'gwp'].dropna()
+    if len(gwp) > 1:
+        runs = percentile_convergence(gwp.to_numpy(), target=target)
+        print(f'\nGWP p5/p50/p95 within {target:.1%} of their final value after {runs} / {len(gwp)} MCA runs '
+              f'({strategy} sampling).')
+
+
+def sample_uncertainty(param_string):
+    """
+    Translates a sample string from a substitution sheet into an OLCA uncertainty distribution, so that the parameter
+    can be sampled by the openLCA simulator. E.g., "triangular; min=0.01; mode=0.0771; max=0.08".
+
+    :param param_string: string from substitution sheet column "sample"
+    :return: OLCA uncertainty, or None if openLCA has no matching distribution (e.g. "list")
+    """
+    sample = fetch_sample(param_string)
+    distribution = sample['distribution']
+
+    if distribution == "uniform":
+        return olca.Uncertainty(distribution_type=olca.UncertaintyType.UNIFORM_DISTRIBUTION,
+                                minimum=sample['a'], maximum=sample['b'])
+    if distribution == "triangular":
+        return olca.Uncertainty(distribution_type=olca.UncertaintyType.TRIANGLE_DISTRIBUTION,
+                                minimum=sample['a'], mode=sample['b'], maximum=sample['c'])
+    if distribution == "normal":
+        return olca.Uncertainty(distribution_type=olca.UncertaintyType.NORMAL_DISTRIBUTION,
+                                mean=sample['a'], sd=sample['b'])
+    if distribution == "lognormal":
+        return olca.Uncertainty(distribution_type=olca.UncertaintyType.LOG_NORMAL_DISTRIBUTION,
+                                geom_mean=float(np.exp(sample['a'])), geom_sd=float(np.exp(sample['b'])))
+    return None
+
+
+def simulator_parameters(param_sheet, ufg=None):
+    """
+    Creates OLCA parameter redefinitions with uncertainty distributions for the openLCA simulator. The simulator samples
+    the values itself and the IPC protocol has no call to read them back, so the columns of sampled parameters are
+    left empty in the results and the parameters are listed next to the results csv, see record_simulated.
+
+    :param param_sheet: substitution sheet rows that list a parameter
+    :param ufg: optional uf_group; parameters of other groups are set to their base value
+    :return: list of values for the results sheet, list of OLCA parameter redefinitions; None if a parameter has no
+        matching openLCA distribution
+    """
+    param_picked = []
+    parameter_redefs = []
+    simulated = []
+
+    for q_index, q_row in param_sheet.iterrows():
+        redef = olca.ParameterRedef(
+            context=fetch_descriptor(olca.Process, q_row['uuid']),
+            name=q_row['parameter'],
+            value=pick_value(q_row['sample'], "base")
+        )
+        if ufg is None or q_row['uf_group'] == ufg:
+            redef.uncertainty = sample_uncertainty(q_row['sample'])
+            if redef.uncertainty is None:
+                print(f"\t{q_index}) {q_row['parameter']} :: {q_row['sample']} cannot be sampled by openLCA")
+                return None
+            param_picked.append(np.nan)
+            simulated.append(q_row['parameter'])
+        else:
+            param_picked.append(redef.value)
+        parameter_redefs.append(redef)
+
+    if simulated:
+        print(f'\tSampled by the openLCA simulator, left empty in the results: {", ".join(simulated)}')
+    return param_picked, parameter_redefs
+
+
+def record_simulated(res_path, sim_type, simulation_setup, param_list):
+    """
+    Lists the parameters sampled by the openLCA simulator, whose columns are empty in the results, in a json file next
+    to the results csv, e.g. {"mca": ["process.parameter"]}. The parameter columns stay numeric this way.
+
+    :param res_path: path of the results csv
+    :param sim_type: sim_type of the simulated runs, i.e. 'mca' or a uf_group
+    :param simulation_setup: list of values for the results sheet, list of OLCA parameter redefinitions from
+        simulator_parameters, or None if the parameters are not simulated
+    :param param_list: parameter columns of the results csv, in the order of the parameter redefinitions
+    :return: None
+    """
+    if simulation_setup is None:
+        return
+    path = f'{os.path.splitext(res_path)[0]} simulated.json'
+    simulated = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            simulated = json.load(f)
+    simulated[sim_type] = [column for column, redef in zip(param_list, simulation_setup[1])
+                           if redef.uncertainty is not None]
+    with open(path, 'w') as f:
+        json.dump(simulated, f, indent=1)
+
+
+def sample_provider(path, regions=None, size=None, uniforms=None):
+    """
+    Randomly selects a provider from a market share spreadsheet using the probability calculated from the total amount
+    produced by each provider. The spreadsheet is compiled once (see fetch_provider_sheet), so each draw is a lookup in
+    the precomputed cumulative shares. Draws match np.random.choice with the same probabilities.
+
+    :param path: Excel sheet path
+    :param regions: which countries to include?
+    :param size: optional number of providers to draw at once
+    :param uniforms: optional value (or array of values) in [0, 1) from a sampling design, used instead of a random draw
+    :return: single provider based on probability, or arrays of providers if size is given
+    """
+    compiled = fetch_provider_sheet(path)
+
+    """If specific regions are listed, filter out just those regions, else include everything."""
+    if regions is not None:
+        print(f'\t\t\tSelecting only from the following regions: {regions}')
+    rows, cdf = provider_shares(compiled, regions)
+
+    """Make a random choice selection."""
+    if uniforms is None:
+        uniforms = np.random.random_sample(size)
+    selection = rows[cdf.searchsorted(uniforms, side='right')]
+
+    """Save info for the randomly selected process."""
+    process_uuid = compiled['process_uuid'][selection]
+    process_name = compiled['name'][selection]
+    process_location = compiled['location'][selection]
+
+    # print(f'{selection}')
+    # print(f"\t\t\t{process_uuid} | {process_name} - {process_location}")
+
+    return process_uuid, process_name, process_location
+
+
+def provider_shares(compiled, regions=None):
+    """
+    Calculates the cumulative market shares of a compiled provider sheet, optionally for a subset of regions. Results
+    are stored in the compiled sheet, so they are only calculated once per region selection.
+
+    :param compiled: compiled provider sheet from fetch_provider_sheet
+    :param regions: which countries to include?
+    :return: array of selectable table rows, array of cumulative shares
+    """
+    key = None if regions is None else tuple(regions)
+    if key not in compiled['shares']:
+        table = compiled['table']
+        if regions is None:
+            rows = np.arange(len(table))
+        else:
+            rows = np.flatnonzero(table['region'].isin(regions).to_numpy())
+
+        """Recalculate probability based on the amount column for the remaining subset of data."""
+        amounts = table['amount'].to_numpy(dtype=float)[rows]
+        shares = amounts / amounts.sum()
+
+        """Check that the recalculated sum equals 100% or notify the user of a possible error."""
+        if 0.96 < shares.sum() < 1.04:
+            pass
+        else:
+            print(f"\t\t,- Market share sum check failed. Please check market share data and code.\n"
+                  f"\t\t|- sum({shares.tolist()}) = {shares.sum()}")
+            raise ValueError(f"Market shares in {compiled['path']} do not sum to 1.")
+
+        cdf = shares.cumsum()
+        cdf /= cdf[-1]
+        compiled['shares'][key] = (rows, cdf)
+
+    return compiled['shares'][key]
+
+
+def modify_exchanges_1(process, find_flow, sub_flow, sub_provider):
+    """
+    Finds specific exchanges in a process and modifies their flow and default provider.
+    :param process: Process whose exchanges will be modified.
     :param find_flow: List of flow names that could represent the exchange that needs modifying.
     :param sub_flow: The flow to be substituted into the process.
     :param sub_provider: The default provider to be substituted into the process.
@@ -1027,48 +2099,44 @@ def modify_exchanges_1(process, find_flow, sub_flow, sub_provider):
     exchange_list = []
     for i in process.exchanges:
         if i.is_input and i.flow.name in find_flow:
-            i.flow = client.find(olca.Flow, sub_flow)
+            i.flow = fetch_flow(sub_flow)
             i.default_provider = sub_provider
         exchange_list.append(i)
 
     process.exchanges = exchange_list
     process.olca_type = 'Process'
 
-    client.put(process)
+    put_process(process)
 
 
-def modify_exchanges(process, find_flow, new_provider, preloaded_provider_dict="None"):
+def modify_exchanges(process, find_flow, new_provider, preloaded_provider_dict=None):
     """
     Finds natural gas exchanges in a process and modifies their flow and default provider as well as converts
     units if needed.
     :param process: Process whose exchanges will be modified. Expects OLCA JSON or REF.
     :param find_flow: List of flow names that could represent the exchange that needs modifying.
     :param new_provider: The default provider to be substituted into the process. Expects OLCA JSON or REF.
-    :param preloaded_provider_dict: Dictionary with all provider OLCA references, including reference flows. Optional,
-    but speeds things up when provided because reference flows do not need to be searched in OLCA.
+    :param preloaded_provider_dict: Dictionary of provider uuid -> provider reference and reference flow, see
+    fetch_ref_flows. Optional, but speeds things up when provided because the provider does not need to be fetched
+    from OLCA. Providers that are not in the dictionary are fetched (and cached) by fetch_ref_flows.
     :return: None. The process is simply updated in OLCA.
     """
-    proc2_mod_json = fetch_process_json(process.id)
+    # Modify a copy, the cached process is only replaced once the update in OLCA succeeded (see put_process).
+    proc2_mod_json = olca.Process.from_dict(fetch_process_json(process.id).to_dict())
     print(f'\tModifying "{proc2_mod_json.name}"')
 
-    proc2_link_json = client.get(olca.Process, new_provider.id)
-    proc2_link_ref = client.get_descriptor(olca.Process, new_provider.id)
-    print(f'\t\tLinking "{proc2_link_json.name}"')
-
-    if preloaded_provider_dict == "None":
-        for i in proc2_link_json.exchanges:
-            if i.is_quantitative_reference:
-                flow2_link_name = i.flow.name
-                flow2_link_uuid = i.flow.id
-                flow2_link_type = i.flow_property.name
-                flow2_link_unit = i.unit.name
-                flow2_link_ref = fetch_flow(flow2_link_name)
+    if preloaded_provider_dict is not None and new_provider.id in preloaded_provider_dict:
+        provider_info = preloaded_provider_dict[new_provider.id]
     else:
-        flow2_link_name = preloaded_provider_dict[proc2_link_json.name]['FlowName']
-        flow2_link_uuid = preloaded_provider_dict[proc2_link_json.name]["FlowUuid"]
-        flow2_link_type = preloaded_provider_dict[proc2_link_json.name]["FlowType"]
-        flow2_link_unit = preloaded_provider_dict[proc2_link_json.name]["FlowUnit"]
-        flow2_link_ref = preloaded_provider_dict[proc2_link_json.name]["FlowRef"]
+        provider_info = fetch_ref_flows(new_provider.id)
+    proc2_link_ref = provider_info['ProviderRef']
+    print(f'\t\tLinking "{provider_info["ProviderName"]}"')
+
+    flow2_link_name = provider_info['FlowName']
+    flow2_link_uuid = provider_info['FlowUuid']
+    flow2_link_type = provider_info['FlowType']
+    flow2_link_unit = provider_info['FlowUnit']
+    flow2_link_ref = provider_info['FlowRef']
 
     exchange_list = []
     modifications = 0
@@ -1101,7 +2169,7 @@ def modify_exchanges(process, find_flow, new_provider, preloaded_provider_dict="
             elif flow2_mod_unit == flow2_link_unit:
                 pass
             elif 'natural gas' in i.flow.name and i.unit.name == 'm3' and flow2_link_type == 'Energy':
-                i.unit = client.find(olca.Unit, 'MJ')
+                i.unit = find_ref(olca.Unit, 'MJ')
                 i.amount = i.amount * 38  # 38 MJ/m3
                 try:
                     i.uncertainty.geom_mean = i.uncertainty.geom_mean * 38
@@ -1114,7 +2182,7 @@ def modify_exchanges(process, find_flow, new_provider, preloaded_provider_dict="
                     print(f"\t\t\t\tUncertainty conversion failed. It seems there is no uncertainty data in the "
                           f"OpenLCA model.")
             elif 'natural gas' in i.flow.name and i.unit.name == 'MJ' and flow2_link_type == 'Volume':
-                i.unit = client.find(olca.Unit, 'm3')
+                i.unit = find_ref(olca.Unit, 'm3')
                 i.amount = i.amount / 38  # 38 MJ/m3
                 try:
                     i.uncertainty.geom_mean = i.uncertainty.geom_mean / 38
@@ -1139,7 +2207,7 @@ def modify_exchanges(process, find_flow, new_provider, preloaded_provider_dict="
     proc2_mod_json.exchanges = exchange_list
     proc2_mod_json.olca_type = 'Process'
 
-    client.put(proc2_mod_json)
+    put_process(proc2_mod_json)
 
     if modifications == 0:
         print(f"\t\t!! {find_flow}\n\t\t !! Not modified. Check your process names and uuids in the substitution"
@@ -1178,7 +2246,7 @@ def create_ps(process_ref):
     )
 
     # Create product system
-    new_ps_ref = client.create_product_system(process_ref, config)
+    new_ps_ref = new_product_system(process_ref, config)
 
     # Next, we need to fetch the whole JSON object and modify its attributes.
     new_ps = client.get(olca.ProductSystem, new_ps_ref.id)
@@ -1200,66 +2268,632 @@ def create_ps(process_ref):
     return new_ps
 
 
-def display_result(study_object, declared_unit, results_path, max_value):
+def new_product_system(process_ref, config):
+    """
+    Creates a product system in openLCA and records it in the checkpoint journal right away, so that it is deleted by
+    the next run if this one stops before delete_ps.
+    :param process_ref: reference process of the product system
+    :param config: olca.LinkingConfig
+    :return: reference of the new product system
+    """
+    new_ps_ref = client.create_product_system(process_ref, config)
+    if active_checkpoint is not None:
+        active_checkpoint.track(new_ps_ref)
+
+    return new_ps_ref
+
+
+class ProductSystemManager:
+    """
+    Hands out the product systems of the main process for the simulation loops. With in_place, one product system is
+    kept per substitution sheet instead of creating and deleting one per provider combination. Its graph is built once
+    with create_product_system. After modify_processes has rewired the substituted processes, only the process links of
+    the exchanges whose default provider changed are rewritten, and the product system is put back in one update. The
+    supply chain of a provider that is linked for the first time is fetched once, from a temporary product system of
+    that provider. Processes that are no longer reachable from the main process are left out of the product system.
+
+    Without in_place, every product system is created with create_ps, and can be kept for a provider combination
+    until it is released.
+    """
+
+    def __init__(self, process_ref, prov_sheet, in_place=True):
+        """
+        :param process_ref: main process from which the product system is created
+        :param prov_sheet: substitution sheet rows that list a provider sheet
+        :param in_place: keep one product system and rewrite its process links
+        """
+        self.process_ref = process_ref
+        self.in_place = in_place
+        self.substituted = set(prov_sheet['uuid'])  # processes whose links follow their default providers
+        self.sheet_processes = prov_sheet.groupby('provider_sheet')['uuid'].agg(set).to_dict()  # sheet -> processes
+        self.product_system = None  # product system that is updated in place
+        self.refs = {}  # process uuid -> reference, of all processes seen so far
+        self.links = {}  # process uuid -> {exchange internal id -> process link}
+        self.known = set()  # processes whose links are known
+        self.written = None  # processes and links of the last update, see system_state
+        self.store = {}  # provider combination key -> product system, without in_place
+
+    @staticmethod
+    def linking_config():
+        # Same linking as create_ps
+        return olca.LinkingConfig(prefer_unit_processes=True, provider_linking=olca.ProviderLinking.PREFER_DEFAULTS)
+
+    def acquire(self, key=None):
+        """
+        :param key: optional provider combination key (provider_key). Without in_place, the product system is kept
+            for the key until it is released, so a repeated combination reuses it. With in_place, the relinked product
+            system is checked against the key, see relink.
+        :return: product system linked to the current default providers of the substituted processes
+        """
+        if not self.in_place:
+            if key in self.store:
+                print(f'Reusing the product system of a repeated provider combination.')
+                return self.store[key]
+            print(f'Creating a product system.')
+            product_system = create_ps(self.process_ref)
+            if key is not None:
+                self.store[key] = product_system
+            return product_system
+
+        if self.product_system is None:
+            print(f'Building the product system graph of {self.process_ref.name[:50]}.')
+            new_ps_ref = new_product_system(self.process_ref, self.linking_config())
+            self.product_system = client.get(olca.ProductSystem, new_ps_ref.id)
+            self.product_system.description = (
+                f"This is a product system created using olca ipc and the BT MCA script. Its process links are "
+                f"updated in place for each provider combination."
+            )
+            self.merge(self.product_system)
+            self.written = self.system_state([process_ref.id for process_ref in self.product_system.processes or []])
+
+        self.relink(key)
+        return self.product_system
+
+    def release(self, product_system):
+        """
+        Releases a product system from acquire. Without in_place, it is deleted unless it is kept for a key.
+        """
+        if self.in_place or product_system is None or any(product_system is kept for kept in self.store.values()):
+            return
+        with tracer.span('product system cleanup'):
+            delete_ps(product_system)
+
+    def release_all(self):
+        """
+        Deletes the product systems kept for provider combinations.
+        """
+        for product_system in self.store.values():
+            with tracer.span('product system cleanup'):
+                delete_ps(product_system)
+        self.store.clear()
+
+    def close(self):
+        """
+        Deletes all product systems of the manager.
+        """
+        self.release_all()
+        if self.product_system is not None:
+            with tracer.span('product system cleanup'):
+                delete_ps(self.product_system)
+            self.product_system = None
+
+    def merge(self, product_system):
+        """
+        Adds the processes and links of a product system graph. Links that are already known are kept.
+        """
+        for process_ref in product_system.processes or []:
+            self.refs.setdefault(process_ref.id, process_ref)
+            self.known.add(process_ref.id)
+        for link in product_system.process_links or []:
+            self.links.setdefault(link.process.id, {}).setdefault(link.exchange.internal_id, link)
+
+    def expand(self, process_ref):
+        """
+        Fetches the supply chain of a process from a temporary product system.
+        """
+        print(f'\tAdding the supply chain of "{process_ref.name}" to the product system graph.')
+        new_ps_ref = new_product_system(process_ref, self.linking_config())
+        graph = client.get(olca.ProductSystem, new_ps_ref.id)
+        with tracer.span('product system cleanup'):
+            delete_ps(new_ps_ref)
+        self.merge(graph)
+        self.known.add(process_ref.id)
+
+    def system_state(self, processes):
+        """
+        :param processes: uuids of the processes of the product system
+        :return: the processes and the links of their exchanges, to compare the product system with the last update
+        """
+        return frozenset(processes), frozenset((process_uuid, internal_id, link.provider.id, link.flow.id)
+                                               for process_uuid in processes
+                                               for internal_id, link in self.links.get(process_uuid, {}).items())
+
+    def relink(self, key=None):
+        """
+        Links the exchanges of the substituted processes to their current default providers, walking the graph from
+        the main process, and updates the product system if any process or link changed.
+        :param key: optional provider combination key the processes were modified for. A RuntimeError is raised if
+            the reachable substituted processes of a provider sheet do not link to the provider of the key.
+        """
+        root = self.process_ref.id
+        self.refs.setdefault(root, self.process_ref)
+        reachable = {}  # process uuid -> None, in the order they are reached
+        todo = [root]
+        while todo:
+            process_uuid = todo.pop()
+            if process_uuid in reachable:
+                continue
+            reachable[process_uuid] = None
+            if process_uuid not in self.known:
+                self.expand(self.refs[process_uuid])
+            process_links = self.links.setdefault(process_uuid, {})
+            if process_uuid in self.substituted:
+                process_ref = fetch_descriptor(olca.Process, process_uuid)
+                for exchange in fetch_process_json(process_uuid).exchanges:
+                    if not exchange.is_input or exchange.default_provider is None:
+                        continue
+                    link = process_links.get(exchange.internal_id)
+                    if link is None or link.provider.id != exchange.default_provider.id \
+                            or link.flow.id != exchange.flow.id:
+                        process_links[exchange.internal_id] = olca.ProcessLink(
+                            provider=exchange.default_provider,
+                            flow=exchange.flow,
+                            process=process_ref,
+                            exchange=olca.ExchangeRef(internal_id=exchange.internal_id)
+                        )
+            for link in process_links.values():
+                self.refs.setdefault(link.provider.id, link.provider)
+                todo.append(link.provider.id)
+
+        if key is not None:
+            for sheet_name, provider_uuid in key:
+                processes = [process_uuid for process_uuid in self.sheet_processes.get(sheet_name, ())
+                             if process_uuid in reachable]
+                if processes and not any(link.provider.id == provider_uuid
+                                         for process_uuid in processes for link in self.links[process_uuid].values()):
+                    raise RuntimeError(f'The product system is not linked to the provider {provider_uuid} of '
+                                       f'"{sheet_name}". Modify the processes for a provider combination before '
+                                       f'acquiring its product system.')
+
+        written = self.system_state(reachable)
+        if written == self.written:
+            return
+        print(f'Updating {len(written[1] - self.written[1])} process links of the product system.')
+        update_start = timeit.default_timer()
+        self.product_system.processes = [self.refs[process_uuid] for process_uuid in reachable]
+        self.product_system.process_links = [link for process_uuid in reachable
+                                             for link in self.links[process_uuid].values()]
+        self.product_system.last_change = datetime.now(pytz.utc).isoformat()
+        client.put(self.product_system)
+        self.written = written
+        print(f'Update finished in {humanfriendly.format_timespan(timeit.default_timer() - update_start)}.')
+
+
+class ResultsWriter:
+    """
+    Results sink that stays open for a whole run. Rows are buffered and written to the results csv in batches, when
+    batch_size rows are waiting or interval seconds have passed, and on exit. Optionally the same rows are also written
+    to a parquet or arrow file with typed columns, so large results can be analysed without parsing csv strings.
+    """
+
+    def __init__(self, path, header, text_columns=(), batch_size=50, interval=30.0, columnar=None, offset=None,
+                 stats=None):
+        """
+        :param path: path to the results csv
+        :param header: list of column names
+        :param text_columns: columns stored as strings in the columnar file; all other columns are stored as floats
+        :param batch_size: number of buffered rows that triggers a write
+        :param interval: maximum number of seconds rows are kept in the buffer
+        :param columnar: None, 'parquet' or 'arrow'
+        :param offset: resume an existing results csv; anything written after this byte offset is discarded
+        :param stats: optional GroupStats that every written row is added to
+        """
+        self.path = path
+        self.header = header
+        self.stats = stats
+        self.batch_size = batch_size
+        self.interval = interval
+        self.buffer = []
+        self.rows = 0  # rows handed to the writer since it was opened
+        self.marks = []  # (rows, callback), see mark
+        self.last_flush = time.monotonic()
+        if offset is None:
+            self.file = open(path, "w", newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(header)
+            self.file.flush()
+        else:
+            self.file = open(path, "r+", newline='')
+            self.file.truncate(offset)  # drop rows of unfinished iterations, they are calculated again
+            self.file.seek(offset)
+            self.writer = csv.writer(self.file)
+        self.flushed_offset = self.file.tell()  # byte offset of the csv after the last flush
+
+        self.columnar = None
+        self.text_columns = [column for column in header if column in text_columns]
+        if columnar is not None:
+            if pa is None:
+                raise ImportError(f"pyarrow is needed for {columnar} results output.")
+            self.schema = pa.schema([(column, pa.string() if column in self.text_columns else pa.float64())
+                                     for column in header])
+            columnar_path = f'{os.path.splitext(path)[0]}.{columnar}'
+            if columnar == 'parquet':
+                self.columnar = pq.ParquetWriter(columnar_path, self.schema)
+            elif columnar == 'arrow':
+                self.columnar = pa.ipc.new_file(columnar_path, self.schema)
+            else:
+                raise ValueError(f"Unknown columnar results format '{columnar}', use 'parquet' or 'arrow'.")
+            if offset is not None:
+                # the columnar file cannot be appended to, so it is rewritten with the rows already in the csv
+                previous = pd.read_csv(path, dtype=str, keep_default_na=False)
+                if len(previous) > 0:
+                    self._write_columnar(previous.values.tolist())
+
+        atexit.register(self.close)  # buffered rows are still written if the run stops early
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        rows = [list(row) for row in rows]
+        self.buffer.extend(rows)
+        self.rows += len(rows)
+        if self.stats is not None:
+            self.stats.add_rows(rows, self.header)
+        if len(self.buffer) >= self.batch_size or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def mark(self, callback):
+        """
+        Calls callback(offset, last) once all rows handed to the writer so far are written to the results csv, with
+        the byte offset of the csv after these rows. Rows are not flushed for this, the callback runs at the next
+        flush, or right away if no rows are buffered. last is False if a later mark is reached in the same flush.
+
+        :param callback: function of the csv offset and last
+        """
+        if not self.buffer:
+            callback(self.flushed_offset, True)
+        else:
+            self.marks.append((self.rows, callback))
+
+    def flush(self):
+        """
+        Writes all buffered rows to disk and calls the callbacks of the marks they reach, see mark.
+        """
+        self.last_flush = time.monotonic()
+        if not self.buffer or self.file is None:
+            return
+        first_row = self.rows - len(self.buffer)
+        written = 0
+        reached = []
+        for rows, callback in self.marks:
+            self.writer.writerows(self.buffer[written:rows - first_row])
+            written = rows - first_row
+            reached.append((self.file.tell(), callback))
+        self.writer.writerows(self.buffer[written:])
+        self.file.flush()
+        if self.columnar is not None:
+            self._write_columnar(self.buffer)
+        self.buffer = []
+        self.marks = []
+        self.flushed_offset = self.file.tell()
+        for position, (offset, callback) in enumerate(reached):
+            callback(offset, position == len(reached) - 1)
+
+    def _write_columnar(self, rows):
+        table = pd.DataFrame(rows, columns=self.header)
+        for column in self.header:
+            if column in self.text_columns:
+                table[column] = table[column].astype(str)
+            else:
+                table[column] = pd.to_numeric(table[column], errors='coerce')
+        self.columnar.write_table(pa.Table.from_pandas(table, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        """
+        Writes remaining rows and closes the results files. Can safely be called more than once.
+        """
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+        if self.columnar is not None:
+            self.columnar.close()
+        atexit.unregister(self.close)
+
+
+class LiveHistogram:
+    """
+    Streaming GWP histogram for live result display. Only new gwp values are passed in; they are added to fixed bins
+    and the plot is saved on a throttled schedule by a background thread, so the calculation loop never waits for
+    matplotlib and the results csv is never re-read.
+    """
+
+    def __init__(self, study_object, declared_unit, results_path, max_value, bins=50, interval=5.0, enabled=True):
+        """
+        :param study_object: name of the studied process, used in the plot title
+        :param declared_unit: declared unit of the studied process
+        :param results_path: path to the results csv; the plot is saved next to it as png
+        :param max_value: expected highest gwp value for the plot axis
+        :param bins: number of fixed histogram bins between 0 and max_value
+        :param interval: minimum number of seconds between two saved plots
+        :param enabled: False disables all rendering, e.g. for headless batch runs
+        """
+        self.title = f'{study_object} impacts per {declared_unit}'
+        self.declared_unit = declared_unit
+        self.png_path = f'{os.path.splitext(results_path)[0]}.png'
+        self.edges = np.linspace(0, max_value, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.interval = interval
+        self.enabled = enabled
+        self.last_render = 0.0
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        if enabled:
+            self.thread = threading.Thread(target=self._render_loop, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)  # the render thread must not be drawing while the interpreter shuts down
+
+    def add(self, rows, column):
+        """
+        Adds the gwp values of newly written result rows to the histogram.
+
+        :param rows: list of result rows as written to the results csv
+        :param column: index of the gwp column in a result row
+        """
+        values = pd.to_numeric(pd.Series([row[column] for row in rows]), errors='coerce').to_numpy()
+        counts, _ = np.histogram(values[~np.isnan(values)], bins=self.edges)
+        with self.lock:
+            self.counts += counts
+        if self.enabled and time.monotonic() - self.last_render >= self.interval:
+            self.last_render = time.monotonic()
+            self.pending.set()
+
+    def close(self):
+        """
+        Saves the final plot and stops the render thread.
+        """
+        if self.thread is not None:
+            self.stopped.set()
+            self.pending.set()
+            self.thread.join()
+            self.thread = None
+            atexit.unregister(self.close)
+
+    def _render_loop(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            self._render()
+            if self.stopped.is_set():
+                return
+
+    def _render(self):
+        with self.lock:
+            counts = self.counts.copy()
+        total = counts.sum()
+        if total == 0:
+            return
+        # The pyplot state machine is not thread safe, so draw on a standalone figure with the Agg canvas.
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        ax.stairs(counts / (total * np.diff(self.edges)), self.edges, fill=True)  # same as density=True in plt.hist
+        ax.set_title(f'{self.title} (n={total})')
+        ax.set_ylabel('Probability (%)')
+        ax.set_xlabel(f'GWP (kgCO2e/{self.declared_unit})')
+        fig.savefig(self.png_path)
+
+
+class ConvergenceMonitor:
+    """
+    Convergence monitor on streaming gwp results. Tracks the running mean, the confidence intervals of the mean and of
+    the 5th, 50th and 95th percentiles, and the effective sample size. Results of one MCA iteration share the same
+    providers and are correlated, so the effective sample size is discounted by the correlation within iterations.
+    """
+
+    def __init__(self, tolerance=0.02, percentiles=(5, 50, 95), min_runs=10, confidence=0.95):
+        """
+        :param tolerance: relative half width of the confidence intervals at which the results count as converged
+        :param percentiles: percentiles to monitor
+        :param min_runs: number of iterations before the results can count as converged
+        :param confidence: confidence level of the intervals
+        """
+        self.tolerance = tolerance
+        self.percentiles = percentiles
+        self.min_runs = min_runs
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.runs = []  # arrays of gwp values, one per finished iteration
+        self.current = []  # gwp values of the running iteration
+
+    def add(self, rows, column):
+        """
+        :param rows: list of result rows as written to the results csv
+        :param column: index of the gwp column in a result row
+        """
+        values = pd.to_numeric(pd.Series([row[column] for row in rows]), errors='coerce').to_numpy()
+        self.current.extend(values[~np.isnan(values)])
+
+    def end_run(self):
+        """
+        Closes the running iteration.
+        """
+        if len(self.current) > 0:
+            self.runs.append(np.array(self.current))
+        self.current = []
+
+    def add_csv(self, path, sim_type, column_name, run_size):
+        """
+        Adds the results of a resumed phase from the results csv.
+
+        :param path: results csv
+        :param sim_type: sim_type of the phase, e.g. 'mca' or a uf_group
+        :param column_name: name of the gwp column
+        :param run_size: number of result rows per iteration, i.e. param_runs
+        """
+        res_df = pd.read_csv(path)
+        values = pd.to_numeric(res_df.loc[res_df['sim_type'].astype(str) == str(sim_type), column_name],
+                               errors='coerce').to_numpy()
+        for start in range(0, len(values), run_size):
+            run_values = values[start:start + run_size]
+            self.current.extend(run_values[~np.isnan(run_values)])
+            self.end_run()
+
+    def effective_size(self):
+        """
+        Effective sample size n / (1 + (m - 1) * icc), with m results per iteration and the intraclass correlation icc
+        of the results within iterations (one-way analysis of variance).
+
+        :return: effective sample size
+        """
+        n = sum(len(run) for run in self.runs)
+        k = len(self.runs)
+        if k < 2 or n == k:
+            return float(n)
+        m = n / k
+        grand_mean = np.concatenate(self.runs).mean()
+        ms_between = sum(len(run) * (run.mean() - grand_mean) ** 2 for run in self.runs) / (k - 1)
+        ms_within = sum(((run - run.mean()) ** 2).sum() for run in self.runs) / (n - k)
+        if ms_between + (m - 1) * ms_within <= 0:
+            return float(n)
+        icc = np.clip((ms_between - ms_within) / (ms_between + (m - 1) * ms_within), 0, 1)
+
+        return n / (1 + (m - 1) * icc)
+
+    def status(self):
+        """
+        :return: dictionary of the number of iterations and results, the effective sample size, the mean, the
+            monitored percentiles and the relative half widths of their confidence intervals
+        """
+        values = np.concatenate(self.runs) if len(self.runs) > 0 else np.array([])
+        status = {'runs': len(self.runs), 'n': len(values), 'ess': self.effective_size(), 'estimates': {},
+                  'errors': {}}
+        if len(values) < 2:
+            return status
+
+        ess = status['ess']
+        status['estimates']['mean'] = values.mean()
+        status['errors']['mean'] = self.z * values.std(ddof=1) / np.sqrt(ess)
+        for p in self.percentiles:
+            # distribution free interval of the percentile from order statistics, with the effective sample size
+            q = p / 100
+            spread = self.z * np.sqrt(q * (1 - q) / ess)
+            low, high = np.quantile(values, [max(q - spread, 0), min(q + spread, 1)])
+            status['estimates'][f'p{p}'] = np.percentile(values, p)
+            status['errors'][f'p{p}'] = (high - low) / 2
+        for name, error in status['errors'].items():
+            estimate = abs(status['estimates'][name])
+            status['errors'][name] = error / estimate if estimate > 0 else np.inf
+
+        return status
+
+    def converged(self):
+        """
+        :return: True if at least min_runs iterations are finished and all intervals are within the tolerance
+        """
+        if len(self.runs) < self.min_runs:
+            return False
+        errors = self.status()['errors']
+
+        return len(errors) > 0 and max(errors.values()) <= self.tolerance
+
+    def summary(self):
+        """
+        :return: one line summary of the convergence status
+        """
+        status = self.status()
+        estimates = ', '.join(f"{name} {status['estimates'][name]:.3g} (±{error:.1%})"
+                              for name, error in status['errors'].items())
+
+        return f"Convergence after {status['runs']} iterations (ESS {status['ess']:.0f} of {status['n']}): {estimates}"
+
+
+def model_descriptor(model):
     """
-    Set up result display.
+    :param model: reference to product system
+    :return: product system descriptor for a calculation setup
     """
-    data = pd.read_csv(f'{results_path}')
-    hist_gwp_vals = data['gwp'].tolist()
+    try:
+        return client.get_descriptor(olca.ProductSystem, model.id)
+    except IndexError:
+        print("IndexError in OLCA calculation, probably because a product system was not set up correctly.")
+        sys.exit()
+
 
-    plt.hist(hist_gwp_vals, density=True, bins=50, range=[0, max_value])  # density=False would make counts
-    plt.title(f'{study_object} impacts per {declared_unit}')
-    plt.ylabel('Probability (%)')
-    plt.xlabel(f'GWP (kgCO2e/{declared_unit})')
+def submit_calculation(model, lcia, parameter_redefs=None):
+    """
+    Starts an openLCA calculation without waiting for it, see get_results and CalculationPipeline.
+    :param model: reference to product system
+    :param lcia: name of the lcia method
+    :param parameter_redefs: list of parameter redefinitions - this needs to be in OLCA format.
+    :return: olca_ipc Result of the running calculation
+    """
+    setup = olca.CalculationSetup(
+        target=model_descriptor(model),
+        impact_method=fetch_lcia_method(lcia),
+        parameters=parameter_redefs if parameter_redefs is not None else [],
+        allocation=olca.AllocationType.USE_DEFAULT_ALLOCATION
+    )
 
-    base_path = os.path.splitext(results_path)[0]
-    plt.savefig(f'{base_path}.png')
+    return client.calculate(setup)
 
 
-def get_results(model, lcia_methods, counter=0, parameter_redefs=None):
+def get_results(model, lcia_methods, counter=0, parameter_redefs=None, local_characterization=True, submitted=None):
     """
     Runs a simulation and returns a set of results to be stored.
     :param model_ref: reference to product system.
     :param lcia_methods: list of lcia methods to run calculations for.
     :param counter: counter from outer scope
     :param parameter_redefs: list of parameter redefinitions - this needs to be in OLCA format.
+    :param local_characterization: calculate the inventory once and characterize it locally for all further methods,
+        see characterize_locally. If False, every method is calculated in openLCA.
+    :param submitted: optional calculation of the first lcia method that was already started with submit_calculation
     :return: list of results
     """
 
-    try:
-        model_ref = client.get_descriptor(olca.ProductSystem, model.id)
-    except IndexError:
-        print("IndexError in OLCA calculation, probably because a product system was not set up correctly.")
-        sys.exit()
+    model_ref = None
+    if submitted is None:
+        model_ref = model_descriptor(model)
 
     # reset all results
-    gwp = np.nan
-    gwp_be = np.nan
-    gwp_bu = np.nan
-    ap = np.nan
-    ep = np.nan
-    odp = np.nan
-    pocp = np.nan
-    gwp_ar5 = np.nan
-    gwp_ef2 = np.nan
-    gwp_cml = np.nan
+    impacts = {}
 
     # Run simulations using each LCIA method and assign results to mapped variables
     if parameter_redefs is None:
         parameter_redefs = []
     print(f"Firing up OpenLCA simulator.")
+    inventory = None
     for lcia in lcia_methods:
 
-        # print(f"\nSetting up OpenLCA simulator for {lcia}.")
-        setup = olca.CalculationSetup(
-            target=model_ref,
-            impact_method=fetch_lcia_method(lcia),
-            parameters=parameter_redefs,
-            allocation=olca.AllocationType.USE_DEFAULT_ALLOCATION
-        )
-
-        result = client.calculate(setup)
-        result.wait_until_ready()
+        """
+        The inventory only depends on the product system and the parameters. After the first method, methods with
+        cached characterization factors are applied to the inventory of the first calculation without another
+        openLCA calculation.
+        """
+        if inventory is not None:
+            local_results = characterize_locally(lcia, inventory)
+            if local_results is not None:
+                map_impacts(lcia, local_results, impacts)
+                continue
+
+        if submitted is not None and lcia == lcia_methods[0]:
+            result = submitted
+        else:
+            # print(f"\nSetting up OpenLCA simulator for {lcia}.")
+            if model_ref is None:
+                model_ref = model_descriptor(model)
+            setup = olca.CalculationSetup(
+                target=model_ref,
+                impact_method=fetch_lcia_method(lcia),
+                parameters=parameter_redefs,
+                allocation=olca.AllocationType.USE_DEFAULT_ALLOCATION
+            )
+            result = client.calculate(setup)
+        with tracer.span('wait'):
+            result.wait_until_ready()
         results = result.get_total_impacts()
 
         # print system setup for QA
@@ -1269,137 +2903,2262 @@ def get_results(model, lcia_methods, counter=0, parameter_redefs=None):
         #       f"Amount: {ref_amount} {ref_unit}"
         #       )
 
-        for r in results:
-            if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
-                    and r.impact_category.name in ['Global warming']:
-                gwp = r.amount
-                gwp_unit = r.impact_category.ref_unit
-            if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
-                    and r.impact_category.name in ['Global warming - biogenic emissions']:
-                gwp_be = r.amount
-                gwp_be_unit = r.impact_category.ref_unit
-            if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
-                    and r.impact_category.name in ['Global warming - biogenic uptake']:
-                gwp_bu = r.amount
-                gwp_bu_unit = r.impact_category.ref_unit
-            if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
-                    and r.impact_category.name in ['Acidification']:
-                ap = r.amount
-                ap_unit = r.impact_category.ref_unit
-            if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
-                    and r.impact_category.name in ['Eutrophication']:
-                ep = r.amount
-                ep_unit = r.impact_category.ref_unit
-            if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
-                    and r.impact_category.name in ['Ozone depletion']:
-                odp = r.amount
-                odp_unit = r.impact_category.ref_unit
-            if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
-                    and r.impact_category.name in ['Smog formation']:
-                pocp = r.amount
-                pocp_unit = r.impact_category.ref_unit
-            if lcia in ['IPCC 2013 GWP 100a'] \
-                    and r.impact_category.name in ['IPCC GWP 100a']:
-                gwp_ar5 = r.amount
-                gwp_ar5_unit = r.impact_category.ref_unit
-            if lcia in ['EF Method (adapted)'] \
-                    and r.impact_category.name in ['Climate change - fossil']:
-                gwp_ef2 = r.amount
-                gwp_ef2_unit = r.impact_category.ref_unit
-            if lcia in ['CML-IA baseline'] \
-                    and r.impact_category.name in ['Global warming (GWP100a)']:
-                gwp_cml = r.amount
-                gwp_cml_unit = r.impact_category.ref_unit
-            else:
-                pass
-            # print(f"{r.impact_category.name} :: {r.amount} {r.impact_category.ref_unit}")
+        map_impacts(lcia, results, impacts)
+
+        if local_characterization and len(lcia_methods) > 1:
+            if inventory is None:
+                inventory = result.get_total_flows()
+            if lcia != lcia_methods[0]:
+                update_lcia_factors(lcia, result)  # factors for flows not seen before
 
         # Dispose of simulator results before starting the next calculation setup and simulation.
         print(f"Completed analysis for: {results[0].impact_category.category}")
         result.dispose()
-    result.dispose()
 
-    impact_results = [round(gwp, 4), gwp_be, gwp_bu, ap, ep, odp, pocp,
-                      round(gwp_ar5, 4),
-                      round(gwp_ef2, 4),
-                      round(gwp_cml, 4)]
+    impact_results = impact_list(impacts)
 
-    print(f'\nResult saved to csv. | Run {counter} gwp: {gwp:.2f} {gwp_unit} ({lcia_methods[0]})')
+    print(f'\nResult saved to csv. | Run {counter} gwp: {impacts.get("gwp", np.nan):.2f} {impacts["gwp_unit"]} ({lcia_methods[0]})')
 
     return impact_results
 
 
-"""CACHING FUNCTIONS"""
-
-cache_process = dict()
-cache_flows = dict()
-cache_lcia = dict()
-cache_ref_flows = dict()
+def envi_flow_key(envi_flow):
+    """
+    :param envi_flow: OLCA elementary flow of a calculation result
+    :return: hashable key of the flow, its direction and its location
+    """
+    location = envi_flow.location.id if envi_flow.location is not None else None
+    return envi_flow.flow.id, bool(envi_flow.is_input), location
 
 
-def fetch_process_json(olca_uuid):
+def update_lcia_factors(lcia, result):
     """
-    Caches process json to speed up loading of repeated processes.
-
-    :param olca_uuid:
-    :return: olca_json
+    Adds the characterization factors of a calculation result to the local factor cache of its LCIA method (see
+    fetch_lcia_factors). The cached factors are then checked by characterizing the inventory of the same result
+    locally; if that does not reproduce the openLCA impacts, the method is always calculated in openLCA.
+    :param lcia: name of the LCIA method the result was calculated with.
+    :param result: OLCA calculation result.
+    :return: None.
     """
-    # print(f"Checking for {olca_uuid} in cache.")
-    if olca_uuid not in cache_process:
-        cache_process[olca_uuid] = client.get(olca.Process, olca_uuid)
-    #     print(f"Added {olca_uuid} to cache.")
-    # else:
-    #     print(f"{olca_uuid} already in cache.")
-
-    return cache_process[olca_uuid]
+    cached = fetch_lcia_factors(lcia)
+    if not cached['valid']:
+        return
+    print(f"Caching characterization factors of {lcia}.")
+    cached['categories'] = result.get_impact_categories()
+    for envi_flow in result.get_envi_flows():
+        cached['index'].setdefault(envi_flow_key(envi_flow), len(cached['index']))
+    for category in cached['categories']:
+        factors = cached['factors'].setdefault(category.id, {})
+        for v in result.get_impact_factors_of(category):
+            factors[cached['index'][envi_flow_key(v.envi_flow)]] = v.amount
+
+    cached['matrix'] = np.zeros((len(cached['categories']), len(cached['index'])))
+    for k, category in enumerate(cached['categories']):
+        for i, value in cached['factors'][category.id].items():
+            cached['matrix'][k, i] = value
+
+    expected = {v.impact_category.id: v.amount for v in result.get_total_impacts()}
+    for v in characterize_locally(lcia, result.get_total_flows()):
+        if not np.isclose(v.amount, expected.get(v.impact_category.id, 0.0), rtol=1e-6, atol=1e-12):
+            print(f"!! Local characterization does not match openLCA for {lcia} ({v.impact_category.name}). "
+                  f"It will be calculated in openLCA instead. !!")
+            cached['valid'] = False
+            break
+
+
+def characterize_locally(lcia, inventory):
+    """
+    Applies the cached characterization factors of an LCIA method to an inventory as one matrix product.
+    :param lcia: name of the LCIA method.
+    :param inventory: list of OLCA elementary flow values, e.g. the total flows of a calculation result.
+    :return: list of OLCA impact values like get_total_impacts, or None if the factors of the method are not cached
+        for every flow of the inventory.
+    """
+    cached = cache_lcia_factors.get(lcia)
+    if cached is None or not cached['valid'] or cached['matrix'] is None:
+        return None
+    columns = [cached['index'].get(envi_flow_key(v.envi_flow)) for v in inventory]
+    if None in columns:
+        return None
+    amounts = np.array([v.amount for v in inventory], dtype=float)
+    totals = cached['matrix'][:, columns] @ amounts
+    return [olca.ImpactValue(amount=float(totals[k]), impact_category=category)
+            for k, category in enumerate(cached['categories'])]
+
+
+def map_impacts(lcia, results, impacts):
+    """
+    Assigns the impact results of one LCIA method to the impact variables saved in the results csv.
+    :param lcia: name of the LCIA method the results were calculated with.
+    :param results: list of OLCA impact values.
+    :param impacts: dictionary of impact variables, updated in place.
+    :return: None.
+    """
+    for r in results:
+        if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
+                and r.impact_category.name in ['Global warming']:
+            impacts['gwp'] = r.amount
+            impacts['gwp_unit'] = r.impact_category.ref_unit
+        if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
+                and r.impact_category.name in ['Global warming - biogenic emissions']:
+            impacts['gwp_be'] = r.amount
+            impacts['gwp_be_unit'] = r.impact_category.ref_unit
+        if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
+                and r.impact_category.name in ['Global warming - biogenic uptake']:
+            impacts['gwp_bu'] = r.amount
+            impacts['gwp_bu_unit'] = r.impact_category.ref_unit
+        if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
+                and r.impact_category.name in ['Acidification']:
+            impacts['ap'] = r.amount
+            impacts['ap_unit'] = r.impact_category.ref_unit
+        if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
+                and r.impact_category.name in ['Eutrophication']:
+            impacts['ep'] = r.amount
+            impacts['ep_unit'] = r.impact_category.ref_unit
+        if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
+                and r.impact_category.name in ['Ozone depletion']:
+            impacts['odp'] = r.amount
+            impacts['odp_unit'] = r.impact_category.ref_unit
+        if lcia in ['TRACI 2.1', 'TRACI 2.1 (openIMPACT)'] \
+                and r.impact_category.name in ['Smog formation']:
+            impacts['pocp'] = r.amount
+            impacts['pocp_unit'] = r.impact_category.ref_unit
+        if lcia in ['IPCC 2013 GWP 100a'] \
+                and r.impact_category.name in ['IPCC GWP 100a']:
+            impacts['gwp_ar5'] = r.amount
+            impacts['gwp_ar5_unit'] = r.impact_category.ref_unit
+        if lcia in ['EF Method (adapted)'] \
+                and r.impact_category.name in ['Climate change - fossil']:
+            impacts['gwp_ef2'] = r.amount
+            impacts['gwp_ef2_unit'] = r.impact_category.ref_unit
+        if lcia in ['CML-IA baseline'] \
+                and r.impact_category.name in ['Global warming (GWP100a)']:
+            impacts['gwp_cml'] = r.amount
+            impacts['gwp_cml_unit'] = r.impact_category.ref_unit
+        else:
+            pass
+        # print(f"{r.impact_category.name} :: {r.amount} {r.impact_category.ref_unit}")
 
 
-def fetch_flow(olca_name):
+def impact_list(impacts):
     """
-    Caches flow json to speed up loading of repeated processes.
-
-    :param olca_name:
-    :return: olca_json
+    Orders mapped impact variables as they are saved in the results csv. Impacts that were not calculated are nan.
+    :param impacts: dictionary of impact variables filled by map_impacts.
+    :return: list of results
+    """
+    impacts.setdefault('gwp_unit', '')
+    return [round(impacts.get('gwp', np.nan), 4),
+            impacts.get('gwp_be', np.nan),
+            impacts.get('gwp_bu', np.nan),
+            impacts.get('ap', np.nan),
+            impacts.get('ep', np.nan),
+            impacts.get('odp', np.nan),
+            impacts.get('pocp', np.nan),
+            round(impacts.get('gwp_ar5', np.nan), 4),
+            round(impacts.get('gwp_ef2', np.nan), 4),
+            round(impacts.get('gwp_cml', np.nan), 4)]
+
+
+class CalculationPipeline:
+    """
+    Keeps openLCA busy while Python works. Calculations are started as soon as their parameter redefinitions are
+    picked and are collected in the order they were started, so picking the next parameters and writing and plotting
+    finished rows overlap with the calculations queued on the server. Pending calculations read the processes when
+    they run, so the pipeline has to be drained before processes are modified or a product system is relinked.
     """
-    # print(f"Checking for {olca_uuid} in cache.")
-    if olca_name not in cache_flows:
-        cache_flows[olca_name] = client.find(olca.Flow, olca_name)
 
-    return cache_flows[olca_name]
+    def __init__(self, lcia_methods, depth=2):
+        """
+        :param lcia_methods: list of lcia methods, see get_results
+        :param depth: number of calculations kept running; 1 waits for every calculation before the next is started
+        """
+        self.lcia_methods = lcia_methods
+        self.depth = max(1, depth)
+        self.pending = []
 
+    def submit(self, model, parameter_redefs, counter, picked, sim_type):
+        """
+        Starts a calculation and collects the oldest ones until fewer than depth are running.
+        :param model: reference to product system
+        :param parameter_redefs: list of parameter redefinitions
+        :param counter: counter from outer scope
+        :param picked: results row columns before the impact results, i.e. picked providers and parameter values
+        :param sim_type: last results row column
+        :return: list of finished results rows, oldest first
+        """
+        with tracer.span('calculate submit'):
+            submitted = submit_calculation(model, self.lcia_methods[0], parameter_redefs) if self.depth > 1 else None
+        self.pending.append((model, parameter_redefs, counter, picked, sim_type, submitted))
+        finished = []
+        while len(self.pending) >= self.depth:
+            finished.append(self.collect())
 
-def fetch_ref_flows(process):
-    """
-    Caches reference flow json to speed up loading of repeated processes.
+        return finished
 
-    :param process:
-    :return: olca_json
-    """
-    if process not in cache_ref_flows:
-        for i in process.exchanges:
-            if i.is_quantitative_reference:
-                fname = i.flow.name
-                fuuid = i.flow.id
-                ftype = i.flow_property.name
-                funit = i.unit.name
-                fref = fetch_flow(fname)
-        cache_ref_flows[process] = [fname, fuuid, ftype, funit, fref]
+    def collect(self):
+        """
+        :return: results row of the oldest pending calculation
+        """
+        model, parameter_redefs, counter, picked, sim_type, submitted = self.pending.pop(0)
+        with tracer.span('calculate'):
+            impact_results = get_results(model, self.lcia_methods, counter, parameter_redefs, submitted=submitted)
 
-    return cache_ref_flows[process]
+        return picked + impact_results + [sim_type]
 
+    def drain(self):
+        """
+        :return: results rows of all pending calculations, oldest first
+        """
+        return [self.collect() for n in range(len(self.pending))]
 
-def fetch_lcia_method(olca_name):
+    def discard(self):
+        """
+        Disposes pending calculations without collecting them, e.g. after an error.
+        """
+        for model, parameter_redefs, counter, picked, sim_type, submitted in self.pending:
+            if submitted is not None:
+                submitted.dispose()
+        self.pending = []
+
+
+class SimulatorSession:
     """
-    Caches lcia method reference to speed up loading of methods.
-    :param olca_name:
-    :return: olca_ref
+    openLCA simulator sessions for one product system, one per LCIA method. The calculation matrices are set up once
+    when the session starts and every call of get_results only runs the next simulation, in which openLCA samples the
+    parameter uncertainties of the redefinitions (and any uncertainties defined in the database).
     """
-    # print(f"Checking for {olca_uuid} in cache.")
-    if olca_name not in cache_lcia:
-        cache_lcia[olca_name] = client.find(olca.ImpactMethod, olca_name)
 
-    return cache_lcia[olca_name]
+    def __init__(self, model, lcia_methods, parameter_redefs):
+        """
+        :param model: product system
+        :param lcia_methods: list of lcia methods to run simulations for
+        :param parameter_redefs: list of OLCA parameter redefinitions, see simulator_parameters
+        """
+        model_ref = client.get_descriptor(olca.ProductSystem, model.id)
+        self.lcia_methods = lcia_methods
+        self.simulations = []
+        self.runs = 0
+
+        print(f"Firing up OpenLCA simulator.")
+        for lcia in lcia_methods:
+            setup = olca.CalculationSetup(
+                target=model_ref,
+                impact_method=fetch_lcia_method(lcia),
+                parameters=parameter_redefs,
+                allocation=olca.AllocationType.USE_DEFAULT_ALLOCATION
+            )
+            simulation = client.simulate(setup)  # runs the first simulation
+            with tracer.span('wait'):
+                simulation.wait_until_ready()
+            self.simulations.append(simulation)
 
+    def get_results(self, counter=0):
+        """
+        :param counter: counter from outer scope
+        :return: list of results of the next simulation, in the same format as get_results
+        """
+        impacts = {}
+        for lcia, simulation in zip(self.lcia_methods, self.simulations):
+            if self.runs > 0:
+                simulation.simulate_next()
+                with tracer.span('wait'):
+                    simulation.wait_until_ready()
+            map_impacts(lcia, simulation.get_total_impacts(), impacts)
+        self.runs += 1
 
-if __name__ == "__main__": main()
+        impact_results = impact_list(impacts)
+
+        print(f'\nResult saved to csv. | Run {counter} gwp: {impacts.get("gwp", np.nan):.2f} {impacts["gwp_unit"]} '
+              f'({self.lcia_methods[0]}, simulation {self.runs})')
+
+        return impact_results
+
+    def dispose(self):
+        for simulation in self.simulations:
+            simulation.dispose()
+        self.simulations = []
+
+
+"""LOCAL MATRIX ENGINE"""
+
+
+class LocalEngine:
+    """
+    Local sparse-matrix LCA engine. The technosphere (A), intervention (B) and characterization (C) matrices of the
+    base product system are exported from openLCA once per substitution sheet, together with the supply chains of all
+    candidate providers listed in the provider sheets. The technosphere matrix is factorized once and every MCA run is
+    then solved locally:
+      - provider substitutions move the substituted input of a process column from the base provider row to the new
+        provider row, i.e. they replace single columns of A,
+      - parameter redefinitions re-evaluate the exchange formulas of their context process and rescale the affected
+        entries of that process column in A and B,
+      - the changed columns are applied to the cached factorization as a low-rank (Woodbury) update.
+    Results are returned in the same format as get_results. Use validate_local_engine to compare the engine with
+    openLCA calculations on a sample of runs.
+    """
+
+    def __init__(self, prov_sheet, lcia_methods):
+        self.prov_sheet = prov_sheet
+        self.lcia_methods = lcia_methods
+        self.valid = False
+        self.params_supported = True
+
+        self.tech_flows = []  # openLCA tech flows (provider + product flow) in matrix order
+        self.tech_index = {}  # (provider uuid, flow uuid) -> row/column of A
+        self.envi_flows = []  # openLCA elementary flows in matrix order
+        self.envi_index = {}  # (flow uuid, is input, location uuid) -> row of B
+        self.a_cols = {}  # column -> {row: value} of A
+        self.b_cols = {}  # column -> {row: value} of B
+        self.b_missing = set()  # columns whose B column could not be exported yet (zero scaling factor)
+        self.demand = {}  # row -> demand value
+        self.categories = {}  # lcia method -> list of impact category refs
+        self.factors = {}  # impact category uuid -> {envi key: characterization factor}
+        self.flow_units = {}  # flow uuid -> reference unit name
+
+        self.global_params = {}  # global parameter name -> value
+        self.param_entries = {}  # process uuid -> list of matrix entries depending on parameters
+        self.param_scopes = {}  # process uuid -> list of OLCA process parameters
+        self.base_values = {}  # (process uuid, parameter name) -> value the matrices were exported with
+
+    """ENGINE SET UP"""
+
+    def build(self, model_ref, parameter_redefs, sheet_providers, param_sheet):
+        """
+        Exports the matrices of the base product system and all candidate providers and factorizes the technosphere.
+        The processes must be modified for the base providers before the engine is built.
+        :param model_ref: reference to the base product system.
+        :param parameter_redefs: parameter redefinitions (base values) the matrices are exported with.
+        :param sheet_providers: dictionary of provider sheet name -> list of candidate provider references.
+        :param param_sheet: substitution sheet rows that list a parameter.
+        :return: True if the engine reproduces the openLCA base result, else False.
+        """
+        build_start = timeit.default_timer()
+        print(f'Exporting base product system matrices.')
+        base_impacts = self._add_target(model_ref, parameter_redefs, demand=True)
+        base_scaling = self._scaling
+
+        for sheet_name, providers in sheet_providers.items():
+            for provider_ref in providers:
+                if any(key[0] == provider_ref.id for key in self.tech_index):
+                    continue
+                print(f'\tExporting supply chain of "{provider_ref.name}" ({sheet_name})')
+                config = olca.LinkingConfig(
+                    prefer_unit_processes=True,
+                    provider_linking=olca.ProviderLinking.PREFER_DEFAULTS,
+                )
+                provider_ps = new_product_system(provider_ref, config)
+                try:
+                    self._add_target(provider_ps, parameter_redefs)
+                finally:
+                    delete_ps(provider_ps)
+
+        if len(self.b_missing) > 0:
+            print(f'\t!! {len(self.b_missing)} process columns without elementary flows. Runs that use them may be '
+                  f'wrong; check them with the validation mode.')
+
+        self._factorize()
+        self._compile_parameters(param_sheet, parameter_redefs)
+
+        # Check the exported matrices against the openLCA base result.
+        x = self.x0
+        scaling_error = max([abs(x[j] - s) / max(abs(s), 1e-12) for j, s in base_scaling.items()] + [0])
+        impact_error = 0
+        local_impacts = self._characterize(x, self._interventions(x, {}))
+        for lcia in self.lcia_methods:
+            for local, remote in zip(local_impacts[lcia], base_impacts[lcia]):
+                impact_error = max(impact_error, abs(local.amount - remote.amount) / max(abs(remote.amount), 1e-12))
+
+        self.valid = scaling_error < 1e-6 and impact_error < 1e-6
+        build_time = humanfriendly.format_timespan(timeit.default_timer() - build_start)
+        print(f'Local engine with {len(self.tech_flows)} processes and {len(self.envi_flows)} elementary flows '
+              f'built in {build_time}.\n'
+              f'\tMax. relative error of scaling factors: {scaling_error:.2e}\n'
+              f'\tMax. relative error of impacts: {impact_error:.2e}')
+        if not self.valid:
+            print(f'\t!! Local engine does not reproduce the openLCA base result. Using openLCA calculations instead.')
+        if not self.params_supported:
+            print(f'\t!! Some parameter formulas cannot be evaluated locally. Using openLCA calculations instead.')
+
+        return self.valid
+
+    def _add_target(self, target, parameter_redefs, demand=False):
+        """
+        Calculates a product system in openLCA for each LCIA method and adds its matrix columns and characterization
+        factors to the engine.
+        :return: dictionary of lcia method -> total impacts of the calculation
+        """
+        total_impacts = {}
+        for lcia in self.lcia_methods:
+            setup = olca.CalculationSetup(
+                target=client.get_descriptor(olca.ProductSystem, target.id),
+                impact_method=fetch_lcia_method(lcia),
+                parameters=parameter_redefs,
+                allocation=olca.AllocationType.USE_DEFAULT_ALLOCATION
+            )
+            result = client.calculate(setup)
+            with tracer.span('wait'):
+                result.wait_until_ready()
+
+            if lcia == self.lcia_methods[0]:
+                self._add_columns(result)
+                if demand:
+                    demand_value = result.get_demand()
+                    self.demand[self._tech_row(demand_value.tech_flow)] = demand_value.amount
+
+            categories = result.get_impact_categories()
+            self.categories[lcia] = categories
+            for category in categories:
+                factors = self.factors.setdefault(category.id, {})
+                for v in result.get_impact_factors_of(category):
+                    factors[self._envi_row(v.envi_flow)] = v.amount
+            total_impacts[lcia] = result.get_total_impacts()
+            result.dispose()
+
+        return total_impacts
+
+    def _add_columns(self, result):
+        """Adds the technosphere and intervention columns of all processes in a calculation result."""
+        self._scaling = {}
+        scaling = {}
+        for v in result.get_scaling_factors():
+            scaling[self._tech_row(v.tech_flow)] = v.amount
+
+        for tech_flow in result.get_tech_flows():
+            j = self._tech_row(tech_flow)
+            s = scaling.get(j, 0)
+            self._scaling[j] = s
+            if j not in self.a_cols:
+                self.a_cols[j] = {self._tech_row(v.tech_flow): v.amount
+                                  for v in result.get_unscaled_tech_flows_of(tech_flow)}
+            if (j not in self.b_cols or j in self.b_missing) and s != 0:
+                self.b_cols[j] = {self._envi_row(v.envi_flow): v.amount / s
+                                  for v in result.get_direct_interventions_of(tech_flow)}
+                self.b_missing.discard(j)
+            elif j not in self.b_cols:
+                self.b_cols[j] = {}
+                self.b_missing.add(j)
+
+    def _tech_row(self, tech_flow):
+        key = (tech_flow.provider.id, tech_flow.flow.id)
+        if key not in self.tech_index:
+            self.tech_index[key] = len(self.tech_flows)
+            self.tech_flows.append(tech_flow)
+        return self.tech_index[key]
+
+    def _envi_row(self, envi_flow):
+        location = envi_flow.location.id if envi_flow.location is not None else None
+        key = (envi_flow.flow.id, bool(envi_flow.is_input), location)
+        if key not in self.envi_index:
+            self.envi_index[key] = len(self.envi_flows)
+            self.envi_flows.append(envi_flow)
+        return self.envi_index[key]
+
+    def _factorize(self):
+        """Builds the sparse matrices and factorizes the technosphere matrix."""
+        n = len(self.tech_flows)
+        rows, cols, vals = [], [], []
+        for j, col in self.a_cols.items():
+            for i, value in col.items():
+                rows.append(i)
+                cols.append(j)
+                vals.append(value)
+        self.A = sparse.csc_matrix((vals, (rows, cols)), shape=(n, n))
+
+        rows, cols, vals = [], [], []
+        for j, col in self.b_cols.items():
+            for i, value in col.items():
+                rows.append(i)
+                cols.append(j)
+                vals.append(value)
+        self.B = sparse.csc_matrix((vals, (rows, cols)), shape=(len(self.envi_flows), n))
+
+        self.C = {}
+        for lcia, categories in self.categories.items():
+            rows, cols, vals = [], [], []
+            for k, category in enumerate(categories):
+                for i, value in self.factors[category.id].items():
+                    rows.append(k)
+                    cols.append(i)
+                    vals.append(value)
+            self.C[lcia] = sparse.csr_matrix((vals, (rows, cols)), shape=(len(categories), len(self.envi_flows)))
+
+        self.f = np.zeros(n)
+        for i, value in self.demand.items():
+            self.f[i] = value
+
+        self.lu = sparse_linalg.splu(self.A)
+        self.x0 = self.lu.solve(self.f)
+
+        self.provider_columns = {}
+        for j, tech_flow in enumerate(self.tech_flows):
+            self.provider_columns.setdefault(tech_flow.provider.id, []).append(j)
+
+    def _compile_parameters(self, param_sheet, parameter_redefs):
+        """
+        Maps the parametrized exchanges of each parameter context process to the matrix entries they contribute to.
+        Several exchanges can contribute to the same matrix entry, so each entry stores all of its exchanges and is
+        rescaled by the ratio of their new and base sums. This keeps unit conversions and allocation factors that
+        openLCA applied when building the matrices.
+        """
+        try:
+            for parameter in client.get_all(olca.Parameter):
+                if parameter.value is not None:
+                    self.global_params[parameter.name.lower()] = parameter.value
+        except Exception:
+            print(f'\t!! Could not load global parameters.')
+
+        for redef in parameter_redefs:
+            if redef.context is not None:
+                self.base_values[(redef.context.id, redef.name.lower())] = redef.value
+
+        for process_uuid in param_sheet['uuid'].unique():
+            process = client.get(olca.Process, process_uuid)  # fresh copy, independent of the modification cache
+            self.param_scopes[process_uuid] = process.parameters or []
+            base_vars = self._process_variables(process_uuid, [])
+            if base_vars is None:
+                self.params_supported = False
+                continue
+
+            columns = self.provider_columns.get(process_uuid, [])
+            entries = {}
+            for exchange in process.exchanges:
+                for j in columns:
+                    key = self._exchange_entry(exchange, j)
+                    if key is None:
+                        if exchange.amount_formula:
+                            # A parametrized exchange without matrix entry cannot be rescaled locally.
+                            self.params_supported = False
+                        continue
+                    entries.setdefault(key, []).append((exchange.amount_formula, exchange.amount))
+
+            compiled = []
+            for key, exchanges in entries.items():
+                if not any(formula for formula, amount in exchanges):
+                    continue
+                base_sum = self._exchange_sum(exchanges, base_vars)
+                if base_sum is None or base_sum == 0:
+                    self.params_supported = False
+                    continue
+                compiled.append((key, exchanges, base_sum))
+            self.param_entries[process_uuid] = compiled
+
+    def _exchange_entry(self, exchange, j):
+        """Finds the (matrix, row, column) entry of an exchange in the column of its process."""
+        if exchange.flow is None:
+            return None
+        if exchange.flow.flow_type == olca.FlowType.ELEMENTARY_FLOW:
+            rows = [i for i in self.b_cols[j] if self.envi_flows[i].flow.id == exchange.flow.id
+                    and bool(self.envi_flows[i].is_input) == bool(exchange.is_input)]
+            return ('B', rows[0], j) if len(rows) == 1 else None
+
+        rows = [i for i in self.a_cols[j] if self.tech_flows[i].flow.id == exchange.flow.id]
+        if exchange.is_quantitative_reference or not exchange.is_input:
+            rows = [i for i in rows if self.tech_flows[i].provider.id == self.tech_flows[j].provider.id]
+        elif len(rows) > 1 and exchange.default_provider is not None:
+            rows = [i for i in rows if self.tech_flows[i].provider.id == exchange.default_provider.id]
+        return ('A', rows[0], j) if len(rows) == 1 else None
+
+    def _process_variables(self, process_uuid, parameter_redefs):
+        """
+        Evaluates the global and local parameters of a process with the given redefinitions.
+        :return: dictionary of lower case parameter name -> value, or None if a formula cannot be evaluated
+        """
+        variables = dict(self.global_params)
+        redefs = {(redef.context.id, redef.name.lower()): redef.value
+                  for redef in parameter_redefs if redef.context is not None}
+        pending = []
+        for parameter in self.param_scopes[process_uuid]:
+            name = parameter.name.lower()
+            if parameter.is_input_parameter or not parameter.formula:
+                variables[name] = redefs.get((process_uuid, name),
+                                             self.base_values.get((process_uuid, name), parameter.value))
+            else:
+                pending.append((name, parameter.formula))
+
+        # Calculated parameters may depend on each other, so evaluate them until nothing changes.
+        while pending:
+            remaining = []
+            for name, formula in pending:
+                try:
+                    variables[name] = evaluate_formula(formula, variables)
+                except (NameError, KeyError):
+                    remaining.append((name, formula))
+                except Exception:
+                    return None
+            if len(remaining) == len(pending):
+                return None
+            pending = remaining
+
+        return variables
+
+    @staticmethod
+    def _exchange_sum(exchanges, variables):
+        total = 0
+        for formula, amount in exchanges:
+            if formula:
+                try:
+                    total += evaluate_formula(formula, variables)
+                except Exception:
+                    return None
+            else:
+                total += amount or 0
+        return total
+
+    """ENGINE CALCULATION"""
+
+    def supports(self, provider_dict):
+        """Checks if a run with the given providers can be calculated locally."""
+        if not self.valid or not self.params_supported:
+            return False
+        return all(self._provider_rows(ref) for ref in provider_dict.values())
+
+    def _provider_rows(self, provider_ref):
+        return self.provider_columns.get(provider_ref.id, [])
+
+    def _flow_unit(self, flow_ref):
+        if flow_ref.id not in self.flow_units:
+            unit = flow_ref.ref_unit
+            if unit is None:
+                descriptor = client.get_descriptor(olca.Flow, flow_ref.id)
+                unit = descriptor.ref_unit if descriptor is not None else None
+            self.flow_units[flow_ref.id] = unit
+        return self.flow_units[flow_ref.id]
+
+    def _changed_columns(self, provider_dict, parameter_redefs):
+        """
+        Applies parameter redefinitions and provider substitutions to copies of the affected columns.
+        :return: (changed A columns, changed B columns) as dictionaries of column -> {row: value}, or None if a formula
+        cannot be evaluated with these redefinitions
+        """
+        a_new = {}
+        b_new = {}
+
+        # 1. Parameter redefinitions rescale the parametrized entries of their context process.
+        for process_uuid, compiled in self.param_entries.items():
+            variables = self._process_variables(process_uuid, parameter_redefs)
+            if variables is None:
+                return None
+            for (matrix, i, j), exchanges, base_sum in compiled:
+                exchange_sum = self._exchange_sum(exchanges, variables)
+                if exchange_sum is None:
+                    return None
+                ratio = exchange_sum / base_sum
+                if ratio == 1:
+                    continue
+                cols, base_cols = (a_new, self.a_cols) if matrix == 'A' else (b_new, self.b_cols)
+                if j not in cols:
+                    cols[j] = dict(base_cols[j])
+                cols[j][i] = base_cols[j][i] * ratio
+
+        # 2. Provider substitutions move the substituted inputs to the new provider's row.
+        for index, row in self.prov_sheet.iterrows():
+            if row['provider_sheet'] not in provider_dict or not isinstance(row['find_flow'], str):
+                continue
+            find_flow = row['find_flow'].replace('", "', '++').replace('"', '').split('++')
+            new_rows = self._provider_rows(provider_dict[row['provider_sheet']])
+            new_rows = [i for i in new_rows if self.tech_flows[i].flow.name in find_flow] or new_rows
+            i_new = new_rows[0]
+
+            for j in self.provider_columns.get(row['uuid'], []):
+                col = a_new[j] if j in a_new else self.a_cols[j]
+                moves = [i for i, value in col.items()
+                         if i != j and i != i_new and self.tech_flows[i].flow.name in find_flow]
+                if len(moves) == 0:
+                    continue
+                if j not in a_new:
+                    a_new[j] = dict(col)
+                for i in moves:
+                    value = a_new[j].pop(i) * self._conversion(self.tech_flows[i], self.tech_flows[i_new])
+                    a_new[j][i_new] = a_new[j].get(i_new, 0) + value
+
+        return a_new, b_new
+
+    def _conversion(self, old_flow, new_flow):
+        """Unit conversion between substituted flows, following the conversions supported by modify_exchanges."""
+        old_unit = self._flow_unit(old_flow.flow)
+        new_unit = self._flow_unit(new_flow.flow)
+        if old_unit == new_unit or 'natural gas' not in old_flow.flow.name:
+            return 1
+        if old_unit == 'm3' and new_unit == 'MJ':
+            return 38  # 38 MJ/m3
+        if old_unit == 'MJ' and new_unit == 'm3':
+            return 1 / 38
+        return 1
+
+    def _solve(self, a_new):
+        """Solves the modified technosphere with a Woodbury update of the cached factorization."""
+        x = self.x0
+        if len(a_new) == 0:
+            return x
+
+        columns = list(a_new)
+        n = len(self.tech_flows)
+        U = np.zeros((n, len(columns)))
+        for k, j in enumerate(columns):
+            for i, value in a_new[j].items():
+                U[i, k] += value
+            for i, value in self.a_cols[j].items():
+                U[i, k] -= value
+
+        Z = self.lu.solve(U)
+        S = np.eye(len(columns)) + Z[columns, :]
+        return x - Z @ np.linalg.solve(S, x[columns])
+
+    def _interventions(self, x, b_new):
+        g = self.B @ x
+        for j, col in b_new.items():
+            for i, value in col.items():
+                g[i] += value * x[j]
+            for i, value in self.b_cols[j].items():
+                g[i] -= value * x[j]
+        return g
+
+    def _characterize(self, x, g):
+        impacts = {}
+        for lcia in self.lcia_methods:
+            h = self.C[lcia] @ g
+            impacts[lcia] = [olca.ImpactValue(amount=float(h[k]), impact_category=category)
+                             for k, category in enumerate(self.categories[lcia])]
+        return impacts
+
+    def get_results(self, provider_dict, parameter_redefs, counter=0):
+        """
+        Calculates a run locally and returns a set of results to be stored, in the same format as get_results.
+        :param provider_dict: dictionary of provider sheet name -> OLCA reference of the provider to link.
+        :param parameter_redefs: list of parameter redefinitions in OLCA format.
+        :param counter: counter from outer scope
+        :return: list of results, or None if the run is not supported locally and has to be calculated in openLCA
+        """
+        changed = self._changed_columns(provider_dict, parameter_redefs)
+        if changed is None:
+            return None
+        a_new, b_new = changed
+        x = self._solve(a_new)
+        local_impacts = self._characterize(x, self._interventions(x, b_new))
+
+        impacts = {}
+        for lcia in self.lcia_methods:
+            map_impacts(lcia, local_impacts[lcia], impacts)
+        impact_results = impact_list(impacts)
+
+        print(f'\nResult saved to csv. | Run {counter} gwp: {impacts.get("gwp", np.nan):.2f} {impacts["gwp_unit"]} '
+              f'({self.lcia_methods[0]}, local engine)')
+
+        return impact_results
+
+
+formula_operators = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.Pow: operator.pow, ast.USub: operator.neg, ast.UAdd: operator.pos,
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge,
+}
+formula_functions = {  # if(condition; then; else) is evaluated lazily in evaluate_formula
+    '_and': lambda *a: all(a),
+    '_or': lambda *a: any(a),
+    'abs': abs, 'min': min, 'max': max, 'round': round,
+    'sqrt': np.sqrt, 'sqr': np.square, 'exp': np.exp, 'ln': np.log, 'log': np.log10,
+}
+formula_constants = {'pi': np.pi, 'e': np.e}
+
+
+def evaluate_formula(formula, variables):
+    """
+    Evaluates an openLCA parameter or exchange formula. Supports arithmetic, comparisons and the common openLCA
+    functions. Parameter names are not case-sensitive in openLCA. The formula is parsed into a syntax tree and only
+    numbers, parameter names and the nodes above are evaluated; anything else raises a ValueError.
+    :param formula: formula string from openLCA, e.g. "elec * 3.6"
+    :param variables: dictionary of lower case parameter name -> value
+    :return: value of the formula
+    """
+    expression = formula.strip().lower().replace('^', '**').replace(';', ',').replace('<>', '!=')
+    expression = re.sub(r'(?<![<>=!])=(?!=)', '==', expression)
+    expression = re.sub(r'\bif\s*\(', '_if(', expression)
+    expression = re.sub(r'\band\s*\(', '_and(', expression)
+    expression = re.sub(r'\bor\s*\(', '_or(', expression)
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as error:
+        raise ValueError(f'Cannot parse formula "{formula}": {error.msg}')
+
+    def evaluate(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) \
+                and not isinstance(node.value, bool):
+            return node.value
+        if isinstance(node, ast.Name):
+            if node.id in variables:
+                return variables[node.id]
+            if node.id in formula_constants:
+                return formula_constants[node.id]
+            raise NameError(f'Unknown parameter "{node.id}" in formula "{formula}"')
+        if isinstance(node, ast.BinOp) and type(node.op) in formula_operators:
+            return formula_operators[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in formula_operators:
+            return formula_operators[type(node.op)](evaluate(node.operand))
+        if isinstance(node, ast.Compare) and all(type(op) in formula_operators for op in node.ops):
+            left = evaluate(node.left)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = evaluate(comparator)
+                if not formula_operators[type(op)](left, right):
+                    return False
+                left = right
+            return True
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == '_if' \
+                and len(node.args) == 3 and not node.keywords:
+            # Only the chosen branch is evaluated, as in openLCA, so that if(x > 0; 1 / x; 0) holds for x = 0.
+            condition, then, otherwise = node.args
+            return evaluate(then) if evaluate(condition) else evaluate(otherwise)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in formula_functions \
+                and not node.keywords:
+            return formula_functions[node.func.id](*[evaluate(argument) for argument in node.args])
+        raise ValueError(f'Unsupported expression "{ast.unparse(node)}" in formula "{formula}"')
+
+    return float(evaluate(tree.body))
+
+
+def validate_local_engine(samples, prov_sheet, main_process_json, lcia_methods, wired_dict=None):
+    """
+    Compares local engine results with openLCA calculations for a sample of runs.
+    :param samples: list of (provider_dict, parameter_redefs, local impact results) tuples
+    :param prov_sheet: substitution sheet rows that list a provider sheet
+    :param main_process_json: main process from which the product systems are created
+    :param lcia_methods: list of lcia methods
+    :param wired_dict: provider dictionary the processes are currently modified for
+    :return: provider dictionary the processes are modified for after the validation
+    """
+    print(f'\nValidating local engine against openLCA on {len(samples)} runs.')
+    max_error = 0
+    for n, (provider_dict, parameter_redefs, local_results) in enumerate(samples):
+        modify_processes(prov_sheet, provider_dict, previous_dict=wired_dict)
+        wired_dict = provider_dict
+        model_ref = create_ps(main_process_json)
+        olca_results = get_results(model_ref, lcia_methods, n + 1, parameter_redefs)
+        delete_ps(model_ref)
+
+        errors = [abs(a - b) / max(abs(b), 1e-12) for a, b in zip(local_results, olca_results)
+                  if not (pd.isna(a) or pd.isna(b))]
+        error = max(errors + [0])
+        max_error = max(max_error, error)
+        print(f'\t{n + 1}) local gwp: {local_results[0]} | openLCA gwp: {olca_results[0]} | '
+              f'max. relative error: {error:.2e}')
+
+    print(f'Validation finished. Max. relative error: {max_error:.2e}')
+    if max_error > 1e-3:
+        print(f'!! Local engine results differ from openLCA. Check provider substitutions and parameter formulas.')
+
+    return wired_dict
+
+
+"""SENSITIVITY FUNCTIONS"""
+
+
+def plan_sensitivity(base_provider_dict, range_p_df, base_q_df, range_q_df):
+    """
+    Plans the one-at-a-time design of the range analysis: one swap per range provider and per range parameter value,
+    each a single change from the base case.
+
+    :param base_provider_dict: dictionary of provider sheet name -> OLCA reference of the base provider
+    :param range_p_df: range provider table (low and high providers of each provider sheet)
+    :param base_q_df: base parameter table
+    :param range_q_df: range parameter table (low and high values of each parameter)
+    :return: list of provider swaps, list of parameter swaps. A swap is a dictionary of the factor (provider sheet or
+        process.parameter), mark, label (provider name or parameter value) and same_as_base, plus the swapped
+        provider_dict for provider swaps, or the value and the positions in base_q_df for parameter swaps.
+    """
+    provider_swaps = []
+    for index, row in range_p_df.iterrows():
+        # If UUID is provided, get REF by UUID, else get REF by Name.
+        if isinstance(row['process_uuid'], str):
+            provider_ref = fetch_descriptor(olca.Process, row['process_uuid'])
+        else:
+            provider_ref = find_ref(olca.Process, row['name'], row['location'])
+
+        provider_dict = dict(base_provider_dict)
+        provider_dict[row['provider_sheet']] = provider_ref
+        provider_swaps.append({
+            'kind': 'provider',
+            'factor': row['provider_sheet'],
+            'mark': row['mark'],
+            'label': provider_ref.name,
+            'provider_dict': provider_dict,
+            'same_as_base': provider_ref.id == base_provider_dict[row['provider_sheet']].id,
+        })
+
+    parameter_swaps = []
+    for index, row in range_q_df.iterrows():
+        matches = (base_q_df['name'] == row['name']) & (base_q_df['parameter'] == row['parameter'])
+        positions = np.flatnonzero(matches.to_numpy()).tolist()
+        parameter_swaps.append({
+            'kind': 'parameter',
+            'factor': f"{row['name']}.{row['parameter']}",
+            'mark': row['mark'],
+            'label': row['value'],
+            'value': row['value'],
+            'positions': positions,
+            'same_as_base': all(base_q_df['value'].iloc[position] == row['value'] for position in positions),
+        })
+
+    print(f'\t{len(provider_swaps)} provider swaps and {len(parameter_swaps)} parameter swaps, '
+          f'{sum(swap["same_as_base"] for swap in provider_swaps + parameter_swaps)} of them equal the base case.')
+
+    return provider_swaps, parameter_swaps
+
+
+def write_tornado(res_path, swaps, declared_unit):
+    """
+    Writes the tornado data of the range analysis, the gwp change of every swap from the base case, and the tornado
+    plot. Factors are sorted by their gwp swing. The files are saved in the results folder of the studied process, next
+    to the raw folder, as "<results name>-range_tornado.csv" and "<results name>-range_tornadoplot.png".
+
+    :param res_path: raw results csv; range rows are in the order of the swaps
+    :param swaps: provider and parameter swaps from plan_sensitivity, in the order they were run
+    :param declared_unit: declared unit of the studied process
+    :return: tornado DataFrame, or None without a base run
+    """
+    res_df = pd.read_csv(res_path, usecols=['gwp', 'sim_type'])
+    base_gwp = res_df.loc[res_df['sim_type'] == 'base', 'gwp']
+    range_gwp = res_df.loc[res_df['sim_type'] == 'range', 'gwp'].to_numpy()
+    if len(base_gwp) == 0 or len(range_gwp) != len(swaps):
+        print(f'\nNo tornado data written, it needs the base run and all range runs in {res_path}.')
+        return None
+    base_gwp = base_gwp.iloc[0]
+
+    tornado = pd.DataFrame([{'factor': swap['factor'], 'kind': swap['kind'], 'mark': swap['mark'],
+                             'label': swap['label']} for swap in swaps])
+    tornado['gwp'] = range_gwp
+    tornado['base_gwp'] = base_gwp
+    tornado['delta_gwp'] = range_gwp - base_gwp
+    swing = tornado.groupby('factor')['gwp'].agg(lambda gwp: max(gwp.max(), base_gwp) - min(gwp.min(), base_gwp))
+    tornado['swing'] = tornado['factor'].map(swing)
+    tornado = tornado.sort_values(['swing', 'factor'], ascending=[False, True], kind='stable')
+
+    results_dir, results_file = os.path.split(res_path)
+    if os.path.basename(results_dir) == 'raw':
+        results_dir = os.path.dirname(results_dir)
+    results_name = os.path.splitext(results_file)[0]
+    tornado_path = os.path.join(results_dir, f'{results_name}-range_tornado.csv')
+    tornado.to_csv(tornado_path, index=False)
+
+    # Bars from the base gwp to the gwp of each swap, largest swing on top. Standalone figure, see LiveHistogram.
+    factors = list(dict.fromkeys(tornado['factor']))[::-1]
+    fig = Figure(figsize=(12, max(4.0, 0.3 * len(factors) + 1)))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    colors = {'low': 'tab:green', 'high': 'tab:red'}
+    for mark, mark_rows in tornado.groupby('mark'):
+        y = [factors.index(factor) for factor in mark_rows['factor']]
+        ax.barh(y, mark_rows['delta_gwp'], left=base_gwp, height=0.6, alpha=0.6, label=mark,
+                color=colors.get(mark, 'tab:gray'))
+    ax.axvline(base_gwp, color='black', linewidth=1)
+    ax.set_yticks(range(len(factors)))
+    ax.set_yticklabels(factors, fontsize=8)
+    ax.set_xlabel(f'GWP (kgCO2e/{declared_unit})')
+    ax.legend(title='Level')
+    fig.tight_layout()
+    fig.savefig(os.path.join(results_dir, f'{results_name}-range_tornadoplot.png'))
+    print(f'\nTornado data saved to {tornado_path}')
+
+    return tornado
+
+
+def sobol_factors(prov_sheet, provider_sheets, param_sheet, mode='uf_group'):
+    """
+    Lists the factors of the variance-based sensitivity analysis. The columns of the sampling design are the provider
+    sheets followed by the parameters, the same order as the results csv.
+        uf_group: one factor per uncertainty group; provider sheets and parameters without a group form 'ungrouped'
+        variable: one factor per provider sheet and per parameter
+
+    :param prov_sheet: substitution sheet rows that list a provider sheet
+    :param provider_sheets: list of unique provider sheets
+    :param param_sheet: substitution sheet rows that list a parameter
+    :param mode: 'uf_group' or 'variable'
+    :return: list of factor names, list of design column arrays (one per factor), list of variable names per factor
+    """
+    if mode not in ['uf_group', 'variable']:
+        raise ValueError(f'Unknown Sobol factor mode "{mode}".')
+
+    variables = list(provider_sheets) + [f"{row['name']}.{row['parameter']}" for index, row in param_sheet.iterrows()]
+    if mode == 'variable':
+        return variables, [np.array([column]) for column in range(len(variables))], [[name] for name in variables]
+
+    sheet_groups = prov_sheet.drop_duplicates(subset='provider_sheet').set_index('provider_sheet')['uf_group']
+    groups = [sheet_groups[sheet_name] for sheet_name in provider_sheets] + param_sheet['uf_group'].tolist()
+    groups = ['ungrouped' if pd.isna(group) else str(group) for group in groups]
+
+    factors = list(dict.fromkeys(groups))
+    columns = [np.flatnonzero(np.array(groups) == factor) for factor in factors]
+    return factors, columns, [[variables[column] for column in factor_columns] for factor_columns in columns]
+
+
+def saltelli_design(base_runs, dimensions, columns, seed=None):
+    """
+    Creates the Saltelli design of a variance-based sensitivity analysis: the base_runs rows of two independent
+    matrices A and B from one scrambled Sobol sequence, followed by one matrix AB_i per factor, which is A with the
+    columns of factor i taken from B. A total of base_runs * (factors + 2) runs.
+
+    :param base_runs: number of rows of A and B, a power of 2 keeps the Sobol sequence balanced
+    :param dimensions: number of sampled variables
+    :param columns: list of design column arrays, one per factor, from sobol_factors
+    :param seed: seed of the design
+    :return: array of shape (base_runs * (factors + 2), dimensions) in [0, 1)
+    """
+    design = sample_design('sobol', base_runs, 2 * dimensions, seed)
+    a, b = design[:, :dimensions], design[:, dimensions:]
+
+    blocks = [a, b]
+    for factor_columns in columns:
+        ab = a.copy()
+        ab[:, factor_columns] = b[:, factor_columns]
+        blocks.append(ab)
+
+    return np.vstack(blocks)
+
+
+def sobol_indices(f, base_runs, factors, variables, bootstrap=1000, confidence=0.95, seed=None):
+    """
+    Calculates first-order and total Sobol indices from the results of a Saltelli design, with bootstrap confidence
+    intervals. First-order indices use the Saltelli (2010) estimator, total indices the Jansen estimator, both
+    normalized by the variance of the A and B results. Base rows with a missing result in A, B or any AB_i are dropped.
+
+    :param f: results in the row order of saltelli_design
+    :param base_runs: number of rows of A and B
+    :param factors: list of factor names
+    :param variables: list of variable names per factor
+    :param bootstrap: number of bootstrap resamples of the base rows
+    :param confidence: confidence level of the intervals
+    :param seed: seed of the bootstrap resamples
+    :return: DataFrame with one row per factor
+    """
+    f = np.asarray(f, dtype=float).reshape(len(factors) + 2, base_runs)
+    f = f[:, ~np.isnan(f).any(axis=0)]
+    f_a, f_b, f_ab = f[0], f[1], f[2:]
+    runs = f.shape[1]
+
+    rng = np.random.default_rng(seed)
+    resamples = rng.integers(0, runs, (bootstrap, runs))
+    variance = np.var(np.concatenate([f_a, f_b]), ddof=1) if runs > 1 else np.nan
+    variance_boot = np.var(np.concatenate([f_a[resamples], f_b[resamples]], axis=1), axis=1, ddof=1)
+    low, high = 50 * (1 - confidence), 50 * (1 + confidence)
+
+    rows = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for factor, factor_variables, f_abi in zip(factors, variables, f_ab):
+            first = f_b * (f_abi - f_a)
+            total = 0.5 * (f_a - f_abi) ** 2
+            first_boot = first[resamples].mean(axis=1) / variance_boot
+            total_boot = total[resamples].mean(axis=1) / variance_boot
+            rows.append({
+                'factor': factor,
+                'variables': '; '.join(factor_variables),
+                'S1': first.mean() / variance,
+                'S1_low': np.nanpercentile(first_boot, low) if runs > 1 else np.nan,
+                'S1_high': np.nanpercentile(first_boot, high) if runs > 1 else np.nan,
+                'ST': total.mean() / variance,
+                'ST_low': np.nanpercentile(total_boot, low) if runs > 1 else np.nan,
+                'ST_high': np.nanpercentile(total_boot, high) if runs > 1 else np.nan,
+            })
+
+    indices = pd.DataFrame(rows)
+    indices['runs'] = runs
+    indices['gwp_variance'] = variance
+    return indices.sort_values('ST', ascending=False, kind='stable')
+
+
+def write_sobol_indices(indices, res_path):
+    """
+    Writes the Sobol indices next to the raw folder, as "<results name>-sobol_indices.csv".
+
+    :param indices: DataFrame from sobol_indices
+    :param res_path: raw results csv
+    :return: path of the csv
+    """
+    results_dir, results_file = os.path.split(res_path)
+    if os.path.basename(results_dir) == 'raw':
+        results_dir = os.path.dirname(results_dir)
+    results_name = os.path.splitext(results_file)[0]
+    sobol_path = os.path.join(results_dir, f'{results_name}-sobol_indices.csv')
+    indices.to_csv(sobol_path, index=False)
+
+    print(f'\nSobol indices of gwp ({indices["runs"].iloc[0]} base runs):')
+    for index, row in indices.iterrows():
+        print(f"\t{row['factor']:<30} S1 {row['S1']:7.3f} [{row['S1_low']:7.3f}, {row['S1_high']:7.3f}]  "
+              f"ST {row['ST']:7.3f} [{row['ST_low']:7.3f}, {row['ST_high']:7.3f}]")
+    print(f'Sobol indices saved to {sobol_path}')
+
+    return sobol_path
+
+
+"""STATISTICS FUNCTIONS"""
+
+
+class TDigest:
+    """
+    Merging t-digest for streaming quantiles. Values are summarized by a few hundred weighted centroids that are small
+    in the tails and larger around the median, so percentiles of any number of results are estimated in fixed memory.
+    """
+
+    def __init__(self, compression=500, buffer_size=8192):
+        """
+        :param compression: accuracy of the digest; keeps about compression / 2 centroids
+        :param buffer_size: number of new values that are buffered before they are merged into the centroids
+        """
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.buffer = []
+        self.buffered = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        """
+        :param values: array of values; NaN values must be removed before
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        if len(values) == 0:
+            return
+        self.buffer.append(values)
+        self.buffered += len(values)
+        self.count += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        if self.buffered >= self.buffer_size:
+            self._compress()
+
+    def merge(self, other):
+        """
+        Adds the centroids of another digest, e.g. of another results file.
+        """
+        other._compress()
+        if other.count == 0:
+            return
+        self._compress()
+        self.means = np.concatenate([self.means, other.means])
+        self.weights = np.concatenate([self.weights, other.weights])
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress(force=True)
+
+    def quantile(self, q):
+        """
+        :param q: quantile or array of quantiles between 0 and 1
+        :return: estimated quantile values
+        """
+        self._compress()
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan)
+        centers = np.cumsum(self.weights) - self.weights / 2
+
+        return np.interp(np.asarray(q) * self.count, np.r_[0, centers, self.count],
+                         np.r_[self.min, self.means, self.max])
+
+    def _compress(self, force=False):
+        """
+        Merges buffered values into the centroids. Sorted points are grouped into centroids of one unit of the arcsine
+        scale function, which keeps the centroids near the extremes small.
+        """
+        if len(self.buffer) == 0 and not force:
+            return
+        means = np.concatenate([self.means] + self.buffer)
+        weights = np.concatenate([self.weights] + [np.ones(len(values)) for values in self.buffer])
+        self.buffer = []
+        self.buffered = 0
+
+        order = np.argsort(means, kind='stable')
+        means = means[order]
+        weights = weights[order]
+        q = (np.cumsum(weights) - weights / 2) / weights.sum()
+        k = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * q - 1))
+        starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+
+class GroupStats:
+    """
+    One pass statistics of a results column per sim_type (base, range, mca and the uf_groups of the sub-group MCA):
+    count, mean, variance, min, max and t-digest percentiles. Rows can be added live from the ResultsWriter or streamed
+    from a raw results csv in chunks (stream_group_stats), so the group stats never need all rows in memory.
+    """
+    percentiles = [10, 20, 30, 40, 50, 60, 70, 80, 90]
+
+    def __init__(self, value_column='gwp', group_column='sim_type', compression=500):
+        """
+        :param value_column: results column to summarize
+        :param group_column: results column that defines the groups
+        :param compression: t-digest compression, see TDigest
+        """
+        self.value_column = value_column
+        self.group_column = group_column
+        self.compression = compression
+        self.groups = {}  # group -> dictionary of n, mean, m2, digest
+
+    def add_rows(self, rows, header):
+        """
+        Adds result rows as written by the ResultsWriter.
+
+        :param rows: list of result rows
+        :param header: results csv header
+        """
+        value_index = header.index(self.value_column)
+        group_index = header.index(self.group_column)
+        values = pd.to_numeric(pd.Series([row[value_index] for row in rows]), errors='coerce').to_numpy()
+        groups = [str(row[group_index]) for row in rows]
+        if len(set(groups)) == 1:
+            self.add(groups[0], values)
+        else:
+            for group in dict.fromkeys(groups):
+                self.add(group, values[[row_group == group for row_group in groups]])
+
+    def add_frame(self, res_df):
+        """
+        Adds a chunk of a results table.
+
+        :param res_df: DataFrame with the value and group columns
+        """
+        values = pd.to_numeric(res_df[self.value_column], errors='coerce')
+        for group, group_values in values.groupby(res_df[self.group_column].astype(str), sort=False):
+            self.add(group, group_values.to_numpy())
+
+    def add(self, group, values):
+        """
+        Adds values of one group. Mean and variance are combined with the parallel update of Chan et al., so a chunk
+        is added in one step.
+
+        :param group: name of the group
+        :param values: array of values; NaN values are skipped
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if group not in self.groups:
+            self.groups[group] = {'n': 0, 'mean': 0.0, 'm2': 0.0, 'digest': TDigest(self.compression)}
+        if len(values) == 0:
+            return
+        stats = self.groups[group]
+        n = len(values)
+        mean = values.mean()
+        delta = mean - stats['mean']
+        total = stats['n'] + n
+        stats['m2'] += ((values - mean) ** 2).sum() + delta ** 2 * stats['n'] * n / total
+        stats['mean'] += delta * n / total
+        stats['n'] = total
+        stats['digest'].add(values)
+
+    def table(self):
+        """
+        :return: DataFrame of the group stats, with the columns of the group_stats csv
+        """
+        records = []
+        for group, stats in self.groups.items():
+            digest = stats['digest']
+            sd = np.sqrt(stats['m2'] / (stats['n'] - 1)) if stats['n'] > 1 else np.nan
+            quantiles = digest.quantile([p / 100 for p in self.percentiles])
+            record = {'sim_type': group, 'n': stats['n'], f'mean_{self.value_column}': stats['mean'],
+                      f'sd_{self.value_column}': sd,
+                      f'rsd_{self.value_column}': sd / stats['mean'] if stats['mean'] != 0 else np.nan,
+                      f'min_{self.value_column}': digest.min, f'max_{self.value_column}': digest.max,
+                      f'median_{self.value_column}': digest.quantile(0.5)}
+            record.update({f'p{p}': value for p, value in zip(self.percentiles, quantiles)})
+            records.append(record)
+
+        return pd.DataFrame(records)
+
+    def boxplot_table(self):
+        """
+        Box plot data per group: quartiles, whiskers at the most extreme values within 1.5 IQR of the box (estimated
+        from the digest), and min, max and mean.
+
+        :return: DataFrame of the boxplot csv
+        """
+        records = []
+        for group, stats in self.groups.items():
+            digest = stats['digest']
+            q1, median, q3 = digest.quantile([0.25, 0.5, 0.75])
+            iqr = q3 - q1
+            records.append({'sim_type': group, 'n': stats['n'],
+                            'lower_whisker': max(digest.min, q1 - 1.5 * iqr), 'q1': q1, 'median': median, 'q3': q3,
+                            'upper_whisker': min(digest.max, q3 + 1.5 * iqr), 'min': digest.min, 'max': digest.max,
+                            'mean': stats['mean']})
+
+        return pd.DataFrame(records)
+
+
+def stream_group_stats(res_path, value_column='gwp', chunksize=1000000):
+    """
+    Streams a raw results csv in chunks and calculates its group stats in one pass.
+
+    :param res_path: raw results csv
+    :param value_column: results column to summarize
+    :param chunksize: number of rows read at once
+    :return: GroupStats
+    """
+    stats = GroupStats(value_column)
+    for chunk in pd.read_csv(res_path, usecols=[stats.group_column, value_column], chunksize=chunksize,
+                             dtype={stats.group_column: str}):
+        stats.add_frame(chunk)
+
+    return stats
+
+
+def write_group_stats(stats, res_path):
+    """
+    Writes the group stats and the boxplot data of a raw results csv. The files are saved in the results folder
+    of the studied process, next to the raw folder, as "<results name>-group_stats.csv" and
+    "<results name>-group_boxplot.csv".
+
+    :param stats: GroupStats of the results
+    :param res_path: raw results csv
+    :return: paths of the group stats and boxplot csv
+    """
+    results_dir, results_file = os.path.split(res_path)
+    if os.path.basename(results_dir) == 'raw':
+        results_dir = os.path.dirname(results_dir)
+    results_name = os.path.splitext(results_file)[0]
+    stats_path = os.path.join(results_dir, f'{results_name}-group_stats.csv')
+    boxplot_path = os.path.join(results_dir, f'{results_name}-group_boxplot.csv')
+    stats.table().to_csv(stats_path, index=False)
+    stats.boxplot_table().to_csv(boxplot_path, index=False)
+    print(f'\nGroup stats saved to {stats_path}')
+
+    return stats_path, boxplot_path
+
+
+"""CHECKPOINT FUNCTIONS"""
+
+active_checkpoint = None  # checkpoint journal that records product systems created by new_product_system
+
+
+class Checkpoint:
+    """
+    Checkpoint journal for the simulations of one substitution sheet. It records the results csv and how far it has
+    been written, finished phases and iterations, the random number generator state and the product systems that were
+    created but not deleted yet. An interrupted run can then skip finished work and continue mid-phase.
+    """
+
+    def __init__(self, path, resume=True, signature=None):
+        """
+        :param path: path of the json journal
+        :param resume: continue from an existing journal; if False, the journal is started over
+        :param signature: optional signature of the inputs and settings, see input_signature. An existing journal with
+            a different signature is started over.
+        """
+        self.path = os.path.abspath(path)  # also written on exit, see ResultsWriter.mark
+        self.state = {'res_path': None, 'csv_offset': None, 'phases': {}, 'rng': None, 'product_systems': [],
+                      'finished': False, 'signature': signature}
+        if os.path.exists(path):
+            with open(path) as f:
+                previous = json.load(f)
+            if resume and signature is not None and previous.get('signature') != signature:
+                print(f'!! The substitution sheet, its provider sheets or the settings changed since {path} was '
+                      f'written. Starting over.')
+                resume = False
+            if resume:
+                self.state = previous
+            else:
+                self.state['product_systems'] = previous['product_systems']  # still clean those up
+        self.rng = self.state['rng']  # random state of the last save, also if it is not journaled yet
+        self.resumed = self.state['res_path'] is not None
+
+    @property
+    def finished(self):
+        return self.state['finished']
+
+    def write(self):
+        """
+        Writes the journal. The file is replaced in one step, so a crash never leaves a half written journal.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.path)
+
+    def start(self, res_path):
+        self.state['res_path'] = res_path
+        self.write()
+
+    def phase(self, name):
+        """
+        :param name: name of a phase, e.g. 'base' or 'mca'
+        :return: mutable state dictionary of the phase
+        """
+        return self.state['phases'].setdefault(name, {'progress': 0, 'done': False})
+
+    def progress(self, name):
+        return self.phase(name)['progress']
+
+    def done(self, name):
+        return self.phase(name)['done']
+
+    def save(self, name, results, progress=None, done=False, finished_runs=None):
+        """
+        Records the progress of a phase together with the results csv offset and the random number generator state.
+
+        :param name: name of the phase
+        :param results: ResultsWriter of the run; the progress is journaled at its next flush, see ResultsWriter.mark
+        :param progress: number of finished iterations of the phase
+        :param done: True if the phase is finished
+        :param finished_runs: optional list of the numbers of the finished iterations, for phases whose iterations
+            finish out of order
+        """
+        rng = get_rng_state()
+        self.rng = rng
+
+        def commit(offset, last):
+            phase = self.phase(name)
+            if progress is not None:
+                phase['progress'] = progress
+            if finished_runs is not None:
+                phase['finished_runs'] = finished_runs
+            phase['done'] = done
+            self.state['csv_offset'] = offset
+            self.state['rng'] = rng
+            if last:
+                self.write()
+
+        # Buffered rows are not flushed for the journal. The progress is journaled once the results writer has written
+        # the rows of the saved iterations, so the journal never records more than the csv holds.
+        results.mark(commit)
+
+    def restore_rng(self):
+        """
+        Restores the random number generator state of the last save, so a phase continues with the same random stream.
+        """
+        if self.rng is not None:
+            set_rng_state(self.rng)
+
+    def finish(self):
+        self.state['finished'] = True
+        self.write()
+
+    def track(self, product_system):
+        if product_system.id not in self.state['product_systems']:
+            self.state['product_systems'].append(product_system.id)
+            self.write()
+
+    def untrack(self, product_system):
+        if product_system.id in self.state['product_systems']:
+            self.state['product_systems'].remove(product_system.id)
+            self.write()
+
+    def worker_journal(self, port):
+        """
+        :param port: IPC server port of a parallel MCA worker
+        :return: journal of the product systems the worker creates on its own openLCA server
+        """
+        journal = Checkpoint(f'{os.path.splitext(self.path)[0]}.port-{port}.json')
+        journal.state['port'] = port
+        journal.write()
+
+        return journal
+
+    def worker_journals(self):
+        """
+        :return: paths of the worker journals that are left, see worker_journal
+        """
+        return sorted(glob.glob(f'{glob.escape(os.path.splitext(self.path)[0])}.port-*.json'))
+
+    def orphans(self):
+        """
+        :return: True if an interrupted run left product systems behind, in this journal or a worker journal
+        """
+        return len(self.state['product_systems']) > 0 or len(self.worker_journals()) > 0
+
+    def clean_up(self, ipc_client=None):
+        """
+        Deletes product systems that an interrupted run created but never deleted, also the ones of parallel MCA
+        workers on their own openLCA servers.
+        :param ipc_client: client of the openLCA server of this journal, the main client by default
+        """
+        ipc_client = ipc_client if ipc_client is not None else client
+        for ps_id in list(self.state['product_systems']):
+            ps_ref = ipc_client.get_descriptor(olca.ProductSystem, ps_id)
+            if ps_ref is not None:
+                print(f'	Deleting orphaned product system {ps_id}')
+                ipc_client.delete(ps_ref)
+            self.state['product_systems'].remove(ps_id)
+        self.write()
+
+        for path in self.worker_journals():
+            journal = Checkpoint(path)
+            port = journal.state['port']
+            try:
+                # replayed runs answer every port from the same recording
+                journal.clean_up(client if getattr(client, 'replay_args', None) else ipc.Client(port))
+            except Exception as error:
+                print(f'!! Could not delete the product systems left on port {port}, see {path}: {error}')
+                continue
+            os.remove(path)
+
+
+def input_signature(sub_sheet_path, settings):
+    """
+    :param sub_sheet_path: path of the substitution sheet
+    :param settings: dictionary of the settings that change the results and the openLCA server
+    :return: hash of the substitution sheet, the provider sheets it lists and the settings
+    """
+    paths = [sub_sheet_path]
+    if os.path.exists(sub_sheet_path):
+        sub_sheet = pd.read_excel(sub_sheet_path)
+        if 'provider_sheet' in sub_sheet:
+            paths += [f'./providers/{sheet_name}.xlsx'
+                      for sheet_name in sorted(sub_sheet['provider_sheet'].dropna().astype(str).unique())]
+
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode())
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+
+    return digest.hexdigest()
+
+
+def get_rng_state():
+    """
+    :return: json serializable state of the numpy and python random number generators
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    version, internal_state, gauss_next = random.getstate()
+    return {'numpy': [name, keys.tolist(), pos, has_gauss, cached_gaussian],
+            'random': [version, list(internal_state), gauss_next]}
+
+
+def set_rng_state(state):
+    """
+    :param state: random number generator state from get_rng_state
+    """
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    version, internal_state, gauss_next = state['random']
+    random.setstate((version, tuple(internal_state), gauss_next))
+
+
+def delete_ps(product_system):
+    """
+    Deletes a product system and removes it from the checkpoint journal.
+    """
+    client.delete(product_system)
+    if active_checkpoint is not None:
+        active_checkpoint.untrack(product_system)
+
+
+"""PARALLEL SIMULATION FUNCTIONS"""
+
+worker_state = dict()
+
+
+def run_parallel_mca(ports, runs, context, stop=None):
+    """
+    Runs MCA iterations in worker processes, one per openLCA IPC server. Iteration numbers are handed out through one
+    task queue, so whichever worker is free takes the next one. At the end, and also after an error, every worker gets
+    exactly one stop signal, deletes its product systems and reports back before it exits.
+    :param ports: list of IPC server ports. Each server must run on its own copy of the database.
+    :param runs: list of the numbers of the MCA iterations to run
+    :param context: dictionary of substitution data shared by all iterations, see run_mca_iteration
+    :param stop: optional function that returns True once no more iterations should be started, e.g. when the
+        results converged. Iterations that are already running are finished and returned.
+    :return: generator of iteration number and result rows, one per finished iteration, in the order they finish
+    """
+    tasks = multiprocessing.Queue()
+    messages = multiprocessing.Queue()
+    workers = {}
+    for port in ports:
+        workers[port] = multiprocessing.Process(target=mca_worker, args=(port, context, tasks, messages), daemon=True)
+        workers[port].start()
+
+    # Only two iterations per worker are queued at a time, so that a stop does not leave a long queue behind.
+    next_run = 0
+    running = 0
+    try:
+        while True:
+            while next_run < len(runs) and running < 2 * len(ports) and not (stop is not None and stop()):
+                tasks.put(runs[next_run])
+                next_run += 1
+                running += 1
+            if running == 0:
+                break
+            kind, port, payload = receive_message(messages, workers)
+            if kind == 'error':
+                raise RuntimeError(f'MCA iteration failed on port {port}:\n{payload}')
+            running -= 1
+            yield payload
+    finally:
+        stop_workers(workers, tasks, messages)
+
+
+def receive_message(messages, workers, timeout=None):
+    """
+    Waits for the next message of the MCA workers, see mca_worker.
+    :param messages: message queue of the workers
+    :param workers: dictionary of port -> worker process
+    :param timeout: seconds to wait; None waits as long as workers are alive
+    :return: message kind, port, payload
+    """
+    waited = 0.0
+    while True:
+        try:
+            return messages.get(timeout=1.0)
+        except queue.Empty:
+            waited += 1.0
+            if not all(worker.is_alive() for worker in workers.values()) and messages.empty():
+                dead = [port for port, worker in workers.items() if not worker.is_alive()]
+                raise RuntimeError(f'The MCA worker on port {dead[0]} stopped without reporting back.')
+            if timeout is not None and waited >= timeout:
+                raise TimeoutError(f'No message from the MCA workers in {timeout} seconds.')
+
+
+def stop_workers(workers, tasks, messages):
+    """
+    Stops the MCA workers. Iterations that were queued but not started are dropped, then every worker gets one stop
+    signal and reports back once its product systems are deleted. Rows of iterations that were still running are
+    dropped too; they are not journaled, so a resumed MCA runs them again.
+    :param workers: dictionary of port -> worker process
+    :param tasks: task queue of the workers
+    :param messages: message queue of the workers
+    """
+    while True:
+        try:
+            tasks.get_nowait()
+        except queue.Empty:
+            break
+    for port in workers:
+        tasks.put(None)
+
+    open_workers = dict(workers)
+    while len(open_workers) > 0:
+        try:
+            kind, port, payload = receive_message(messages, open_workers)
+        except RuntimeError:
+            for port, worker in list(open_workers.items()):
+                if not worker.is_alive():
+                    print(f'!! The MCA worker on port {port} stopped before deleting its product systems. Check the '
+                          f'database on port {port}.')
+                    del open_workers[port]
+            continue
+        if kind == 'closed':
+            tracer.merge(payload)
+            open_workers.pop(port, None)
+        elif kind == 'error':
+            print(f'!! MCA worker on port {port}: {payload}')
+
+    for worker in workers.values():
+        worker.join()
+
+
+def mca_worker(port, context, tasks, messages):
+    """
+    Worker process of the parallel MCA. Runs the iteration numbers it takes from the task queue until it takes a stop
+    signal (None), then deletes its product systems. Messages are (kind, port, payload) tuples: ('rows', port,
+    (iteration number, rows)) per iteration, ('error', port, traceback) if an iteration fails and ('closed', port,
+    trace) once the worker is done.
+    """
+    trace = None
+    try:
+        init_worker(port, context)
+        while True:
+            run = tasks.get()
+            if run is None:
+                break
+            try:
+                messages.put(('rows', port, run_mca_iteration(run)))
+            except Exception:
+                messages.put(('error', port, traceback.format_exc()))
+    except Exception:
+        messages.put(('error', port, traceback.format_exc()))
+    finally:
+        try:
+            trace = close_worker()
+        finally:
+            messages.put(('closed', port, trace))
+
+
+def init_worker(port, context):
+    """
+    Initializes a worker process of the parallel MCA. Each worker talks to its own openLCA IPC server and keeps its
+    own process cache, product system and random number stream.
+    """
+    global client, active_checkpoint
+    # product systems are journaled per worker, they live on the openLCA server of the worker
+    active_checkpoint = Checkpoint(context['journal']).worker_journal(port)
+    client = ReplayClient(*context['replay']) if context.get('replay') else ipc.Client(port)
+    if context.get('trace') is not None:
+        tracer.reset(f'worker on port {port}')  # a forked worker starts with the events of the main process
+        tracer.label = context['trace']
+        tracer.enable()
+        client = TracedClient(client)
+    for cache in [cache_process, cache_descriptors, cache_flows, cache_lcia, cache_lcia_factors]:
+        cache.clear()  # compiled provider sheets are kept, they do not depend on the server
+    cache_ref_flows.update(context['provider_index'])  # all servers run copies of the same database
+
+    worker_state.clear()
+    worker_state.update(context)
+    worker_state['port'] = port
+    worker_state['wired_dict'] = None
+    worker_state['ps_manager'] = ProductSystemManager(context['main_process_json'], context['prov_sheet'],
+                                                      in_place=context['update_ps_in_place'])
+    worker_state['pipeline'] = CalculationPipeline(context['lcia_methods'], context['pipeline_depth'])
+
+
+def close_worker():
+    """
+    Deletes the product systems of a worker process once its MCA iterations are finished.
+    :return: trace of the worker, see Tracer.export, or None if tracing is off
+    """
+    if 'ps_manager' in worker_state:
+        worker_state['ps_manager'].close()
+    if active_checkpoint is not None and len(active_checkpoint.state['product_systems']) == 0:
+        os.remove(active_checkpoint.path)  # nothing left to clean up
+
+    return tracer.export() if tracer.enabled else None
+
+
+def run_mca_iteration(run):
+    """
+    Runs one MCA iteration in a worker process: picks providers, modifies processes, links the product system of the
+    worker and runs all parameter redefinition loops against it. The random streams are seeded from the iteration
+    number, so the iteration draws the same values on any worker and when it is run again after a resume.
+    :param run: iteration number
+    :return: iteration number, list of result rows for the results csv
+    """
+    run_seed = np.random.SeedSequence([worker_state['run_seed'], run]).generate_state(2)
+    np.random.seed(int(run_seed[0]))
+    random.seed(int(run_seed[1]))
+    prov_sheet = worker_state['prov_sheet']
+    provider_sheets = worker_state['provider_sheets']
+    param_runs = worker_state['param_runs']
+    print(f"\n\nStarting iteration {run + 1} on port {worker_state['port']} ========================================")
+
+    print(f'\nPicking providers')
+    provider_design = worker_state['provider_design']
+    with tracer.span('provider pick'):
+        provider_dict = pick_providers(provider_sheets,
+                                       uniforms=None if provider_design is None else provider_design[run])
+
+    run_key = provider_key(provider_dict)
+    wired_dict = worker_state['wired_dict']
+    if wired_dict is None or run_key != provider_key(wired_dict):
+        print(f'\nModifying all relevant processes.')
+        with tracer.span('rewire'):
+            modify_processes(prov_sheet, provider_dict,
+                             previous_dict=wired_dict if worker_state['minimize_rewiring'] else None,
+                             preloaded_provider_dict=worker_state['provider_index'])
+        worker_state['wired_dict'] = provider_dict
+    else:
+        print(f'\nProcesses already modified for this provider combination.')
+
+    model_ref = None
+    if worker_state['calc_using_ps']:
+        with tracer.span('product system'):
+            model_ref = worker_state['ps_manager'].acquire(run_key)
+
+    providers_picked = [provider_dict[sheet].name for sheet in provider_sheets]
+    rows = []
+    session = None
+    pipeline = worker_state['pipeline']
+    try:
+        if worker_state['olca_simulator']:
+            if 'simulation_setup' not in worker_state:
+                worker_state['simulation_setup'] = simulator_parameters(worker_state['param_sheet'])
+            if worker_state['simulation_setup'] is not None:
+                param_picked, parameter_redefs = worker_state['simulation_setup']
+                session = SimulatorSession(model_ref, worker_state['lcia_methods'], parameter_redefs)
+        if session is None and worker_state['param_design'] is None:
+            with tracer.span('parameter draw'):
+                param_block = draw_parameters(worker_state['param_table'], param_runs)
+        elif session is None:
+            with tracer.span('parameter draw'):
+                param_block = quantile_parameters(worker_state['param_table'],
+                                                  worker_state['param_design'][run * param_runs:(run + 1) * param_runs])
+
+        for param_loop in range(param_runs):
+            counter = run * param_runs + param_loop + 1
+            if session is not None:
+                with tracer.span('calculate'):
+                    impact_results = session.get_results(counter)
+                rows.append(providers_picked + param_picked + impact_results + ["mca"])
+            else:
+                print(f"\nPicking parameters. Parameter redefinition loop {param_loop + 1} / {param_runs} ----\n")
+                with tracer.span('parameter pick'):
+                    param_picked, parameter_redefs = pick_parameters(worker_state['param_sheet'],
+                                                                     param_block[param_loop])
+                rows += pipeline.submit(model_ref, parameter_redefs, counter, providers_picked + param_picked, "mca")
+        rows += pipeline.drain()
+    finally:
+        pipeline.discard()  # calculations left behind by an error
+        if session is not None:
+            session.dispose()
+        if model_ref is not None:
+            worker_state['ps_manager'].release(model_ref)
+
+    return run, rows
+
+
+"""CACHING FUNCTIONS"""
+
+
+class LRUCache:
+    """
+    Size bounded cache that evicts the least recently used entries. Entries remember the version and last change of
+    the cached openLCA object, so fetching a newer copy of an object replaces (invalidates) an outdated entry. Hits,
+    misses, evictions and invalidations are counted, see print_cache_stats.
+    """
+
+    def __init__(self, name, maxsize=None):
+        """
+        :param name: name of the cache for the statistics
+        :param maxsize: maximum number of entries, None for no limit
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()  # preload_ref_flows fills the caches from several threads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.writes = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def store(self, key, value, write=False):
+        """
+        :param key: cache key
+        :param value: object to cache
+        :param write: True if the object was just written to OLCA (write-through), False if it was read from OLCA
+        """
+        with self.lock:
+            if write:
+                self.writes += 1
+            elif key in self.entries and model_version(self.entries[key]) != model_version(value):
+                self.invalidations += 1
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self._evict()
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def revalidate(self, fetch):
+        """
+        Fetches every cached object again and replaces entries whose version or last change differ, e.g. because the
+        database was edited outside of this script.
+        :param fetch: function that fetches the object of a key from OLCA
+        :return: number of invalidated entries
+        """
+        invalidations = self.invalidations
+        for key in list(self.entries):
+            self.store(key, fetch(key))
+        return self.invalidations - invalidations
+
+    def stats(self):
+        return {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations, 'writes': self.writes}
+
+    def _evict(self):
+        while self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+def model_version(model):
+    """
+    :param model: OLCA object
+    :return: version and last change of the object, None for objects without them (e.g. references)
+    """
+    return getattr(model, 'version', None), getattr(model, 'last_change', None)
+
+
+cache_process = LRUCache('processes', maxsize=2000)
+cache_descriptors = LRUCache('descriptors', maxsize=20000)
+cache_flows = LRUCache('flows', maxsize=5000)
+cache_lcia = dict()
+cache_ref_flows = dict()
+cache_provider_sheets = dict()
+cache_lcia_factors = dict()
+cache_name_index = dict()
+cache_samples = dict()
+cache_parameters = dict()
+
+
+def fetch_process_json(olca_uuid):
+    """
+    Caches process json to speed up loading of repeated processes.
+
+    :param olca_uuid:
+    :return: olca_json
+    """
+    # print(f"Checking for {olca_uuid} in cache.")
+    process_json = cache_process.get(olca_uuid)
+    if process_json is None:
+        process_json = client.get(olca.Process, olca_uuid)
+        cache_process.store(olca_uuid, process_json)
+    #     print(f"Added {olca_uuid} to cache.")
+    # else:
+    #     print(f"{olca_uuid} already in cache.")
+
+    return process_json
+
+
+def put_process(process_json):
+    """
+    Updates a process in OLCA and writes it through to the process cache, so the cache always holds what the server
+    holds. If the update fails, the cached process is dropped and fetched again on its next use.
+
+    :param process_json: modified process; it must not be changed anymore after it was put
+    :return: olca_ref, or None if the update failed
+    """
+    process_json.last_change = datetime.now(pytz.utc).isoformat()  # log current date and time
+    process_ref = client.put(process_json)
+    if process_ref is None:
+        cache_process.discard(process_json.id)
+        print(f'\t\t!! Updating "{process_json.name}" in OLCA failed. !!')
+    else:
+        cache_process.store(process_json.id, process_json, write=True)
+
+    return process_ref
+
+
+def fetch_descriptor(model_type, olca_uuid):
+    """
+    Caches references (descriptors) of processes and other entities that are not modified by this script.
+
+    :param model_type: olca type, e.g. olca.Process
+    :param olca_uuid:
+    :return: olca_ref
+    """
+    key = (model_type.__name__, olca_uuid)
+    descriptor = cache_descriptors.get(key)
+    if descriptor is None:
+        descriptor = client.get_descriptor(model_type, olca_uuid)
+        cache_descriptors.store(key, descriptor)
+
+    return descriptor
+
+
+def print_cache_stats():
+    """
+    Prints hit, miss, eviction and invalidation counters of the bounded caches.
+    """
+    print(f'\nCache statistics:')
+    for cache in [cache_process, cache_descriptors, cache_flows]:
+        stats = cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / lookups if lookups > 0 else 0
+        print(f"\t{cache.name}: {stats['size']} / {stats['maxsize']} entries, {stats['hits']} hits, "
+              f"{stats['misses']} misses ({hit_rate:.0%} hit rate), {stats['evictions']} evictions, "
+              f"{stats['invalidations']} invalidations, {stats['writes']} writes")
+
+
+def fetch_flow(olca_name):
+    """
+    Caches flow json to speed up loading of repeated processes.
+
+    :param olca_name:
+    :return: olca_json
+    """
+    # print(f"Checking for {olca_uuid} in cache.")
+    flow_ref = cache_flows.get(olca_name)
+    if flow_ref is None:
+        flow_ref = find_ref(olca.Flow, olca_name)
+        cache_flows.store(olca_name, flow_ref)
+
+    return flow_ref
+
+
+def fetch_ref_flows(olca_uuid):
+    """
+    Caches the reference and the quantitative reference flow of a provider process, so that linking a provider in
+    modify_exchanges does not need to fetch the full provider process again.
+
+    :param olca_uuid: uuid of the provider process
+    :return: dictionary with the provider reference and the name, uuid, flow property, unit and reference of its
+        reference flow
+    """
+    if olca_uuid not in cache_ref_flows:
+        provider_json = client.get(olca.Process, olca_uuid)
+        provider_info = {'ProviderRef': fetch_descriptor(olca.Process, olca_uuid),
+                         'ProviderName': provider_json.name}
+        for i in provider_json.exchanges:
+            if i.is_quantitative_reference:
+                provider_info['FlowName'] = i.flow.name
+                provider_info['FlowUuid'] = i.flow.id
+                provider_info['FlowType'] = i.flow_property.name
+                provider_info['FlowUnit'] = i.unit.name
+                provider_info['FlowRef'] = i.flow
+        cache_ref_flows[olca_uuid] = provider_info
+
+    return cache_ref_flows[olca_uuid]
+
+
+def preload_ref_flows(provider_sheets, workers=8):
+    """
+    Fetches the reference flows of every provider listed in the provider sheets with parallel requests, so that
+    rewiring processes never has to fetch a full provider process.
+
+    :param provider_sheets: list of provider sheet names from the providers folder
+    :param workers: number of parallel requests to the openLCA IPC server
+    :return: dictionary of provider uuid -> provider information, see fetch_ref_flows
+    """
+    preload_start = timeit.default_timer()
+    provider_ids = set()
+    for sheet_name in provider_sheets:
+        table = fetch_provider_sheet(f'./providers/{sheet_name}.xlsx')['table']
+        for index, row in table.drop_duplicates(subset=['process_uuid', 'name']).iterrows():
+            # If UUID is provided, use it, else get REF by Name.
+            if isinstance(row['process_uuid'], str):
+                provider_ids.add(row['process_uuid'])
+            else:
+                provider_ref = find_ref(olca.Process, row['name'], row['location'])
+                if provider_ref is not None:
+                    provider_ids.add(provider_ref.id)
+    missing = [provider_id for provider_id in provider_ids if provider_id not in cache_ref_flows]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(fetch_ref_flows, missing))
+    preload_time = humanfriendly.format_timespan(timeit.default_timer() - preload_start)
+    print(f'\tIndexed the reference flows of {len(provider_ids)} providers in {preload_time}.')
+
+    return {provider_id: cache_ref_flows[provider_id] for provider_id in provider_ids}
+
+
+def fetch_provider_sheet(path):
+    """
+    Caches compiled provider sheets so that market share spreadsheets are only read from Excel once per run. A sheet
+    is reloaded when its file modification time or size changes.
+
+    :param path: Excel sheet path
+    :return: dictionary with the cleaned provider table, its provider columns as arrays, and cumulative shares
+    """
+    path = os.path.normpath(path)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    if path not in cache_provider_sheets or cache_provider_sheets[path]['signature'] != signature:
+        """Load provider sheet and remove unnecessary rows."""
+        prod_stats = pd.read_excel(path).dropna(subset=["amount"])
+        prod_stats = prod_stats.replace(r'^\s+$', np.nan, regex=True)  # Replace empties and spaces with "nan"
+        prod_stats = prod_stats[~prod_stats['skip'].isin(['Yes'])]  # Skip any marked rows
+        prod_stats = prod_stats.reset_index(drop=True)  # Reindex the dataframe for consistency in calling by index
+
+        cache_provider_sheets[path] = {
+            'path': path,
+            'signature': signature,
+            'table': prod_stats,
+            'process_uuid': prod_stats['process_uuid'].to_numpy(dtype=object),
+            'name': prod_stats['name'].to_numpy(dtype=object),
+            'location': prod_stats['location'].to_numpy(dtype=object),
+            'shares': {},  # region selection -> (rows, cumulative shares), see provider_shares
+        }
+
+    return cache_provider_sheets[path]
+
+
+def fetch_lcia_method(olca_name):
+    """
+    Caches lcia method reference to speed up loading of methods.
+    :param olca_name:
+    :return: olca_ref
+    """
+    # print(f"Checking for {olca_uuid} in cache.")
+    if olca_name not in cache_lcia:
+        cache_lcia[olca_name] = find_ref(olca.ImpactMethod, olca_name)
+
+    return cache_lcia[olca_name]
+
+
+def find_ref(model_type, name, location=None):
+    """
+    Looks up an entity by name in the local name index (see fetch_name_index) instead of searching the database on
+    the server with client.find.
+
+    :param model_type: olca.Process, olca.Flow, olca.Unit or olca.ImpactMethod
+    :param name: name of the entity
+    :param location: optional location code, used to choose between entities with the same name
+    :return: olca_ref, or None if there is no entity with that name. Raises a ValueError listing the candidates if
+        several entities match, so that the wanted one can be set by its uuid in the sheet.
+    """
+    type_name = model_type.__name__
+    refs = fetch_name_index(type_name).get(name, [])
+    if not index_is_current(type_name, refs):
+        # the database changed since the index was built; every type is indexed again at most once per run
+        if type_name not in cache_name_index['refreshed']:
+            print(f'The {type_name} name index is out of date for "{name}". Indexing {type_name} names again.')
+        refs = fetch_name_index(type_name, refresh=True).get(name, [])
+    if len(refs) == 0:
+        return None
+
+    if len(refs) > 1 and isinstance(location, str):
+        refs = [r for r in refs if str(r.get('location', '')).lower() == location.strip().lower()] or refs
+    if len(refs) > 1:
+        candidates = ', '.join(f"{r['@id']} ({r.get('location', 'no location')})" for r in refs)
+        raise ValueError(f'{len(refs)} entities of type {type_name} are named "{name}": {candidates}. Check the sheet '
+                         f'columns location, or set the uuid of the one to use, e.g. in column process_uuid.')
+
+    return olca.Ref.from_dict(refs[0])
+
+
+def index_is_current(type_name, refs):
+    """
+    Checks the entities of a name from the name index against the database by id, once per entity and session, so
+    that entities deleted or renamed since the index was built are not used. Types indexed in this session are
+    current, and units are only checked by indexing them again when a name is missing.
+
+    :param type_name: name of the olca type, e.g. 'Process'
+    :param refs: list of olca reference dictionaries of one name in the name index
+    :return: False if there are no entities of the name or one of them was deleted or renamed, else True
+    """
+    if len(refs) == 0:
+        return False
+    if type_name in cache_name_index['refreshed'] or type_name == 'Unit':
+        return True
+    checked = cache_name_index['checked']
+    for ref in refs:
+        if ref['@id'] not in checked:
+            descriptor = client.get_descriptor(getattr(olca, type_name), ref['@id'])
+            checked[ref['@id']] = descriptor is not None and descriptor.name == ref.get('name')
+        if not checked[ref['@id']]:
+            return False
+    return True
+
+
+def fetch_name_index(type_name, refresh=False):
+    """
+    Caches the names of all entities of a type in the openLCA database, so lookups by name are dictionary hits. The
+    index is kept on disk per IPC server, so it is only built once per database. A type is indexed again (at most once
+    per session) when a name is not found or one of its entities was deleted or renamed (see index_is_current), which
+    picks up the changes to the database since the index was built. Delete the index file to rebuild it completely.
+
+    :param type_name: name of the olca type, e.g. 'Process'
+    :param refresh: index the type again if it has not been refreshed in this session yet
+    :return: dictionary of name -> list of olca reference dictionaries
+    """
+    if cache_name_index.get('url') != client.url:
+        file_name = re.sub(r'[^A-Za-z0-9]+', '_', client.url).strip('_')
+        path = os.path.join("results files", "name index", f"{file_name}.json")
+        cache_name_index.clear()
+        cache_name_index.update({'url': client.url, 'path': path, 'types': {}, 'refreshed': set(), 'checked': {}})
+        if os.path.exists(path):
+            with open(path) as f:
+                cache_name_index['types'] = json.load(f)
+
+    types = cache_name_index['types']
+    if type_name not in types or (refresh and type_name not in cache_name_index['refreshed']):
+        print(f'Indexing {type_name} names of the openLCA database.')
+        if type_name == 'Unit':
+            # units are not stored on their own but in unit groups
+            refs = [{'@type': 'Unit', '@id': unit.id, 'name': unit.name}
+                    for group in client.get_all(olca.UnitGroup) for unit in group.units]
+        else:
+            refs = [ref.to_dict() for ref in client.get_descriptors(getattr(olca, type_name))]
+        names = {}
+        for ref in refs:
+            names.setdefault(ref.get('name'), []).append(ref)
+        types[type_name] = names
+        cache_name_index['refreshed'].add(type_name)
+
+        path = cache_name_index['path']
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(types, f)
+        os.replace(temp_path, path)
+
+    return types[type_name]
+
+
+def fetch_sample(param_string):
+    """
+    Caches compiled sample strings, so every sample string of a substitution sheet is only parsed once.
+
+    :param param_string: string from substitution sheet column "sample"
+    :return: compiled sample, see compile_sample
+    """
+    if param_string not in cache_samples:
+        cache_samples[param_string] = compile_sample(param_string)
+
+    return cache_samples[param_string]
+
+
+def fetch_lcia_factors(olca_name):
+    """
+    Caches the characterization factors of an lcia method for local characterization. Factors are added from
+    calculation results by update_lcia_factors, for the elementary flows the results contain.
+    :param olca_name:
+    :return: dictionary with the impact categories, an elementary flow index and the characterization factor matrix
+    """
+    if olca_name not in cache_lcia_factors:
+        cache_lcia_factors[olca_name] = {
+            'categories': [],  # impact category refs, rows of the matrix
+            'index': {},  # elementary flow key -> column of the matrix
+            'factors': {},  # impact category uuid -> {column: characterization factor}
+            'matrix': None,
+            'valid': True,  # False if local characterization did not reproduce the openLCA results
+        }
+
+    return cache_lcia_factors[olca_name]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == '--group-stats':
+        # post-process raw results csv files: python oi_0.3.3.py --group-stats <raw results csv> ...
+        for raw_path in sys.argv[2:]:
+            write_group_stats(stream_group_stats(raw_path), raw_path)
+    elif len(sys.argv) > 2 and sys.argv[1] == '--record':
+        # record the openLCA requests of a run for replays: python oi_0.3.3.py --record <recording file>
+        client = RecordingClient(8080)
+        try:
+            main()
+        finally:
+            # the name index is saved with the recording, so a replay also finds names indexed before the recording
+            client.save(sys.argv[2], cache_name_index['types'] if cache_name_index.get('url') == client.url else None)
+    elif len(sys.argv) > 2 and sys.argv[1] == '--replay':
+        # run without openLCA: python oi_0.3.3.py --replay <recording file> [<seconds per request> | recorded]
+        client = ReplayClient(sys.argv[2], parse_latency(sys.argv[3]) if len(sys.argv) > 3 else None)
+        main()
+        print(client.recording.summary())
+    elif len(sys.argv) > 2 and sys.argv[1] == '--benchmark':
+        # python oi_0.3.3.py --benchmark <json file> [<sheets>x<rows>x<runs> ...] [<seconds per request>]
+        sizes = [tuple(int(n) for n in arg.split('x')) for arg in sys.argv[3:] if 'x' in arg]
+        latency = next((parse_latency(arg) for arg in sys.argv[3:] if 'x' not in arg), None)
+        script = sys.modules[__name__]  # the benchmarks run the pipeline functions of this script
+        results = benchmark_pipeline(script, sizes or [(5, 20, 20), (20, 80, 20), (5, 20, 100)], latency)
+        write_benchmark(results, sys.argv[2], latency, label=os.path.splitext(os.path.basename(__file__))[0])
+    elif len(sys.argv) > 2 and sys.argv[1] == '--serve-recording':
+        # mock openLCA IPC servers: python oi_0.3.3.py --serve-recording <recording file> <latency> [<port> ...]
+        latency = parse_latency(sys.argv[3]) if len(sys.argv) > 3 else None
+        servers = serve_recording(sys.argv[2], [int(port) for port in sys.argv[4:]] or [8080], latency)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print(servers[0].recording.summary())
+    else:
+        main()
 
@@ -0,0 +1,4 @@
+"""
+Development tools of the openIMPACT simulation script: record and replay of openLCA requests (replay), tracing of the
+pipeline stages (trace) and benchmarks of the pipeline stages (bench). The simulations themselves do not need them.
+"""
@@ -0,0 +1,278 @@
+"""
+Benchmarks of the simulation pipeline stages against a local stand-in openLCA server (see replay.serve_recording), on
+synthetic provider sheets and substitution rows. Used by the --benchmark option of the script; results are added to a
+JSON history file so that regressions between versions are reported.
+"""
+import contextlib
+import gzip
+import json
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import olca_ipc as ipc
+import olca_schema as olca
+import pandas as pd
+import pytz
+
+from oi_tools.replay import serve_recording
+
+
+def benchmark_inputs(sheets, rows, providers=10):
+    """
+    Writes synthetic inputs of a benchmark to the working directory: a provider sheet with providers rows for each of
+    the sheets, and a recording for the stand-in server, see serve_recording. Every substitution row links one flow of
+    a process to a provider sheet; processes have one input flow per provider sheet.
+
+    :param sheets: number of provider sheets
+    :param rows: number of substitution rows, also used as the number of parameters
+    :param providers: number of providers per provider sheet
+    :return: path of the recording, substitution rows with a provider sheet, substitution rows with a parameter,
+        main process reference
+    """
+    def process(process_uuid, name, ref_flow, inputs):
+        exchanges = [{'@type': 'Exchange', 'internalId': 1, 'amount': 1.0, 'isInput': False,
+                      'isQuantitativeReference': True, 'flow': {'@type': 'Flow', '@id': ref_flow, 'name': ref_flow},
+                      'flowProperty': {'@type': 'FlowProperty', 'name': 'Mass'}, 'unit': {'@type': 'Unit', 'name': 'kg'}}]
+        for position, flow in enumerate(inputs):
+            exchanges.append({'@type': 'Exchange', 'internalId': position + 2, 'amount': 1.0 + position, 'isInput': True,
+                              'flow': {'@type': 'Flow', '@id': flow, 'name': flow},
+                              'flowProperty': {'@type': 'FlowProperty', 'name': 'Mass'},
+                              'unit': {'@type': 'Unit', 'name': 'kg'}})
+        return {'@type': 'Process', '@id': process_uuid, 'name': name, 'exchanges': exchanges}
+
+    flows = [f'benchmark flow {sheet}' for sheet in range(sheets)]
+    provider_sheets = [f'benchmark_sheet_{sheet}' for sheet in range(sheets)]
+    calls = []
+    os.makedirs('providers', exist_ok=True)
+    for sheet, sheet_name in enumerate(provider_sheets):
+        table = pd.DataFrame({
+            'process_uuid': [f'benchmark-provider-{sheet}-{n}' for n in range(providers)],
+            'name': [f'benchmark provider {sheet}-{n}' for n in range(providers)],
+            'location': 'US',
+            'amount': np.arange(1, providers + 1, dtype=float),
+            'skip': 'No',
+        })
+        table.to_excel(os.path.join('providers', f'{sheet_name}.xlsx'), index=False)
+        for index, row in table.iterrows():
+            calls.append(['data/get', {'@type': 'Process', '@id': row['process_uuid']},
+                          process(row['process_uuid'], row['name'], flows[sheet], []), None, 0.0])
+
+    process_count = max(1, -(-rows // sheets))
+    for n in range(process_count):
+        calls.append(['data/get', {'@type': 'Process', '@id': f'benchmark-process-{n}'},
+                      process(f'benchmark-process-{n}', f'benchmark process {n}', f'benchmark product {n}', flows),
+                      None, 0.0])
+
+    prov_sheet = pd.DataFrame({
+        'uuid': [f'benchmark-process-{row // sheets}' for row in range(rows)],
+        'find_flow': [f'"{flows[row % sheets]}"' for row in range(rows)],
+        'provider_sheet': [provider_sheets[row % sheets] for row in range(rows)],
+    })
+    samples = ['uniform; min=0.5; max=1.5', 'triangular; min=0.5; mode=1.0; max=2.0', 'normal; mean=1.0; sd=0.1',
+               'lognormal; gmean=1.0; gsd=1.2', 'list; 0.5, 1.0, 1.5']
+    param_sheet = pd.DataFrame({
+        'uuid': [f'benchmark-process-{row % process_count}' for row in range(rows)],
+        'name': [f'benchmark process {row % process_count}' for row in range(rows)],
+        'parameter': [f'p{row}' for row in range(rows)],
+        'sample': [samples[row % len(samples)] for row in range(rows)],
+    })
+
+    # one TRACI calculation, the stand-in server answers every calculation with it
+    lcia_ref = {'@type': 'ImpactMethod', '@id': 'benchmark-lcia', 'name': 'TRACI 2.1 (openIMPACT)'}
+    state = {'@type': 'ResultState', '@id': 'benchmark-result', 'isReady': True}
+    impacts = [{'@type': 'ImpactValue', 'amount': 1.0 + position / 10,
+                'impactCategory': {'@type': 'ImpactCategory', 'name': name, 'refUnit': 'kg', 'category': 'TRACI'}}
+               for position, name in enumerate(['Global warming', 'Acidification', 'Eutrophication',
+                                                'Ozone depletion', 'Smog formation'])]
+    calls += [['result/calculate', {'impactMethod': lcia_ref}, state, None, 0.0],
+              ['result/state', {'@id': 'benchmark-result'}, state, None, 0.0],
+              ['result/total-impacts', {'@id': 'benchmark-result'}, impacts, None, 0.0],
+              ['result/dispose', {'@id': 'benchmark-result'}, state, None, 0.0]]
+
+    path = 'benchmark recording.json.gz'
+    with gzip.open(path, 'wt') as f:
+        json.dump({'url': 'benchmark', 'calls': calls,
+                   'name_index': {'ImpactMethod': {lcia_ref['name']: [lcia_ref]}}}, f)
+
+    return path, prov_sheet, param_sheet, olca.Ref(id='benchmark-process-0', name='benchmark process 0')
+
+
+def time_stage(function, calls, setup=None):
+    """
+    Times the calls of one benchmark stage.
+
+    :param function: function of the call number
+    :param calls: number of calls
+    :param setup: optional function of the call number that runs untimed before each call
+    :return: dictionary of the number of calls, total seconds and per call mean, median and max seconds
+    """
+    times = []
+    for call in range(calls):
+        if setup is not None:
+            setup(call)
+        call_start = time.perf_counter()
+        function(call)
+        times.append(time.perf_counter() - call_start)
+
+    times = np.array(times) if len(times) > 0 else np.zeros(1)
+    return {'calls': calls, 'seconds': float(times.sum()), 'mean': float(times.mean()),
+            'median': float(np.median(times)), 'max': float(times.max())}
+
+
+def benchmark_pipeline(oi, sizes, latency=None, param_runs=5, providers=10):
+    """
+    Benchmarks the stages of the simulation pipeline against a local stand-in server (see serve_recording), for each
+    size of provider sheets, substitution rows and runs. Stages: reading the provider sheets, provider sampling,
+    pick_value and draw_parameters, modify_processes, create_ps, the in-place product system update, get_results and
+    writing the results csv. Runs in a temporary directory; caches are cleared for every size.
+
+    :param oi: the openIMPACT script module whose pipeline is benchmarked; its client is pointed at the stand-in
+        server while a size runs
+    :param sizes: list of (provider sheets, substitution rows, runs)
+    :param latency: latency of the stand-in server, see Recording
+    :param param_runs: parameter draws per run, for draw_parameters and the results writing
+    :param providers: number of providers per provider sheet
+    :return: list of results, one per size
+    """
+    live_client = oi.client
+    work_dir = os.getcwd()
+    lcia_methods = ['TRACI 2.1 (openIMPACT)']
+    results = []
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.chdir(temp_dir)
+        try:
+            for sheets, rows, runs in sizes:
+                print(f'\nBenchmark: {sheets} provider sheets, {rows} substitution rows, {runs} runs')
+                for cache in [oi.cache_process, oi.cache_descriptors, oi.cache_flows, oi.cache_lcia, oi.cache_ref_flows,
+                              oi.cache_provider_sheets, oi.cache_lcia_factors, oi.cache_name_index, oi.cache_samples,
+                              oi.cache_parameters]:
+                    cache.clear()
+
+                path, prov_sheet, param_sheet, main_ref = benchmark_inputs(sheets, rows, providers)
+                servers = serve_recording(path, [0], latency)
+                oi.client = ipc.Client(servers[0].server_address[1])
+                provider_sheets = prov_sheet['provider_sheet'].unique().tolist()
+                header = provider_sheets + param_sheet['parameter'].tolist() + ['gwp', 'gwp_be', 'gep_bu', 'ap', 'ep',
+                                                                                 'odp', 'pocp', 'gwp_AR5', 'gwp_EF2',
+                                                                                 'gwp_CML', 'sim_type']
+                stages = {}
+                try:
+                    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                        stages['provider_sheets'] = time_stage(
+                            lambda n: oi.fetch_provider_sheet(f'./providers/{provider_sheets[n]}.xlsx'),
+                            len(provider_sheets))
+                        provider_index = oi.preload_ref_flows(provider_sheets)
+
+                        draws = []
+                        stages['provider_sampling'] = time_stage(
+                            lambda n: draws.append(oi.pick_providers(provider_sheets)), runs)
+                        samples = param_sheet['sample'].tolist()
+                        param_table = oi.compile_parameters(param_sheet)
+                        stages['pick_value'] = time_stage(
+                            lambda n: [oi.pick_value(sample, 'sample') for sample in samples], runs)
+                        stages['draw_parameters'] = time_stage(
+                            lambda n: oi.draw_parameters(param_table, param_runs), runs)
+
+                        stages['modify_processes'] = time_stage(
+                            lambda n: oi.modify_processes(prov_sheet, draws[n], preloaded_provider_dict=provider_index),
+                            runs)
+                        stages['create_ps'] = time_stage(lambda n: oi.delete_ps(oi.create_ps(main_ref)), runs)
+                        manager = oi.ProductSystemManager(main_ref, prov_sheet)
+                        stages['ps_update_in_place'] = time_stage(
+                            lambda n: manager.acquire(),
+                            runs, setup=lambda n: oi.modify_processes(prov_sheet, draws[n], previous_dict=draws[n - 1],
+                                                                      preloaded_provider_dict=provider_index))
+
+                        model_ref = manager.acquire()
+                        values = oi.draw_parameters(param_table, runs)
+                        redefs = [oi.pick_parameters(param_sheet, values[n])[1] for n in range(runs)]
+                        stages['get_results'] = time_stage(
+                            lambda n: oi.get_results(model_ref, lcia_methods, n, redefs[n]), runs)
+                        manager.close()
+
+                        row = [provider.name for provider in draws[0].values()] + values[0].tolist() + \
+                              [1.0] * 10 + ['mca']
+                        writer = oi.ResultsWriter(os.path.join(temp_dir, f'benchmark {sheets}-{rows}-{runs}.csv'),
+                                                  header)
+                        stages['results_writing'] = time_stage(
+                            lambda n: writer.writerows([row] * param_runs), runs)
+                        write_start = time.perf_counter()
+                        writer.close()
+                        stages['results_writing']['seconds'] += time.perf_counter() - write_start
+                finally:
+                    oi.client = live_client
+                    for server in servers:
+                        server.shutdown()
+                        server.server_close()
+
+                for stage, timing in stages.items():
+                    print(f"\t{stage:<20} {timing['seconds']:8.3f} s  {timing['mean'] * 1000:9.3f} ms per call "
+                          f"({timing['calls']} calls)")
+                recording = servers[0].recording
+                if recording.misses > 0:
+                    print(f'\t!! {recording.misses} requests were not answered by the stand-in server.')
+                results.append({'sheets': sheets, 'rows': rows, 'runs': runs, 'param_runs': param_runs,
+                                'providers': providers, 'requests': recording.requests, 'misses': recording.misses,
+                                'stages': stages})
+        finally:
+            os.chdir(work_dir)
+
+    return results
+
+
+def write_benchmark(results, path, latency=None, label=None, threshold=1.2):
+    """
+    Adds the results of a benchmark run to a JSON history file, and prints the stages that got slower than in the
+    previous run of the file by more than the threshold.
+
+    :param results: results from benchmark_pipeline
+    :param path: JSON file
+    :param latency: latency of the stand-in server
+    :param label: label of the run, e.g. a release or the script file name
+    :param threshold: ratio of the mean time per call to the previous run that is reported as a regression
+    :return: benchmark run that was added
+    """
+    history = {'runs': []}
+    if os.path.exists(path):
+        with open(path) as f:
+            history = json.load(f)
+
+    run = {
+        'label': label,
+        'created': datetime.now(pytz.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'latency': latency,
+        'results': results,
+    }
+
+    if len(history['runs']) > 0:
+        previous = history['runs'][-1]
+        print(f"\nComparing with benchmark run \"{previous['label']}\" of {previous['created']}:")
+        previous_results = {(r['sheets'], r['rows'], r['runs']): r for r in previous['results']}
+        for result in results:
+            previous_result = previous_results.get((result['sheets'], result['rows'], result['runs']))
+            if previous_result is None:
+                continue
+            for stage, timing in result['stages'].items():
+                previous_timing = previous_result['stages'].get(stage)
+                if previous_timing is None or previous_timing['mean'] == 0:
+                    continue
+                ratio = timing['mean'] / previous_timing['mean']
+                flag = ' !! slower' if ratio > threshold else ''
+                print(f"\t{result['sheets']}x{result['rows']}x{result['runs']} {stage:<20} {ratio:6.2f}x{flag}")
+
+    history['runs'].append(run)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=1)
+    print(f'\nBenchmark results saved to {path}')
+
+    return run
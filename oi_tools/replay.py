@@ -0,0 +1,242 @@
+"""
+Record and replay of openLCA IPC requests. A RecordingClient records the requests of a run; a ReplayClient or the mock
+servers of serve_recording answer them again without openLCA, e.g. for tests and benchmarks. Used by the --record,
+--replay and --serve-recording options of the script.
+"""
+import gzip
+import http.server
+import json
+import os
+import threading
+import time
+import timeit
+
+import humanfriendly
+import olca_ipc as ipc
+
+
+class RecordingClient(ipc.Client):
+    """
+    IPC client that records every JSON-RPC request to openLCA and its response, so that a run can later be replayed
+    without openLCA, see ReplayClient and serve_recording. All client and result calls (get, put, calculate,
+    create_product_system, result queries, ...) go through rpc_call.
+    """
+
+    def __init__(self, endpoint=8080):
+        super().__init__(endpoint)
+        self.calls = []  # [method, params, result, error, seconds] in request order
+
+    def rpc_call(self, method, params=None):
+        call_start = timeit.default_timer()
+        result, err = super().rpc_call(method, params)
+        self.calls.append([method, params, result, err, timeit.default_timer() - call_start])
+        return result, err
+
+    def save(self, path, name_index=None):
+        """
+        Writes the recording as gzipped json. The name index of the database should be included, so a replay also
+        works when the names were indexed before the recording started.
+
+        :param path: recording file, e.g. "recording.json.gz"
+        :param name_index: dictionary of type name -> name -> list of reference dictionaries, see fetch_name_index
+        """
+        name_index = name_index if name_index is not None else {}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with gzip.open(path, 'wt') as f:
+            json.dump({'url': self.url, 'calls': self.calls, 'name_index': name_index}, f)
+        seconds = sum(call[4] for call in self.calls)
+        print(f'\nRecorded {len(self.calls)} openLCA requests ({humanfriendly.format_timespan(seconds)}) to {path}')
+
+
+class Recording:
+    """
+    Responses of a recording, served as a mock openLCA database. Responses are looked up by method and parameters and
+    served in the order they were recorded; once a request has used up its responses, the last one is repeated. Put
+    entities are kept, so a later get returns them. Calculations with the same setup (e.g. the same product system
+    after its links changed) get their results in recorded order, so a replay is exact for the recorded pipeline.
+    A calculation that was not recorded, e.g. of other parameter draws or of the parallel MCA, is answered with a
+    recorded calculation of the same LCIA method, so a changed pipeline still runs with realistic responses.
+    """
+
+    def __init__(self, path, latency=None):
+        """
+        :param path: recording file from RecordingClient.save
+        :param latency: None to reply right away, a number of seconds per request, or 'recorded' to reply after the
+            time the request took when it was recorded
+        """
+        with gzip.open(path, 'rt') as f:
+            recording = json.load(f)
+        self.url = recording['url']
+        self.latency = latency
+        self.name_index = recording['name_index']
+        self.responses = {}  # request key -> list of [result, error, seconds]
+        self.calculations = {}  # (method, LCIA method id) -> list of recorded calculation results
+        for method, params, result, err, seconds in recording['calls']:
+            self.responses.setdefault(self.key(method, params), []).append([result, err, seconds])
+            if method in ['result/calculate', 'result/simulate'] and err is None:
+                self.calculations.setdefault((method, self.lcia_id(params)), []).append(result)
+        self.served = {}  # request key -> number of responses served
+        self.entities = {}  # (type, id) -> entity put during the replay
+        self.requests = 0
+        self.mocked = 0
+        self.misses = 0
+        self.systems = 0  # product systems created by the mock
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(method, params):
+        if method == 'data/put':
+            params = {'@type': params.get('@type'), '@id': params.get('@id')}  # puts differ in their time stamps
+        return f'{method} {json.dumps(params, sort_keys=True)}'
+
+    @staticmethod
+    def lcia_id(setup):
+        return (setup.get('impactMethod') or {}).get('@id')
+
+    def reply(self, method, params=None):
+        """
+        :param method: JSON-RPC method
+        :param params: JSON-RPC parameters
+        :return: result, error message (None if there was no error)
+        """
+        with self.lock:
+            self.requests += 1
+            key = self.key(method, params)
+            responses = self.responses.get(key)
+            if method == 'data/put':
+                self.entities[(params.get('@type'), params.get('@id'))] = params
+            elif method == 'data/delete':
+                self.entities.pop((params.get('@type'), params.get('@id')), None)
+            elif method == 'data/get' and (params.get('@type'), params.get('@id')) in self.entities:
+                return self.entities[(params.get('@type'), params.get('@id'))], None
+
+            if responses is None:
+                result = self.mock_reply(method, params)
+                if result is None:
+                    self.misses += 1
+                    return None, f'No recorded response for {key[:300]}'
+                self.mocked += 1
+                return result, None
+
+            served = self.served.get(key, 0)
+            self.served[key] = served + 1
+            result, err, seconds = responses[min(served, len(responses) - 1)]
+
+        if self.latency == 'recorded':
+            time.sleep(seconds)
+        elif self.latency:
+            time.sleep(self.latency)
+        return result, err
+
+    def mock_reply(self, method, params):
+        """
+        Answers requests that were not recorded where the answer is known: puts, deletes and descriptors by id (named
+        if they are in the name index), and descriptor lists and unit groups from the name index of the recording. A product system that is created is
+        kept as an entity that only holds its reference process, until it is deleted.
+        """
+        if method == 'data/get/descriptor' and params.get('@id'):
+            for refs in self.name_index.get(params['@type'], {}).values():
+                for ref in refs:
+                    if ref['@id'] == params['@id']:
+                        return ref
+        if method in ['data/put', 'data/delete'] or (method == 'data/get/descriptor' and params.get('@id')):
+            return {'@type': params.get('@type'), '@id': params.get('@id')}
+        if method == 'data/create/system':
+            self.systems += 1
+            system = {'@type': 'ProductSystem', '@id': f'mock-system-{self.systems}', 'name': 'mock product system',
+                      'refProcess': params['process'], 'processes': [params['process']], 'processLinks': []}
+            self.entities[('ProductSystem', system['@id'])] = system
+            return {'@type': 'ProductSystem', '@id': system['@id']}
+        if method in ['result/calculate', 'result/simulate']:
+            calculations = self.calculations.get((method, self.lcia_id(params)), [])
+            return calculations[self.mocked % len(calculations)] if calculations else None
+        if method == 'data/get/descriptors' and params['@type'] in self.name_index:
+            return [ref for refs in self.name_index[params['@type']].values() for ref in refs]
+        if method == 'data/get/all' and params['@type'] == 'UnitGroup' and 'Unit' in self.name_index:
+            units = [{'@type': 'Unit', '@id': ref['@id'], 'name': ref['name']}
+                     for refs in self.name_index['Unit'].values() for ref in refs]
+            return [{'@type': 'UnitGroup', '@id': 'recorded-units', 'name': 'Recorded units', 'units': units}]
+        return None
+
+    def summary(self):
+        return (f'{self.requests} openLCA requests replayed, {self.mocked} answered by the mock, '
+                f'{self.misses} without a response')
+
+
+class ReplayClient(ipc.Client):
+    """
+    IPC client that replays a recording instead of talking to openLCA, see Recording.
+    """
+
+    def __init__(self, path, latency=None):
+        """
+        :param path: recording file from RecordingClient.save
+        :param latency: None, seconds per request or 'recorded', see Recording
+        """
+        self.recording = Recording(path, latency)
+        super().__init__(self.recording.url)
+        self.replay_args = (path, latency)
+
+    def rpc_call(self, method, params=None):
+        result, err = self.recording.reply(method, params)
+        if result is None and err is not None and err.startswith('No recorded response'):
+            raise LookupError(err)
+        return result, err
+
+
+def parse_latency(text):
+    """
+    :param text: seconds per request, or 'recorded'
+    :return: latency setting of Recording
+    """
+    if text == 'recorded':
+        return text
+    return float(text) or None
+
+
+class RecordingHandler(http.server.BaseHTTPRequestHandler):
+    """
+    JSON-RPC endpoint of serve_recording.
+    """
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        result, err = self.server.recording.reply(request['method'], request.get('params'))
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        if err is None:
+            response['result'] = result
+        else:
+            code, _, message = err.partition(': ')
+            response['error'] = {'code': int(code) if code.lstrip('-').isdigit() else -32000,
+                                 'message': message if message else err}
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no log line per request
+
+
+def serve_recording(path, ports=(8080,), latency=None):
+    """
+    Starts mock openLCA IPC servers that answer from a recording, one per port, so that ipc.Client(port) and the
+    parallel MCA workers run without openLCA. All ports share the same replayed database.
+
+    :param path: recording file from RecordingClient.save
+    :param ports: list of ports
+    :param latency: None, seconds per request or 'recorded', see Recording
+    :return: list of servers, call shutdown() on each to stop them
+    """
+    recording = Recording(path, latency)
+    servers = []
+    for port in ports:
+        server = http.server.ThreadingHTTPServer(('localhost', port), RecordingHandler)
+        server.recording = recording
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    print(f'Serving {path} on port(s) {", ".join(str(server.server_address[1]) for server in servers)}.')
+
+    return servers
@@ -0,0 +1,256 @@
+"""
+Per-stage tracing of the simulation pipeline and latency of the openLCA IPC requests. Stages are timed where they are
+called with tracer.span(stage), requests by wrapping the IPC client in a TracedClient. The trace is written as Chrome
+trace JSON or OpenMetrics text, see the trace_output setting of main.
+"""
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+import humanfriendly
+import numpy as np
+import olca_ipc as ipc
+
+
+class Tracer:
+    """
+    Records the duration of the pipeline stages and the latency and payload size of every openLCA IPC request, per
+    substitution sheet. Stages are timed where they are called, with tracer.span(stage); requests are timed by a
+    TracedClient and attributed to the innermost running stage. Nothing is recorded until enable is called.
+    """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # seconds
+
+    def __init__(self, max_events=500000):
+        """
+        :param max_events: maximum number of trace events kept for the Chrome trace; metrics are always complete
+        """
+        self.enabled = False
+        self.label = ''  # substitution sheet name
+        self.max_events = max_events
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, process_name='main'):
+        """
+        Drops all recorded events and metrics, e.g. the ones a forked worker process inherited.
+        :param process_name: name of this process in the Chrome trace
+        """
+        self.events = []
+        self.dropped = 0
+        self.metrics = {}  # (kind, sub_name, stage, method) -> counts, sums and latency histogram
+        self.process_names = {os.getpid(): process_name}
+
+    def enable(self):
+        """
+        Starts recording spans, and requests of TracedClients.
+        """
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stops recording. Recorded events and metrics are kept until reset.
+        """
+        self.enabled = False
+
+    def stage(self):
+        """
+        :return: innermost running stage of this thread, 'other' outside of all stages
+        """
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else 'other'
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """
+        Times a block of code as a stage, e.g. with tracer.span('plots'): ...
+        :param stage: stage name
+        """
+        if not self.enabled:
+            yield
+            return
+        if getattr(self.local, 'stack', None) is None:
+            self.local.stack = []
+        self.local.stack.append(stage)
+        begin, span_start = time.time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self.local.stack.pop()
+            self.record('stage', stage, None, begin, time.perf_counter() - span_start)
+
+    def record(self, kind, stage, method, begin, duration, request_bytes=0, response_bytes=0, error=False):
+        """
+        Adds one stage run or IPC request to the metrics and the trace events.
+        """
+        key = (kind, self.label, stage, method)
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = {'count': 0, 'seconds': 0.0, 'buckets': [0] * (len(self.buckets) + 1),
+                                              'request_bytes': 0, 'response_bytes': 0, 'errors': 0}
+            metric['count'] += 1
+            metric['seconds'] += duration
+            metric['buckets'][bisect.bisect_left(self.buckets, duration)] += 1
+            metric['request_bytes'] += request_bytes
+            metric['response_bytes'] += response_bytes
+            metric['errors'] += int(error)
+
+            if len(self.events) >= self.max_events:
+                self.dropped += 1
+                return
+            event = {'name': stage if kind == 'stage' else method, 'cat': kind, 'ph': 'X',
+                     'ts': round(begin * 1e6, 1), 'dur': round(duration * 1e6, 1), 'pid': os.getpid(),
+                     'tid': threading.get_ident(), 'args': {'sub_name': self.label}}
+            if kind == 'ipc':
+                event['args'].update(stage=stage, request_bytes=request_bytes, response_bytes=response_bytes)
+            self.events.append(event)
+
+    def export(self):
+        """
+        :return: events and metrics of this process, for merge in the main process
+        """
+        return {'events': self.events, 'dropped': self.dropped, 'metrics': self.metrics,
+                'process_names': self.process_names}
+
+    def merge(self, part):
+        """
+        Adds the events and metrics of a worker process, see export.
+        :param part: dictionary from export, or None if the worker did not trace
+        """
+        if part is None:
+            return
+        with self.lock:
+            room = max(0, self.max_events - len(self.events))
+            self.events.extend(part['events'][:room])
+            self.dropped += part['dropped'] + max(0, len(part['events']) - room)
+            self.process_names.update(part['process_names'])
+            for key, metric in part['metrics'].items():
+                if key not in self.metrics:
+                    self.metrics[key] = {name: list(value) if isinstance(value, list) else value
+                                         for name, value in metric.items()}
+                    continue
+                total = self.metrics[key]
+                for name, value in metric.items():
+                    if name == 'buckets':
+                        total[name] = [a + b for a, b in zip(total[name], value)]
+                    else:
+                        total[name] += value
+
+    def write(self, path):
+        """
+        Writes the trace as Chrome trace JSON if the path ends with .json (open it in Perfetto or chrome://tracing),
+        otherwise as OpenMetrics text.
+        :param path: trace file path
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.lock:
+            if path.endswith('.json'):
+                names = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}}
+                         for pid, name in self.process_names.items()]
+                with open(path, 'w') as f:
+                    json.dump({'traceEvents': names + self.events, 'displayTimeUnit': 'ms',
+                               'otherData': {'dropped_events': self.dropped}}, f)
+            else:
+                with open(path, 'w') as f:
+                    f.write(self.openmetrics())
+        if self.dropped > 0:
+            print(f'!! {self.dropped} trace events were dropped after {self.max_events} events, metrics are complete.')
+        print(f'Trace saved to {path}')
+
+    def openmetrics(self):
+        """
+        :return: metrics in the OpenMetrics text format
+        """
+        def labels(sub_name, stage, method=None, **extra):
+            pairs = [('sub_name', sub_name), ('stage', stage)] + ([('method', method)] if method else []) + \
+                    list(extra.items())
+            escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                       for name, value in pairs]
+            return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+        families = [
+            ('openimpact_stage_seconds', 'stage', 'Duration of pipeline stages.'),
+            ('openimpact_ipc_request_seconds', 'ipc', 'Latency of openLCA IPC requests.'),
+        ]
+        lines = []
+        for family, kind, help_text in families:
+            lines += [f'# TYPE {family} histogram', f'# UNIT {family} seconds', f'# HELP {family} {help_text}']
+            for (metric_kind, sub_name, stage, method), metric in sorted(self.metrics.items(), key=str):
+                if metric_kind != kind:
+                    continue
+                cumulative = np.cumsum(metric['buckets'])
+                for bound, count in zip(list(self.buckets) + ['+Inf'], cumulative):
+                    lines.append(f'{family}_bucket{labels(sub_name, stage, method, le=bound)} {count}')
+                lines.append(f"{family}_count{labels(sub_name, stage, method)} {metric['count']}")
+                lines.append(f"{family}_sum{labels(sub_name, stage, method)} {metric['seconds']:.6f}")
+
+        for name, help_text in [('request_bytes', 'Size of openLCA IPC request parameters.'),
+                                ('response_bytes', 'Size of openLCA IPC responses.'),
+                                ('errors', 'openLCA IPC requests that returned an error.')]:
+            family = f'openimpact_ipc_{name}'
+            lines += [f'# TYPE {family} counter', f'# HELP {family} {help_text}']
+            for (metric_kind, sub_name, stage, method), metric in sorted(self.metrics.items(), key=str):
+                if metric_kind == 'ipc':
+                    lines.append(f'{family}_total{labels(sub_name, stage, method)} {metric[name]}')
+
+        return '\n'.join(lines + ['# EOF']) + '\n'
+
+    def summary(self, top=10):
+        """
+        :param top: number of stages and IPC methods listed
+        :return: text with the stages and IPC methods that took the most time, over all substitution sheets
+        """
+        totals = {}
+        for (kind, sub_name, stage, method), metric in self.metrics.items():
+            total = totals.setdefault((kind, stage if kind == 'stage' else method), [0, 0.0, 0])
+            total[0] += metric['count']
+            total[1] += metric['seconds']
+            total[2] += metric['response_bytes']
+        text = []
+        for kind, title in [('stage', 'Stages'), ('ipc', 'openLCA IPC requests')]:
+            text.append(f'{title} by total time:')
+            ranked = sorted(((name, total) for (total_kind, name), total in totals.items() if total_kind == kind),
+                            key=lambda item: -item[1][1])
+            for name, (count, seconds, response_bytes) in ranked[:top]:
+                size = f', {humanfriendly.format_size(response_bytes / count)} per response' if kind == 'ipc' else ''
+                text.append(f'\t{name:<28} {humanfriendly.format_timespan(seconds):>24} {count:>8} calls, '
+                            f'{seconds / count * 1000:.2f} ms each{size}')
+
+        return '\n'.join(text)
+
+
+tracer = Tracer()
+
+
+class TracedClient(ipc.Client):
+    """
+    IPC client that times every request of another client (ipc.Client, RecordingClient or ReplayClient) for the tracer
+    and measures its request and response size. All client and result calls of olca_ipc go through rpc_call, and
+    results keep a reference to the client that created them, so result queries are timed too. Other attributes, e.g.
+    replay_args or save of a recording, are those of the wrapped client.
+    """
+
+    def __init__(self, ipc_client):
+        """
+        :param ipc_client: client that sends the requests
+        """
+        super().__init__(ipc_client.url)
+        self.client = ipc_client
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['client'], name)
+
+    def rpc_call(self, method, params=None):
+        if not tracer.enabled:
+            return self.client.rpc_call(method, params)
+        begin, call_start = time.time(), time.perf_counter()
+        result, err = self.client.rpc_call(method, params)
+        duration = time.perf_counter() - call_start
+        request_bytes = len(json.dumps(params)) if params is not None else 0
+        response_bytes = len(json.dumps(result)) if result is not None else 0
+        tracer.record('ipc', tracer.stage(), method, begin, duration, request_bytes, response_bytes, err is not None)
+        return result, err
@@ -0,0 +1,72 @@
+"""
+Shared setup of the tests: the script is loaded as module oi and the replay_inputs fixture builds a replayed openLCA
+database for end-to-end runs of main
+"""
+import gzip
+import importlib.util
+import json
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')  # before the script imports pyplot
+import pandas as pd
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)  # the script imports the oi_tools package next to it
+
+from oi_tools import bench, replay
+
+# the file name is not a valid module name, so the script is loaded from its path and registered as oi for the test
+# modules
+spec = importlib.util.spec_from_file_location('oi', os.path.join(repo_dir, 'oi_0.3.3.py'))
+oi = importlib.util.module_from_spec(spec)
+sys.modules['oi'] = oi
+spec.loader.exec_module(oi)
+
+
+def clear_caches():
+    """Empties the openLCA caches of the script, so a test does not see the entities of another test's database."""
+    for cache in [oi.cache_process, oi.cache_descriptors, oi.cache_flows, oi.cache_lcia, oi.cache_ref_flows,
+                  oi.cache_provider_sheets, oi.cache_lcia_factors, oi.cache_name_index, oi.cache_samples,
+                  oi.cache_parameters]:
+        cache.clear()
+
+
+@pytest.fixture
+def replay_inputs(tmp_path, monkeypatch):
+    """
+    Synthetic substitution sheet, provider sheets and openLCA recording in a temporary working directory, see
+    benchmark_inputs. The replay client answers the requests of main from the recording.
+    """
+    monkeypatch.chdir(tmp_path)
+    clear_caches()
+
+    path, prov_sheet, param_sheet, main_ref = bench.benchmark_inputs(2, 4, providers=3)
+    with gzip.open(path, 'rt') as f:
+        recording = json.load(f)
+    for sheet_name in prov_sheet['provider_sheet'].unique():
+        sheet_path = os.path.join('providers', f'{sheet_name}.xlsx')
+        providers = pd.read_excel(sheet_path)
+        providers['mark'] = ['base', 'low', 'high']
+        providers.to_excel(sheet_path, index=False)
+        for index, row in providers.iterrows():
+            recording['calls'].append(['data/get/descriptor', {'@type': 'Process', '@id': row['process_uuid']},
+                                       {'@type': 'Process', '@id': row['process_uuid'], 'name': row['name']},
+                                       None, 0.0])
+    with gzip.open(path, 'wt') as f:
+        json.dump(recording, f)
+
+    rows = [{'uuid': main_ref.id, 'name': main_ref.name}]
+    rows += [{'uuid': row['uuid'], 'mod': 'provider', 'find_flow': row['find_flow'],
+              'provider_sheet': row['provider_sheet'], 'uf_group': 'supply'} for index, row in prov_sheet.iterrows()]
+    rows += [{'uuid': row['uuid'], 'name': row['name'], 'mod': 'parameter', 'parameter': row['parameter'],
+              'sample': row['sample'], 'uf_group': 'use'} for index, row in param_sheet.iterrows()]
+    os.makedirs('substitutions')
+    columns = ['uuid', 'location', 'name', 'mod', 'find_flow', 'provider_sheet', 'regions', 'parameter', 'sample',
+               'skip', 'uf_group']
+    pd.DataFrame(rows, columns=columns).to_excel(os.path.join('substitutions', 'replay.xlsx'), index=False)
+
+    monkeypatch.setattr(oi, 'client', replay.ReplayClient(path))
+    return prov_sheet, param_sheet
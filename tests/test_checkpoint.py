@@ -0,0 +1,80 @@
+"""
+Tests of the checkpoint journal: an interrupted run of main continues where it stopped, and a finished substitution
+sheet is only skipped when nothing that changes its results differs. openLCA is replayed, see replay_inputs.
+"""
+import glob
+import json
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+import oi
+
+settings = {'sub_names': ['replay'], 'loop_runs': 3, 'param_runs': 2, 'live_histogram': False, 'prefetch_workers': 1,
+            'seed': 1}
+
+
+def read_results():
+    [res_path] = glob.glob(os.path.join('results files', '*', 'raw', '*.csv'))
+    return pd.read_csv(res_path)
+
+
+def read_journal():
+    with open(os.path.join('results files', 'checkpoints', 'replay.json')) as f:
+        return json.load(f)
+
+
+def test_resume_after_crash(replay_inputs, monkeypatch):
+    pick_parameters = oi.pick_parameters
+    calls = []
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return pick_parameters(*args, **kwargs)
+
+    monkeypatch.setattr(oi, 'pick_parameters', counted)
+    oi.main(**settings)
+    expected = read_results()
+    shutil.rmtree('results files')
+
+    def crashing(*args, **kwargs):
+        if len(calls) == total // 2:
+            raise RuntimeError('crash')
+        return counted(*args, **kwargs)
+
+    total = len(calls)
+    calls.clear()
+    monkeypatch.setattr(oi, 'pick_parameters', crashing)
+    with pytest.raises(RuntimeError):
+        oi.main(**settings)
+    journal = read_journal()
+    assert not journal['finished'] and len(journal['phases']) > 0
+    assert len(read_results()) < len(expected)
+
+    # the resumed run draws the same providers and parameters as the uninterrupted one
+    monkeypatch.setattr(oi, 'pick_parameters', pick_parameters)
+    oi.main(**settings)
+    assert read_journal()['finished']
+    results = read_results()
+    impacts = ['gwp', 'gwp_be', 'gep_bu', 'ap', 'ep', 'odp', 'pocp', 'gwp_AR5', 'gwp_EF2', 'gwp_CML']
+    inputs = [column for column in expected.columns if column not in impacts]
+    pd.testing.assert_frame_equal(results[inputs], expected[inputs])
+    assert results['gwp'].notna().all()
+
+
+def test_skip_finished(replay_inputs):
+    oi.main(**dict(settings, probability_analysis=False, subgroup_mca=False))
+    assert set(read_results()['sim_type']) == {'base', 'range'}
+
+    # settings that do not change the results keep the finished journal
+    oi.main(**dict(settings, probability_analysis=False, subgroup_mca=False, flush_rows=10))
+    assert set(read_results()['sim_type']) == {'base', 'range'}
+
+    # a phase that was not run, or another seed, starts the sheet over
+    oi.main(**dict(settings, subgroup_mca=False))
+    assert set(read_results()['sim_type']) == {'base', 'range', 'mca'}
+    signature = read_journal()['signature']
+    oi.main(**dict(settings, subgroup_mca=False, seed=2))
+    assert read_journal()['signature'] != signature
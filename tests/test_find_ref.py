@@ -0,0 +1,63 @@
+"""
+Tests of the name index behind find_ref, with the replay client serving a database of a few processes from the name
+index of a recording.
+"""
+import gzip
+import json
+import os
+import re
+
+import olca_schema as olca
+import pytest
+
+import oi
+from conftest import clear_caches
+from oi_tools import replay
+
+url = 'http://localhost:8080'
+
+
+def process(uuid, name, location):
+    return {'@type': 'Process', '@id': uuid, 'name': name, 'location': location}
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """
+    Replays a database with two grid processes of the same name in different locations, and one renamed process.
+    :return: function that writes an index of the database as it was before, see fetch_name_index
+    """
+    monkeypatch.chdir(tmp_path)
+    clear_caches()
+    processes = {'grid': [process('grid-us', 'grid', 'US'), process('grid-ca', 'grid', 'CA')],
+                 'boiler, new': [process('boiler', 'boiler, new', 'US')]}
+    with gzip.open('database.json.gz', 'wt') as f:
+        json.dump({'url': url, 'calls': [], 'name_index': {'Process': processes}}, f)
+    monkeypatch.setattr(oi, 'client', replay.ReplayClient('database.json.gz'))
+
+    def write_index(names):
+        path = os.path.join('results files', 'name index', f"{re.sub(r'[^A-Za-z0-9]+', '_', url).strip('_')}.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'Process': names}, f)
+
+    return write_index
+
+
+def test_find_ref_ambiguous(database):
+    with pytest.raises(ValueError, match='grid-us.*grid-ca'):
+        oi.find_ref(olca.Process, 'grid')
+    with pytest.raises(ValueError, match='grid-us.*grid-ca'):
+        oi.find_ref(olca.Process, 'grid', 'MX')
+    assert oi.find_ref(olca.Process, 'grid', 'CA').id == 'grid-ca'
+    assert oi.find_ref(olca.Process, 'boiler, new').id == 'boiler'
+    assert oi.find_ref(olca.Process, 'boiler') is None
+
+
+def test_find_ref_renamed(database):
+    # the index on disk still has the process under its old name
+    database({'grid': [process('grid-us', 'grid', 'US'), process('grid-ca', 'grid', 'CA')],
+              'boiler': [process('boiler', 'boiler', 'US')]})
+    assert oi.find_ref(olca.Process, 'boiler') is None
+    assert oi.find_ref(olca.Process, 'boiler, new').id == 'boiler'
+    assert oi.client.recording.misses == 0
@@ -0,0 +1,152 @@
+"""
+Tests of the local matrix engine against openLCA calculations of the same runs. openLCA is replayed from a recording of
+a toy database: a main process that takes electricity from a grid process, with the electricity input given by a
+parameter formula, and one LCIA method with a single impact category.
+"""
+import os
+
+import numpy as np
+import olca_ipc as ipc
+import olca_schema as olca
+import pandas as pd
+import pytest
+
+import oi
+from conftest import clear_caches
+from oi_tools import replay
+
+main_product = olca.Ref(ref_type=olca.RefType.Flow, id='toy-product', name='product',
+                        flow_type=olca.FlowType.PRODUCT_FLOW)
+electricity = olca.Ref(ref_type=olca.RefType.Flow, id='toy-electricity', name='electricity',
+                       flow_type=olca.FlowType.PRODUCT_FLOW)
+co2 = olca.Ref(ref_type=olca.RefType.Flow, id='toy-co2', name='carbon dioxide',
+               flow_type=olca.FlowType.ELEMENTARY_FLOW)
+main_ref = olca.Ref(ref_type=olca.RefType.Process, id='toy-main', name='main')
+grid_ref = olca.Ref(ref_type=olca.RefType.Process, id='toy-grid', name='grid')
+system_ref = olca.Ref(ref_type=olca.RefType.ProductSystem, id='toy-system', name='main')
+traci = olca.Ref(ref_type=olca.RefType.ImpactMethod, id='toy-traci', name='TRACI 2.1')
+gwp = olca.Ref(ref_type=olca.RefType.ImpactCategory, id='toy-gwp', name='Global warming', ref_unit='kg CO2 eq')
+
+main_tech = olca.TechFlow(provider=main_ref, flow=main_product)
+grid_tech = olca.TechFlow(provider=grid_ref, flow=electricity)
+co2_out = olca.EnviFlow(flow=co2, is_input=False)
+
+# the electricity input is guarded against a share of zero
+guarded_formula = 'if(share > 0; 1 / share; 0)'
+
+
+def toy_process():
+    return olca.Process(
+        id=main_ref.id, name=main_ref.name,
+        parameters=[olca.Parameter(name='share', is_input_parameter=True, value=0.5),
+                    olca.Parameter(name='per_share', is_input_parameter=False, formula=guarded_formula)],
+        exchanges=[olca.Exchange(flow=main_product, amount=1.0, is_quantitative_reference=True),
+                   olca.Exchange(flow=electricity, amount=4.0, amount_formula='per_share * 2', is_input=True,
+                                 default_provider=grid_ref),
+                   olca.Exchange(flow=co2, amount=0.5)])
+
+
+class ToyServer(ipc.Client):
+    """
+    Answers the IPC requests of the engine and of get_results for the toy database, in place of openLCA. The main
+    process emits 0.5 kg CO2 and takes 2 / share kWh of grid electricity with 1 kg CO2 per kWh.
+    """
+
+    results = {}
+
+    def rpc_call(self, method, params=None):
+        if method == 'data/get/descriptors':
+            return [traci.to_dict()] if params['@type'] == 'ImpactMethod' else [], None
+        if method == 'data/get/descriptor':
+            return {'@type': params['@type'], '@id': params['@id'], 'name': 'toy'}, None
+        if method == 'data/get/all':
+            return [], None
+        if method == 'data/get':
+            return toy_process().to_dict(), None
+        if method == 'result/calculate':
+            variables = {'share': 0.5}
+            variables.update({redef['name'].lower(): redef['value'] for redef in params.get('parameters', [])})
+            variables['per_share'] = oi.evaluate_formula(guarded_formula, variables)
+            state = olca.ResultState(id=f'toy-result-{len(self.results)}', is_ready=True, is_scheduled=False)
+            self.results[state.id] = (state, oi.evaluate_formula('per_share * 2', variables))
+            return state.to_dict(), None
+
+        state, kwh = self.results[params['@id']]
+        tech_flow = params.get('techFlow', {}).get('provider', {}).get('@id')
+        replies = {
+            'result/state': state,
+            'result/dispose': state,
+            'result/demand': olca.TechFlowValue(tech_flow=main_tech, amount=1.0),
+            'result/tech-flows': [main_tech, grid_tech],
+            'result/scaling-factors': [olca.TechFlowValue(tech_flow=main_tech, amount=1.0),
+                                       olca.TechFlowValue(tech_flow=grid_tech, amount=kwh)],
+            'result/unscaled-tech-flows-of': {
+                main_ref.id: [olca.TechFlowValue(tech_flow=main_tech, amount=1.0),
+                              olca.TechFlowValue(tech_flow=grid_tech, amount=-kwh)],
+                grid_ref.id: [olca.TechFlowValue(tech_flow=grid_tech, amount=1.0)]}.get(tech_flow),
+            'result/direct-interventions-of': {
+                main_ref.id: [olca.EnviFlowValue(envi_flow=co2_out, amount=0.5)],
+                grid_ref.id: [olca.EnviFlowValue(envi_flow=co2_out, amount=kwh)]}.get(tech_flow),
+            'result/impact-categories': [gwp],
+            'result/impact-factors-of': [olca.EnviFlowValue(envi_flow=co2_out, amount=1.0)],
+            'result/total-impacts': [olca.ImpactValue(impact_category=gwp, amount=0.5 + kwh)],
+        }
+        reply = replies[method]
+        return [r.to_dict() for r in reply] if isinstance(reply, list) else reply.to_dict(), None
+
+
+class ToyRecordingClient(replay.RecordingClient, ToyServer):
+    """Records the answers of the toy server like a recording of openLCA."""
+
+
+def share_redefs(share):
+    return [olca.ParameterRedef(name='share', value=share, context=main_ref)]
+
+
+def engine_and_openlca(shares):
+    """
+    Builds the engine for the toy product system and calculates runs with the given shares locally and in openLCA.
+    :return: engine, list of (local results, openLCA results)
+    """
+    engine = oi.LocalEngine(pd.DataFrame(columns=['uuid', 'provider_sheet', 'find_flow']), ['TRACI 2.1'])
+    engine.build(system_ref, [], {}, pd.DataFrame({'uuid': [main_ref.id]}))
+    runs = [(engine.get_results({}, share_redefs(share)),
+             oi.get_results(system_ref, ['TRACI 2.1'], parameter_redefs=share_redefs(share)))
+            for share in shares]
+    return engine, runs
+
+
+@pytest.fixture
+def toy_replay(tmp_path, monkeypatch):
+    """Records the toy database for the runs of engine_and_openlca and replays it with the replay client."""
+    monkeypatch.chdir(tmp_path)
+    shares = [0.5, 0.25, 0.0]
+    clear_caches()
+    monkeypatch.setattr(oi, 'client', ToyRecordingClient(8080))
+    engine_and_openlca(shares)
+    path = os.path.join('recordings', 'toy.json.gz')
+    oi.client.save(path, oi.cache_name_index['types'])
+
+    clear_caches()
+    monkeypatch.setattr(oi, 'client', replay.ReplayClient(path))
+    return shares
+
+
+def test_engine_matches_openlca(toy_replay):
+    engine, runs = engine_and_openlca(toy_replay)
+
+    assert engine.valid and engine.params_supported
+    assert oi.client.recording.misses == 0
+    for (local, remote), share in zip(runs, toy_replay):
+        expected = 0.5 + (2 / share if share > 0 else 0)
+        assert local[0] == pytest.approx(expected)
+        np.testing.assert_allclose(local, remote, equal_nan=True)
+
+
+def test_engine_unsupported_formula(toy_replay):
+    engine, runs = engine_and_openlca(toy_replay)
+
+    # without the guard, a share of zero cannot be evaluated locally and the run has to go to openLCA
+    engine.param_scopes[main_ref.id][1].formula = '1 / share'
+    assert engine.get_results({}, share_redefs(0.25))[0] == pytest.approx(8.5)
+    assert engine.get_results({}, share_redefs(0.0)) is None
@@ -0,0 +1,329 @@
+"""
+Tests of oi_0.3.3.py: sample strings, parameter draws, caches, streaming quantiles, Sobol indices and one replayed
+end-to-end run of main. Run from the repository folder with: python -m pytest tests
+"""
+import glob
+import json
+import os
+import re
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import oi
+from conftest import repo_dir
+
+
+def sheet_samples():
+    samples = set()
+    for path in glob.glob(os.path.join(repo_dir, 'substitutions', '*.xlsx')):
+        sheet = pd.read_excel(path)
+        if 'sample' in sheet:
+            samples.update(sheet['sample'].dropna().astype(str))
+    return sorted(samples)
+
+
+"""SAMPLE STRINGS AND PARAMETER DRAWS"""
+
+
+@pytest.mark.parametrize('param_string', sheet_samples())
+def test_compile_sheet_samples(param_string):
+    sample = oi.compile_sample(param_string)
+    table = oi.compile_samples([sample])
+    np.random.seed(1)
+    drawn = oi.draw_parameters(table, 2000)[:, 0]
+    quantiles = oi.quantile_parameters(table, np.linspace(0, 1, 101)[:, None])[:, 0]
+
+    assert sample['distribution'] in ['uniform', 'triangular', 'list']
+    if sample['distribution'] == 'list':
+        support = sample['values'].min(), sample['values'].max()
+        assert set(drawn) <= set(sample['values'])
+        assert set(quantiles) <= set(sample['values'])
+    else:
+        support = sample['a'], sample['b'] if sample['distribution'] == 'uniform' else sample['c']
+        assert support[0] <= drawn.min() and drawn.max() <= support[1]
+        assert support[0] <= quantiles.min() and quantiles.max() <= support[1]
+        assert np.all(np.diff(quantiles) >= 0)  # list values are picked in the listed order instead
+    assert support[0] <= sample['low'] <= support[1] and support[0] <= sample['high'] <= support[1]
+    assert oi.pick_value(param_string, 'base') == sample['base']
+
+
+def test_compile_sample_forms():
+    triangular = oi.compile_sample('triangular; min=0.01; mode=0.0771; max=0.08; base=0.0771')
+    assert (triangular['a'], triangular['b'], triangular['c']) == (0.01, 0.0771, 0.08)
+    assert (triangular['base'], triangular['low'], triangular['high']) == (0.0771, 0.01, 0.08)
+
+    assert oi.compile_sample('triangular; 0.01; 0.0771; 0.08')['b'] == 0.0771
+    assert oi.compile_sample('traingular; min=1; mode=2; max=3')['distribution'] == 'triangular'
+    assert oi.compile_sample('uniform; min=0.04; max=0.06')['base'] == pytest.approx(0.05)
+
+    by_geometric = oi.compile_sample('lognormal; gmean=2.0; gsd=1.5')
+    by_normal = oi.compile_sample(f'lognormal; mu={np.log(2.0)}; sigma={np.log(1.5)}')
+    assert by_geometric['a'] == pytest.approx(by_normal['a']) and by_geometric['b'] == pytest.approx(by_normal['b'])
+    assert by_geometric['base'] == pytest.approx(2.0)
+
+    listed = oi.compile_sample('list; 0.5, 1.0, 2.0')
+    assert (listed['base'], listed['low'], listed['high']) == (1.0, 0.5, 2.0)
+
+    with pytest.raises(ValueError):
+        oi.compile_sample('uniform; min=a; max=1')
+    with pytest.raises(ValueError):
+        oi.compile_sample('poisson; 3')
+    # a missing value is named instead of taking another value by its position
+    for param_string, missing in [('uniform; min=1; maximum=2', 'max'), ('triangular; min=1; max=3; base=2', 'mode'),
+                                  ('normal; mean=1', 'sd'), ('lognormal; gmean=2', 'gsd')]:
+        with pytest.raises(ValueError, match=f'missing "{missing}"'):
+            oi.compile_sample(param_string)
+
+
+def test_draw_parameters_moments():
+    param_sheet = pd.DataFrame({'sample': ['uniform; min=1; max=3', 'triangular; min=0; mode=1; max=2',
+                                           'normal; mean=5; sd=0.5', 'lognormal; mu=0; sigma=0.25',
+                                           'list; 1, 2, 3, 4']})
+    table = oi.compile_parameters(param_sheet)
+    assert oi.compile_parameters(param_sheet) is table  # compiled once per sheet content
+
+    np.random.seed(1)
+    block = oi.draw_parameters(table, 20000)
+    assert block.shape == (20000, 5)
+    means = block.mean(axis=0)
+    expected = [2.0, 1.0, 5.0, np.exp(0.25 ** 2 / 2), 2.5]
+    assert means == pytest.approx(expected, rel=0.02)
+
+    medians = oi.quantile_parameters(table, np.full((1, 5), 0.5))[0]
+    assert medians[:4] == pytest.approx([2.0, 1.0, 5.0, 1.0])
+
+
+def test_simulated_parameters(replay_inputs):
+    prov_sheet, param_sheet = replay_inputs
+    param_sheet = param_sheet.assign(uf_group=['use', 'use', 'supply', 'supply'])
+    param_list = [f"{row['name']}.{row['parameter']}" for index, row in param_sheet.iterrows()]
+    res_path = os.path.join('results files', 'raw', 'results.csv')
+    os.makedirs(os.path.dirname(res_path))
+
+    # simulated parameters are empty, so the parameter columns stay numeric
+    setup = oi.simulator_parameters(param_sheet, 'use')
+    assert np.isnan(setup[0][:2]).all() and not np.isnan(setup[0][2:]).any()
+    oi.record_simulated(res_path, 'use', setup, param_list)
+    oi.record_simulated(res_path, 'mca', oi.simulator_parameters(param_sheet), param_list)
+    oi.record_simulated(res_path, 'supply', None, param_list)
+    with open(os.path.join('results files', 'raw', 'results simulated.json')) as f:
+        assert json.load(f) == {'use': param_list[:2], 'mca': param_list}
+
+
+def test_evaluate_formula():
+    variables = {'a': 2.0, 'b': 3.0}
+    assert oi.evaluate_formula('a * 3.6', variables) == pytest.approx(7.2)
+    assert oi.evaluate_formula('a^2 + b', variables) == 7.0
+    assert oi.evaluate_formula('IF(a = 2; b; 0)', variables) == 3.0
+    assert oi.evaluate_formula('and(a > 1; b <> 1) + sqrt(4)', variables) == 3.0
+    # only the chosen branch of if is evaluated
+    assert oi.evaluate_formula('if(c > 0; 1 / c; 0)', {'c': 0.0}) == 0.0
+    with pytest.raises(ZeroDivisionError):
+        oi.evaluate_formula('if(c = 0; 1 / c; 0)', {'c': 0.0})
+    with pytest.raises(NameError):
+        oi.evaluate_formula('c * 2', variables)
+    for formula in ['__import__("os")', 'a.real', '[a, b]', '(lambda: 1)()', 'a if b else 1']:
+        with pytest.raises(ValueError):
+            oi.evaluate_formula(formula, variables)
+
+
+"""CACHES"""
+
+
+def versioned(version, last_change='2024-01-01'):
+    return types.SimpleNamespace(version=version, last_change=last_change)
+
+
+def test_lru_cache_eviction():
+    cache = oi.LRUCache('test', maxsize=2)
+    cache.store('a', versioned('1'))
+    cache.store('b', versioned('1'))
+    assert cache.get('a') is not None  # 'b' is now the least recently used entry
+    cache.store('c', versioned('1'))
+
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.stats() == {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 1, 'evictions': 1, 'invalidations': 0,
+                             'writes': 0}
+
+    cache.resize(1)
+    assert list(cache.entries) == ['c'] and cache.evictions == 2
+
+
+def test_lru_cache_invalidation():
+    cache = oi.LRUCache('test')
+    cache.store('a', versioned('1'))
+    cache.store('a', versioned('1'))
+    assert cache.invalidations == 0
+    cache.store('a', versioned('2'))
+    assert cache.invalidations == 1
+    cache.store('a', versioned('3'), write=True)  # written by this script, not outdated
+    assert cache.invalidations == 1 and cache.writes == 1
+
+    cache.store('b', versioned('1'))
+    database = {'a': versioned('3'), 'b': versioned('1', last_change='2024-02-01')}
+    assert cache.revalidate(database.get) == 1
+    assert cache.get('b').last_change == '2024-02-01'
+
+
+"""STATISTICS"""
+
+
+def test_tdigest_quantiles():
+    rng = np.random.default_rng(1)
+    values = rng.lognormal(0, 0.5, 200000)
+    digest = oi.TDigest()
+    for chunk in np.array_split(values, 37):
+        digest.add(chunk)
+
+    q = np.array([0.001, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.999])
+    assert digest.count == len(values)
+    assert digest.quantile(q) == pytest.approx(np.quantile(values, q), rel=0.01)
+    assert digest.quantile([0, 1]) == pytest.approx([values.min(), values.max()])
+    assert len(digest.means) < 500
+
+    first, second = oi.TDigest(), oi.TDigest()
+    first.add(values[:50000])
+    second.add(values[50000:])
+    first.merge(second)
+    assert first.count == len(values)
+    assert first.quantile(q) == pytest.approx(np.quantile(values, q), rel=0.01)
+
+    assert np.isnan(oi.TDigest().quantile(0.5))
+
+
+def test_group_stats(tmp_path):
+    rng = np.random.default_rng(1)
+    header = ['gwp', 'sim_type']
+    results = pd.DataFrame({'gwp': rng.lognormal(0, 0.5, 30000),
+                            'sim_type': rng.choice(['base', 'mca', 'use', '2'], 30000, p=[0.01, 0.6, 0.3, 0.09])})
+    results.loc[::97, 'gwp'] = np.nan  # failed calculations are skipped
+    res_path = os.path.join(tmp_path, 'raw', 'results.csv')
+    os.makedirs(os.path.dirname(res_path))
+    results.to_csv(res_path, index=False)
+
+    # rows added live in batches give the same stats as the csv streamed in chunks and as pandas
+    live = oi.GroupStats()
+    for chunk in np.array_split(results.values.tolist(), 41):
+        live.add_rows(chunk, header)
+    streamed = oi.stream_group_stats(res_path, chunksize=7000)
+    grouped = results.groupby('sim_type')['gwp']
+    for stats in [live, streamed]:
+        table = stats.table().set_index('sim_type').loc[sorted(grouped.groups)]
+        assert table['n'].tolist() == grouped.count().tolist()
+        assert table['mean_gwp'].to_numpy() == pytest.approx(grouped.mean().to_numpy())
+        assert table['sd_gwp'].to_numpy() == pytest.approx(grouped.std().to_numpy())
+        assert table['max_gwp'].to_numpy() == pytest.approx(grouped.max().to_numpy())
+        assert table['p90'].to_numpy() == pytest.approx(grouped.quantile(0.9).to_numpy(), rel=0.02)
+
+    stats_path, boxplot_path = oi.write_group_stats(streamed, res_path)
+    assert os.path.dirname(stats_path) == str(tmp_path)
+    boxplot = pd.read_csv(boxplot_path, dtype={'sim_type': str}).set_index('sim_type')
+    assert (boxplot['lower_whisker'] >= boxplot['min']).all() and (boxplot['q1'] <= boxplot['median']).all()
+    assert boxplot.loc['mca', 'median'] == pytest.approx(grouped.median()['mca'], rel=0.02)
+
+
+def test_sobol_indices_ishigami():
+    pytest.importorskip('scipy')
+    a, b = 7.0, 0.1
+    variables = ['x1', 'x2', 'x3']
+    columns = [np.array([column]) for column in range(3)]
+    base_runs = 2 ** 13
+    design = oi.saltelli_design(base_runs, 3, columns, seed=1)
+    x = -np.pi + 2 * np.pi * design
+    f = np.sin(x[:, 0]) + a * np.sin(x[:, 1]) ** 2 + b * x[:, 2] ** 4 * np.sin(x[:, 0])
+
+    indices = oi.sobol_indices(f, base_runs, variables, [[name] for name in variables], bootstrap=200, seed=1)
+    indices = indices.set_index('factor').loc[variables]
+
+    # analytic indices of the Ishigami function
+    variance = a ** 2 / 8 + b * np.pi ** 4 / 5 + b ** 2 * np.pi ** 8 / 18 + 0.5
+    v1 = 0.5 * (1 + b * np.pi ** 4 / 5) ** 2
+    v2 = a ** 2 / 8
+    v13 = b ** 2 * np.pi ** 8 * (1 / 18 - 1 / 50)
+    assert indices['S1'].to_numpy() == pytest.approx([v1 / variance, v2 / variance, 0], abs=0.03)
+    assert indices['ST'].to_numpy() == pytest.approx([(v1 + v13) / variance, v2 / variance, v13 / variance], abs=0.03)
+    assert (indices['S1_low'] <= indices['S1']).all() and (indices['S1'] <= indices['S1_high']).all()
+    assert (indices['runs'] == base_runs).all()
+
+
+"""END-TO-END RUN"""
+
+
+def test_main_replay(replay_inputs):
+    prov_sheet, param_sheet = replay_inputs
+    settings = {'sub_names': ['replay'], 'loop_runs': 3, 'param_runs': 2, 'live_histogram': False,
+                'prefetch_workers': 1}
+    np.random.seed(1)
+    oi.main(**settings)
+
+    assert oi.client.recording.misses == 0
+    [res_path] = glob.glob(os.path.join('results files', '*', 'raw', '*.csv'))
+    results = pd.read_csv(res_path)
+    provider_sheets = prov_sheet['provider_sheet'].unique().tolist()
+    assert results.columns.tolist()[:len(provider_sheets) + len(param_sheet)] == \
+        provider_sheets + [f"{row['name']}.{row['parameter']}" for index, row in param_sheet.iterrows()]
+
+    # base, one low and one high run per provider sheet and parameter, the MCA and one sub-group MCA per uf_group
+    counts = results['sim_type'].value_counts().to_dict()
+    assert counts == {'base': 1, 'range': 2 * (len(provider_sheets) + len(param_sheet)), 'mca': 6, 'supply': 6,
+                      'use': 6}
+    assert results['gwp'].notna().all()
+    mca = results[results['sim_type'] == 'mca']
+    for sheet_name in provider_sheets:
+        names = pd.read_excel(os.path.join('providers', f'{sheet_name}.xlsx'))['name']
+        assert mca[sheet_name].isin(names).all()
+    for index, row in param_sheet.iterrows():
+        sample = oi.compile_sample(row['sample'])
+        values = mca[f"{row['name']}.{row['parameter']}"]
+        low = sample['values'].min() if sample['distribution'] == 'list' else sample['low']
+        high = sample['values'].max() if sample['distribution'] == 'list' else sample['high']
+        if sample['distribution'] in ['uniform', 'triangular', 'list']:
+            assert values.between(min(low, high), max(low, high)).all()
+
+    with open(os.path.join('results files', 'checkpoints', 'replay.json')) as f:
+        assert json.load(f)['finished']
+    assert os.path.exists(res_path.replace(os.path.join('raw', ''), '').replace('.csv', '-range_tornado.csv'))
+    group_stats = pd.read_csv(res_path.replace(os.path.join('raw', ''), '').replace('.csv', '-group_stats.csv'))
+    assert group_stats.set_index('sim_type')['n'].to_dict() == counts
+
+    # a second run finds the finished journal and skips the sheet
+    oi.main(**settings)
+    assert glob.glob(os.path.join('results files', '*', 'raw', '*.csv')) == [res_path]
+    assert len(pd.read_csv(res_path)) == len(results)
+
+
+def test_main_adaptive_stopping(replay_inputs, monkeypatch):
+    # the replayed results are the same for every run, so the MCA converges after its first batch of iterations
+    draws = []
+    group_provider_draws = oi.group_provider_draws
+
+    def grouped(provider_draws):
+        draws.append(len(provider_draws))
+        return group_provider_draws(provider_draws)
+
+    monkeypatch.setattr(oi, 'group_provider_draws', grouped)
+    oi.main(sub_names=['replay'], loop_runs=7, param_runs=2, min_loop_runs=3, adaptive_stopping=True,
+            minimize_rewiring=False, base_analysis=False, range_analysis=False, subgroup_mca=False,
+            live_histogram=False, prefetch_workers=1)
+    assert draws == [3, 3, 1]  # repeated combinations are grouped within each batch
+    [res_path] = glob.glob(os.path.join('results files', '*', 'raw', '*.csv'))
+    assert pd.read_csv(res_path)['sim_type'].value_counts().to_dict() == {'mca': 3 * 2}
+
+
+def test_main_settings(tmp_path, monkeypatch):
+    # every setting of main can be overridden, and only those
+    with open(os.path.join(repo_dir, 'oi_0.3.3.py')) as f:
+        names = re.findall(r"setting\('(\w+)'", f.read())
+    assert sorted(set(names)) == sorted(oi.main_settings)
+
+    # unknown names, also internal names of main, fail before anything is traced or written
+    monkeypatch.chdir(tmp_path)
+    for overrides in [{'loop_run': 3}, {'setting': None}, {'sub_name': 'replay'}]:
+        with pytest.raises(TypeError):
+            oi.main(trace_output='trace.json', **overrides)
+        assert not oi.tracer.enabled
+        assert os.listdir(tmp_path) == []
@@ -0,0 +1,33 @@
+"""
+Tests of the parallel MCA: whole iterations run in one worker process per IPC port, here all replaying the same
+recording, see replay_inputs.
+"""
+import glob
+import os
+
+import pandas as pd
+import pytest
+
+import oi
+
+settings = {'sub_names': ['replay'], 'loop_runs': 4, 'param_runs': 2, 'live_histogram': False, 'prefetch_workers': 1,
+            'base_analysis': False, 'range_analysis': False, 'subgroup_mca': False, 'seed': 1}
+
+
+def test_parallel_mca(replay_inputs):
+    prov_sheet, param_sheet = replay_inputs
+    oi.main(ipc_ports=[8080, 8081], **settings)
+
+    [res_path] = glob.glob(os.path.join('results files', '*', 'raw', '*.csv'))
+    results = pd.read_csv(res_path)
+    assert results['sim_type'].value_counts().to_dict() == {'mca': 8}
+    assert results['gwp'].notna().all()
+    for sheet_name in prov_sheet['provider_sheet'].unique():
+        names = pd.read_excel(os.path.join('providers', f'{sheet_name}.xlsx'))['name']
+        assert results[sheet_name].isin(names).all()
+
+
+def test_parallel_local_engine(replay_inputs):
+    with pytest.raises(ValueError):
+        oi.main(ipc_ports=[8080, 8081], local_engine=True, **settings)
+    assert not os.path.exists('results files')
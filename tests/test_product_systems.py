@@ -0,0 +1,87 @@
+"""
+Tests of the ProductSystemManager with the replay client: the product system of the main process is relinked in place
+for each provider combination, and the supply chains of new providers are added to its graph.
+"""
+import olca_schema as olca
+import pandas as pd
+import pytest
+
+import oi
+
+
+@pytest.fixture
+def manager(replay_inputs, monkeypatch):
+    """
+    :return: ProductSystemManager of the replayed main process, function that modifies the processes for the n-th
+        provider of every sheet and returns the provider combination key, list of the product system updates
+    """
+    prov_sheet, param_sheet = replay_inputs
+    monkeypatch.setattr(oi, 'active_checkpoint', None)
+    puts = []
+    put = oi.client.put
+
+    def counted_put(entity):
+        if isinstance(entity, olca.ProductSystem):
+            puts.append(entity)
+        return put(entity)
+
+    monkeypatch.setattr(oi.client, 'put', counted_put)
+
+    def wire(n):
+        provider_dict = {}
+        for sheet_name in prov_sheet['provider_sheet'].unique():
+            provider = pd.read_excel(f'./providers/{sheet_name}.xlsx').iloc[n]
+            provider_dict[sheet_name] = oi.fetch_descriptor(olca.Process, provider['process_uuid'])
+        oi.modify_processes(prov_sheet, provider_dict)
+        return oi.provider_key(provider_dict)
+
+    main_process = oi.fetch_process_json(prov_sheet['uuid'].iloc[0])
+    return oi.ProductSystemManager(main_process, prov_sheet), wire, puts
+
+
+def system_providers(product_system):
+    return {link.provider.id for link in product_system.process_links}
+
+
+def test_relink_and_expand(manager):
+    manager, wire, puts = manager
+    first = wire(0)
+    product_system = manager.acquire(first)
+    assert system_providers(product_system) == {provider_uuid for sheet_name, provider_uuid in first}
+    assert {provider_uuid for sheet_name, provider_uuid in first} <= manager.known  # supply chains were added
+    assert len(puts) == 1
+
+    # the same combination does not update the product system again
+    assert manager.acquire(first) is product_system
+    assert len(puts) == 1
+
+    # another combination rewrites the links, and the old providers are left out of the product system
+    second = wire(1)
+    assert manager.acquire(second) is product_system
+    assert system_providers(product_system) == {provider_uuid for sheet_name, provider_uuid in second}
+    assert {process_ref.id for process_ref in product_system.processes}.isdisjoint(
+        provider_uuid for sheet_name, provider_uuid in first)
+    assert len(puts) == 2
+    assert oi.client.recording.misses == 0
+
+
+def test_relink_checks_key(manager):
+    manager, wire, puts = manager
+    first = wire(0)
+    second = wire(1)
+    with pytest.raises(RuntimeError):
+        manager.acquire(first)  # the processes are modified for the second combination
+    manager.acquire(second)
+
+
+def test_created_system_not_updated(manager, monkeypatch):
+    manager, wire, puts = manager
+    key = wire(0)
+    product_system = manager.acquire(key)
+
+    # a product system that openLCA creates with the current links is not put again on the first relink
+    monkeypatch.setattr(oi, 'new_product_system', lambda process_ref, config: product_system)
+    linked_manager = oi.ProductSystemManager(manager.process_ref, pd.DataFrame(
+        {'uuid': sorted(manager.substituted), 'provider_sheet': 'all'}))
+    linked_manager.acquire(key)
+    assert len(puts) == 1
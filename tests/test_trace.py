@@ -0,0 +1,117 @@
+"""
+Tests of the tracer: stage spans, attribution of IPC requests to the running stage, merge of worker traces, and the
+Chrome trace and OpenMetrics output of a replayed run of main, see replay_inputs.
+"""
+import json
+import os
+import re
+
+import pytest
+
+import oi
+from oi_tools import replay, trace
+
+
+@pytest.fixture
+def tracer():
+    """Empty global tracer, disabled and emptied again after the test so other tests do not trace."""
+    max_events = trace.tracer.max_events
+    trace.tracer.reset()
+    trace.tracer.label = ''
+    yield trace.tracer
+    trace.tracer.disable()
+    trace.tracer.reset()
+    trace.tracer.label = ''
+    trace.tracer.max_events = max_events
+
+
+class EchoClient:
+    """Answers every request with its parameters."""
+
+    url = 'http://localhost:8080'
+
+    def rpc_call(self, method, params=None):
+        return params, None
+
+
+def test_spans_and_requests(tracer):
+    client = trace.TracedClient(EchoClient())
+    client.rpc_call('data/get', {'@id': 'before'})  # not recorded until the tracer is enabled
+    with tracer.span('rewire'):
+        pass
+    assert tracer.metrics == {} and tracer.events == []
+
+    tracer.enable()
+    tracer.label = 'sheet'
+    with tracer.span('calculate'):
+        with tracer.span('rewire'):
+            client.rpc_call('data/put', {'@id': 'x'})
+        client.rpc_call('result/calculate', {'@id': 'y'})
+    client.rpc_call('data/get')
+
+    counts = {key: metric['count'] for key, metric in tracer.metrics.items()}
+    assert counts == {('stage', 'sheet', 'rewire', None): 1, ('stage', 'sheet', 'calculate', None): 1,
+                      ('ipc', 'sheet', 'rewire', 'data/put'): 1, ('ipc', 'sheet', 'calculate', 'result/calculate'): 1,
+                      ('ipc', 'sheet', 'other', 'data/get'): 1}
+    put = tracer.metrics[('ipc', 'sheet', 'rewire', 'data/put')]
+    assert put['request_bytes'] == put['response_bytes'] == len(json.dumps({'@id': 'x'}))
+    assert sum(put['buckets']) == 1
+    # the inner span ends first, and its duration lies within the outer one
+    rewire, calculate = [event for event in tracer.events if event['cat'] == 'stage']
+    assert (rewire['name'], calculate['name']) == ('rewire', 'calculate')
+    assert calculate['ts'] <= rewire['ts'] and rewire['dur'] <= calculate['dur']
+
+
+def test_merge_and_event_limit(tracer):
+    tracer.enable()
+    tracer.max_events = 3
+    worker = trace.Tracer(max_events=2)
+    worker.reset('worker on port 8081')
+    worker.enable()
+    for _ in range(3):
+        with worker.span('calculate'):
+            pass
+    assert worker.dropped == 1
+
+    with tracer.span('calculate'):
+        pass
+    tracer.merge(worker.export())
+    tracer.merge(None)  # workers that did not trace
+    metric = tracer.metrics[('stage', '', 'calculate', None)]
+    assert metric['count'] == 4 and sum(metric['buckets']) == 4
+    assert len(tracer.events) == 3 and tracer.dropped == 1
+    assert 'worker on port 8081' in tracer.process_names.values()
+
+
+def test_main_trace_output(replay_inputs, tracer):
+    oi.main(sub_names=['replay'], loop_runs=3, param_runs=2, subgroup_mca=False, live_histogram=False,
+            prefetch_workers=1, trace_output=os.path.join('traces', 'trace.json'))
+    assert not tracer.enabled
+    assert isinstance(oi.client, replay.ReplayClient)  # the traced client is unwrapped after the run
+
+    with open(os.path.join('traces', 'trace.json')) as f:
+        chrome = json.load(f)
+    events = chrome['traceEvents']
+    assert {event['name'] for event in events if event['ph'] == 'M'} == {'process_name'}
+    spans = [event for event in events if event['ph'] == 'X']
+    stages = {event['name'] for event in spans if event['cat'] == 'stage'}
+    assert {'rewire', 'calculate', 'write'} <= stages
+    requests = [event for event in spans if event['cat'] == 'ipc']
+    assert requests and all(event['args']['sub_name'] == 'replay' for event in spans)
+    assert {'result/calculate', 'data/put'} <= {event['name'] for event in requests}
+    assert all(event['args']['stage'] in stages | {'other'} for event in requests)
+    assert chrome['otherData']['dropped_events'] == 0
+
+    # the same metrics as OpenMetrics text: one histogram per stage and method, with cumulative buckets
+    tracer.write(os.path.join('traces', 'trace.txt'))
+    with open(os.path.join('traces', 'trace.txt')) as f:
+        lines = f.read().splitlines()
+    assert lines[-1] == '# EOF'
+    sample = re.compile(r'^(openimpact_\w+)\{(\w+="[^"]*"(,\w+="[^"]*")*)\} ([0-9.e+-]+)$')
+    assert all(line.startswith('# ') or sample.match(line) for line in lines[:-1])
+    calculate = [line for line in lines
+                 if line.startswith('openimpact_stage_seconds_') and 'stage="calculate"' in line]
+    buckets = [int(sample.match(line).group(4)) for line in calculate if '_bucket' in line]
+    [count] = [int(sample.match(line).group(4)) for line in calculate if '_count' in line]
+    assert buckets == sorted(buckets) and buckets[-1] == count
+    assert count == sum(1 for event in spans if event['name'] == 'calculate' and event['cat'] == 'stage')